@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - Benchmarks
+#
+# Throughput and latency of the pools under concurrent load:
+#
+#   getput  DBConnectionPool.get / put
+#   run     DBInteractionPool.run of a query
+#   listen  PGChannelListener fan-out of NOTIFYs to many subscribers
+#
+# Runs against the in-process fake driver (benchmarks/fake_driver.py) with a
+# simulated round trip latency unless a --dsn is given - then against
+# PostgreSQL through psycopg2.
+#
+# usage: python benchmarks/bench.py [options]   (see --help)
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import os, sys
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ).rpartition( '/' )[ 0 ] )
+
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+from gevent.queue import Queue
+from optparse import OptionParser
+from time import time
+
+import fake_driver
+from gdbpool.connection_pool import DBConnectionPool
+from gdbpool.interaction_pool import DBInteractionPool
+
+
+SCENARIOS = ( 'getput', 'run', 'listen' )
+
+
+def percentile( sorted_values, p ):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[ min( len( sorted_values ) - 1, int( len( sorted_values ) * p / 100.0 ) ) ]
+
+
+def report( name, latencies, took ):
+    latencies.sort()
+    print "%-8s %8i ops in %7.3fs  %10.1f ops/s  p50 %8.3f ms  p99 %8.3f ms  max %8.3f ms" % (
+        name, len( latencies ), took, len( latencies ) / took if took else 0.0,
+        percentile( latencies, 50 ) * 1000, percentile( latencies, 99 ) * 1000,
+        ( latencies[ -1 ] if latencies else 0.0 ) * 1000 )
+
+
+def drive( f, concurrency, ops ):
+    """
+    Call `f` `ops` times spread over `concurrency` greenlets
+
+    :rtype: tuple
+    :returns: ( list of the latencies of the calls, seconds it took in total )
+    """
+
+    latencies = []
+    per_greenlet = [ ops // concurrency + ( 1 if i < ops % concurrency else 0 ) for i in xrange( concurrency ) ]
+
+    def loop( n ):
+        for i in xrange( n ):
+            start = time()
+            f()
+            latencies.append( time() - start )
+
+    start = time()
+    gevent.joinall( [ gevent.spawn( loop, n ) for n in per_greenlet if n ], raise_error = True )
+    return latencies, time() - start
+
+
+def bench_getput( options ):
+    pool = DBConnectionPool( options.dsn, db_module = options.db_module, pool_size = options.pool_size,
+                             health_check_interval = None )
+
+    def getput():
+        conn = pool.get()
+        pool.put( conn )
+
+    try:
+        report( 'getput', *drive( getput, options.concurrency, options.ops ) )
+    finally:
+        pool.__del__()
+
+
+def bench_run( ipool, options ):
+    sql = options.query
+
+    def run():
+        ipool.run( sql ).get()
+
+    report( 'run', *drive( run, options.concurrency, options.ops ) )
+
+
+def bench_listen( ipool, options ):
+    channel = 'gdbpool_bench'
+    subscribers = options.subscribers
+    messages = max( 1, options.ops // subscribers )
+    latencies = []
+    subscriptions = [ ipool.listen_on( Queue(), channel, unmarshaller = 'raw' ) for i in xrange( subscribers ) ]
+    # the LISTEN has to be through before the first NOTIFY
+    gevent.sleep( 0.1 )
+
+    def receive( q ):
+        for i in xrange( messages ):
+            sent_at = float( q.get() )
+            latencies.append( time() - sent_at )
+
+    receivers = [ gevent.spawn( receive, s.queue ) for s in subscriptions ]
+    start = time()
+    for i in xrange( messages ):
+        ipool.run( "NOTIFY %s, %%s;" % ( channel, ), ( repr( time() ), ) ).get()
+    gevent.joinall( receivers, raise_error = True )
+    took = time() - start
+    for subscription in subscriptions:
+        subscription.close()
+    report( 'listen', latencies, took )
+
+
+def main():
+    parser = OptionParser( usage = "%prog [options]" )
+    parser.add_option( '-s', '--scenarios', default = ','.join( SCENARIOS ),
+                       help = "comma separated scenarios to run: %s [default: all]" % ( ', '.join( SCENARIOS ), ) )
+    parser.add_option( '-c', '--concurrency', type = 'int', default = 50,
+                       help = "greenlets issuing requests at the same time [default: %default]" )
+    parser.add_option( '-n', '--ops', type = 'int', default = 10000,
+                       help = "operations per scenario (deliveries for listen) [default: %default]" )
+    parser.add_option( '-p', '--pool-size', type = 'int', default = 10,
+                       help = "connections per pool [default: %default]" )
+    parser.add_option( '-w', '--workers', type = 'int', default = None,
+                       help = "worker greenlets of the interaction pool [default: one greenlet per run]" )
+    parser.add_option( '--subscribers', type = 'int', default = 100,
+                       help = "queues subscribed to the channel for listen [default: %default]" )
+    parser.add_option( '-l', '--latency', type = 'float', default = 0.5,
+                       help = "fake driver: milliseconds per query [default: %default]" )
+    parser.add_option( '-j', '--jitter', type = 'float', default = 0.0,
+                       help = "fake driver: random extra milliseconds per query [default: %default]" )
+    parser.add_option( '-q', '--query', default = "SELECT 1;",
+                       help = "query to run for the run scenario [default: %default]" )
+    parser.add_option( '-d', '--dsn', default = None,
+                       help = "run against PostgreSQL with this dsn instead of the fake driver" )
+    options, args = parser.parse_args()
+
+    scenarios = [ s.strip() for s in options.scenarios.split( ',' ) if s.strip() ]
+    for s in scenarios:
+        if s not in SCENARIOS:
+            parser.error( "unknown scenario: %s" % ( s, ) )
+    if options.dsn is None:
+        options.dsn = 'fake'
+        options.db_module = fake_driver.MODULE_NAME
+        fake_driver.configure( latency = options.latency / 1000.0, jitter = options.jitter / 1000.0 )
+        print "fake driver: %.3f ms latency, %.3f ms jitter" % ( options.latency, options.jitter )
+    else:
+        options.db_module = 'psycopg2'
+        print "psycopg2: %s" % ( options.dsn, )
+    print "concurrency %i, pool size %i, workers %s" % ( options.concurrency, options.pool_size, options.workers )
+
+    if 'getput' in scenarios:
+        bench_getput( options )
+    if 'run' in scenarios or 'listen' in scenarios:
+        ipool = DBInteractionPool( options.dsn, pool_size = options.pool_size, workers = options.workers,
+                                   health_check_interval = None, db_module = options.db_module )
+        try:
+            if 'run' in scenarios:
+                bench_run( ipool, options )
+            if 'listen' in scenarios:
+                bench_listen( ipool, options )
+        finally:
+            ipool.__del__()
+
+
+if __name__ == '__main__':
+    main()
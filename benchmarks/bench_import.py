@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - Benchmarks
+#
+# Import time of the gDBPool modules in fresh interpreters - with and
+# without gdbpool.setup() (monkey patching, psycopg2 wait callback and
+# unicode types - what importing the modules used to do) - and the side
+# effects the import leaves behind.
+#
+# usage: python benchmarks/bench_import.py [runs]
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import os, sys
+import subprocess
+
+
+ROOT = os.path.dirname( os.path.abspath( __file__ ) ).rpartition( '/' )[ 0 ]
+
+CHILD = """
+import sys
+sys.path.insert( 0, %(root)r )
+from time import time
+started = time()
+%(code)s
+took = time() - started
+from gevent import monkey
+import psycopg2.extensions
+print "%%f %%i %%i" %% ( took, monkey.is_module_patched( 'socket' ), psycopg2.extensions.get_wait_callback() is not None )
+"""
+
+CASES = (
+    ( 'import gdbpool', "import gdbpool" ),
+    ( 'import gdbpool.gdbpool_error', "import gdbpool.gdbpool_error" ),
+    ( 'import gdbpool.interaction_pool', "import gdbpool.interaction_pool" ),
+    ( 'setup() + import interaction_pool', "import gdbpool; gdbpool.setup(); import gdbpool.interaction_pool" ),
+)
+
+
+def run_case( code ):
+    out = subprocess.check_output( [ sys.executable, '-c', CHILD % { 'root': ROOT, 'code': code } ] )
+    took, patched, green = out.split()
+    return float( took ), patched == '1', green == '1'
+
+
+if __name__ == '__main__':
+    runs = int( sys.argv[ 1 ] ) if len( sys.argv ) > 1 else 10
+    print "%i fresh interpreters per case, import time:" % ( runs, )
+    for name, code in CASES:
+        results = [ run_case( code ) for i in xrange( runs ) ]
+        times = sorted( [ r[ 0 ] for r in results ] )
+        print "  %-36s min %7.2f ms  median %7.2f ms  patched: %-5s  wait callback: %s" % (
+            name, times[ 0 ] * 1000, times[ len( times ) // 2 ] * 1000, results[ 0 ][ 1 ], results[ 0 ][ 2 ] )
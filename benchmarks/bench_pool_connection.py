@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - Benchmarks
+#
+# Per-query overhead of the PoolConnection wrapper: the hot path of an
+# interaction (set_isolation_level, cursor, execute, fetchall, commit,
+# reset) run against an in-memory DB-API module, through the old
+# __getattribute__ proxy and through the current PoolConnection.
+#
+# usage: python benchmarks/bench_pool_connection.py [iterations]
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import os, sys
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ).rpartition( '/' )[ 0 ] )
+
+import types
+from time import time
+
+from gdbpool.pool_connection import PoolConnection
+
+
+class DummyCursor( object ):
+
+    def __init__( self, conn ):
+        self.conn = conn
+
+    def execute( self, sql, args = None ):
+        pass
+
+    def fetchall( self ):
+        return []
+
+    def close( self ):
+        pass
+
+
+class DummyConnection( object ):
+
+    def __init__( self, dsn ):
+        self.isolation_level = 1
+        self.closed = 0
+
+    def cursor( self, *args, **kwargs ):
+        return DummyCursor( self )
+
+    def set_isolation_level( self, level ):
+        self.isolation_level = level
+
+    def commit( self ):
+        pass
+
+    def rollback( self ):
+        pass
+
+    def reset( self ):
+        pass
+
+
+dummy_module = types.ModuleType( 'gdbpool_bench_dummy' )
+dummy_module.connect = DummyConnection
+sys.modules[ 'gdbpool_bench_dummy' ] = dummy_module
+
+
+class LegacyPoolConnection( object ):
+    """
+    The PoolConnection proxy as it was before it got __slots__ and explicit
+    delegation: every member access goes through __getattribute__.
+    """
+
+    def __init__( self, db_module, dsn, cursor_type = None ):
+        self.db_module_name = db_module
+        self.cursor_type = cursor_type
+        self.db_module = sys.modules[ db_module ]
+        self.stmt_cache = None
+        self.conn = self.PoolConnection_db_module.connect( dsn )
+        self.initialized_at = time()
+
+    def __getattribute__( self, name ):
+        if name.startswith( 'PoolConnection_' ) or name == 'cursor':
+            if name == 'cursor':
+                return object.__getattribute__( self, name )
+            else:
+                return object.__getattribute__( self, name[15:] )
+        else:
+            return object.__getattribute__( self.PoolConnection_conn, name )
+
+    def cursor( self, *args, **kwargs ):
+        return self.PoolConnection_conn.cursor( *args, **kwargs )
+
+    def execute( self, cursor, sql, args = None ):
+        if self.PoolConnection_stmt_cache is not None:
+            self.PoolConnection_stmt_cache.execute( self, cursor, sql, args )
+        elif args is not None:
+            cursor.execute( sql, args )
+        else:
+            cursor.execute( sql )
+
+
+def legacy_interaction( conn ):
+    if conn.isolation_level != 1:
+        conn.set_isolation_level( 1 )
+    cursor = conn.cursor()
+    conn.PoolConnection_execute( cursor, "SELECT 1;", None )
+    cursor.fetchall()
+    conn.commit()
+    conn.PoolConnection_stmt_cache
+    conn.reset()
+
+
+def interaction( conn ):
+    if conn.isolation_level != 1:
+        conn.set_isolation_level( 1 )
+    cursor = conn.cursor()
+    conn.execute( cursor, "SELECT 1;", None )
+    cursor.fetchall()
+    conn.commit()
+    conn.stmt_cache
+    conn.reset()
+
+
+def bare_interaction( conn ):
+    if conn.isolation_level != 1:
+        conn.set_isolation_level( 1 )
+    cursor = conn.cursor()
+    cursor.execute( "SELECT 1;" )
+    cursor.fetchall()
+    conn.commit()
+    conn.reset()
+
+
+def bench( f, conn, iterations ):
+    best = None
+    for i in xrange( 5 ):
+        start = time()
+        for j in xrange( iterations ):
+            f( conn )
+        took = time() - start
+        if best is None or took < best:
+            best = took
+    return best / iterations * 1e6
+
+
+if __name__ == '__main__':
+    iterations = int( sys.argv[ 1 ] ) if len( sys.argv ) > 1 else 100000
+    bare = bench( bare_interaction, DummyConnection( None ), iterations )
+    legacy = bench( legacy_interaction, LegacyPoolConnection( 'gdbpool_bench_dummy', None ), iterations )
+    current = bench( interaction, PoolConnection( 'gdbpool_bench_dummy', None ), iterations )
+    print "%i iterations, best of 5, per interaction:" % ( iterations, )
+    print "  bare connection:            %6.2f us" % ( bare, )
+    print "  __getattribute__ proxy:     %6.2f us (+%.2f us)" % ( legacy, legacy - bare )
+    print "  PoolConnection (__slots__): %6.2f us (+%.2f us)" % ( current, current - bare )
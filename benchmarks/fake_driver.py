@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - Benchmarks
+#
+# In-process DB-API 2.0 driver that behaves enough like psycopg2 for the
+# pools to run against it without a database: every query takes a
+# (configurable) simulated round trip, ``NOTIFY`` is delivered to the
+# connections that ``LISTEN`` on the channel through their fileno() and
+# poll() like psycopg2 does.
+#
+# Plug it in through the `db_module` parameter of DBConnectionPool or
+# DBInteractionPool once it is imported (it registers itself as
+# 'gdbpool_fake_driver' in sys.modules).
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import os, sys, re, fcntl
+import gevent
+
+from random import random
+from itertools import count
+
+
+MODULE_NAME = 'gdbpool_fake_driver'
+
+apilevel = '2.0'
+threadsafety = 2
+paramstyle = 'pyformat'
+
+# transaction status as returned by get_transaction_status() (psycopg2.extensions)
+TRANSACTION_STATUS_IDLE = 0
+TRANSACTION_STATUS_INTRANS = 2
+
+# seconds each query takes and random extra seconds on top
+LATENCY = 0.0005
+JITTER = 0.0
+# the rows each query returns
+ROWS = [ { 'id': 1, 'val': 'a' } ]
+
+NOTIFY_RE = re.compile( r"^\s*NOTIFY\s+\"?(\w+)\"?\s*(?:,\s*'((?:[^']|'')*)')?\s*;?\s*$", re.IGNORECASE )
+LISTEN_RE = re.compile( r"^\s*(UN)?LISTEN\s+\"?(\w+|\*)\"?\s*;?\s*$", re.IGNORECASE )
+
+connections = set()
+backend_pids = count( 1000 )
+
+
+def configure( latency = None, jitter = None, rows = None ):
+    """
+    Change the simulated latency (seconds per query plus random jitter) and
+    the rows every query returns
+    """
+
+    global LATENCY, JITTER, ROWS
+    if latency is not None:
+        LATENCY = latency
+    if jitter is not None:
+        JITTER = jitter
+    if rows is not None:
+        ROWS = rows
+
+
+def round_trip():
+    delay = LATENCY + ( random() * JITTER if JITTER else 0 )
+    if delay > 0:
+        gevent.sleep( delay )
+
+
+def quote( value ):
+    if value is None:
+        return 'NULL'
+    if isinstance( value, bool ):
+        return 'true' if value else 'false'
+    if isinstance( value, ( int, long, float ) ):
+        return repr( value )
+    if isinstance( value, unicode ):
+        value = value.encode( 'utf-8' )
+    return "'%s'" % ( str( value ).replace( "'", "''" ), )
+
+
+def notify( channel, payload = '', pid = 0 ):
+    """
+    Deliver a notification to all connections listening on `channel` (like
+    ``NOTIFY channel, 'payload'`` does)
+    """
+
+    for conn in list( connections ):
+        if channel in conn.listening:
+            conn.deliver( Notify( pid, channel, payload ) )
+
+
+class Error( StandardError ):
+    pass
+
+class InterfaceError( Error ):
+    pass
+
+class DatabaseError( Error ):
+    pass
+
+class OperationalError( DatabaseError ):
+    pass
+
+class ProgrammingError( DatabaseError ):
+    pass
+
+
+class Notify( object ):
+
+    def __init__( self, pid, channel, payload ):
+        self.pid = pid
+        self.channel = channel
+        self.payload = payload
+
+
+class Cursor( object ):
+
+    def __init__( self, conn, name = None ):
+        self.conn = conn
+        self.name = name
+        self.closed = False
+        self.rows = []
+        self.rowcount = -1
+        self.description = None
+        self.itersize = 2000
+
+    def mogrify( self, sql, args = None ):
+        if args is None:
+            return sql
+        if isinstance( args, dict ):
+            return sql % dict( [ ( k, quote( v ) ) for k, v in args.items() ] )
+        return sql % tuple( [ quote( a ) for a in args ] )
+
+    def execute( self, sql, args = None ):
+        conn = self.conn
+        if self.closed or conn.closed:
+            raise InterfaceError( "cursor already closed" )
+        sql = self.mogrify( sql, args )
+        round_trip()
+        if not conn.autocommit:
+            conn.status = TRANSACTION_STATUS_INTRANS
+        m = NOTIFY_RE.match( sql )
+        if m is not None:
+            notify( m.group( 1 ), ( m.group( 2 ) or '' ).replace( "''", "'" ), conn.pid )
+            self.rows = []
+            self.rowcount = -1
+            self.description = None
+            return
+        m = LISTEN_RE.match( sql )
+        if m is not None:
+            if m.group( 1 ) is None:
+                conn.listening.add( m.group( 2 ) )
+            elif m.group( 2 ) == '*':
+                conn.listening.clear()
+            else:
+                conn.listening.discard( m.group( 2 ) )
+            self.rows = []
+            self.rowcount = -1
+            self.description = None
+            return
+        self.rows = list( ROWS )
+        self.rowcount = len( self.rows )
+        self.description = tuple( [ ( k, None, None, None, None, None, None ) for k in ( ROWS[ 0 ] if ROWS else () ) ] )
+
+    def executemany( self, sql, seq_of_args ):
+        rowcount = 0
+        for args in seq_of_args:
+            self.execute( sql, args )
+            rowcount += 1
+        self.rows = []
+        self.rowcount = rowcount
+
+    def fetchone( self ):
+        return self.rows.pop( 0 ) if self.rows else None
+
+    def fetchmany( self, size = None ):
+        size = size or self.itersize
+        rows, self.rows = self.rows[ :size ], self.rows[ size: ]
+        return rows
+
+    def fetchall( self ):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__( self ):
+        while self.rows:
+            yield self.rows.pop( 0 )
+
+    def close( self ):
+        self.closed = True
+
+
+class Connection( object ):
+
+    def __init__( self, dsn ):
+        round_trip()
+        self.dsn = dsn
+        self.closed = 0
+        self.autocommit = False
+        self.isolation_level = 1
+        self.status = TRANSACTION_STATUS_IDLE
+        self.pid = backend_pids.next()
+        self.listening = set()
+        self.notifies = []
+        self.pending = []
+        # notifications wake up select() on fileno() like data on the socket of a real connection
+        self.rfd, self.wfd = os.pipe()
+        fcntl.fcntl( self.rfd, fcntl.F_SETFL, os.O_NONBLOCK )
+        connections.add( self )
+
+    def cursor( self, name = None, cursor_factory = None, **kwargs ):
+        if self.closed:
+            raise InterfaceError( "connection already closed" )
+        return Cursor( self, name )
+
+    def commit( self ):
+        if self.status != TRANSACTION_STATUS_IDLE:
+            round_trip()
+            self.status = TRANSACTION_STATUS_IDLE
+
+    def rollback( self ):
+        if self.status != TRANSACTION_STATUS_IDLE:
+            round_trip()
+            self.status = TRANSACTION_STATUS_IDLE
+
+    def reset( self ):
+        round_trip()
+        self.status = TRANSACTION_STATUS_IDLE
+        self.set_isolation_level( 1 )
+        self.listening.clear()
+
+    def set_isolation_level( self, level ):
+        self.isolation_level = level
+        self.autocommit = level == 0
+
+    def get_transaction_status( self ):
+        return self.status
+
+    def cancel( self ):
+        pass
+
+    def fileno( self ):
+        return self.rfd
+
+    def deliver( self, notify ):
+        self.pending.append( notify )
+        if len( self.pending ) == 1:
+            os.write( self.wfd, 'n' )
+
+    def poll( self ):
+        if self.closed:
+            raise OperationalError( "connection closed" )
+        try:
+            os.read( self.rfd, 4096 )
+        except OSError:
+            pass
+        self.notifies.extend( self.pending )
+        self.pending = []
+        return 0
+
+    def close( self ):
+        if not self.closed:
+            self.closed = 1
+            connections.discard( self )
+            os.close( self.rfd )
+            os.close( self.wfd )
+
+
+def connect( dsn = None, **kwargs ):
+    return Connection( dsn )
+
+
+sys.modules.setdefault( MODULE_NAME, sys.modules[ __name__ ] )
@@ -0,0 +1 @@
+from .gdbpool_setup import setup
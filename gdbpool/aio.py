@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# asyncio flavour of DBInteractionPool, DBConnectionPool and PGChannelListener
+# on psycopg2's asynchronous connections. Python 3 only - no gevent, no
+# monkey patching, no wait callback.
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import asyncio
+
+from collections import deque
+from time import time
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
+
+from .gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, DBInteractionTimeoutException
+from .channel_payload import PGChannelListenerException, quote_channel_name, get_unmarshaller
+
+
+ISOLATION_LEVELS = {
+    ISOLATION_LEVEL_READ_UNCOMMITTED: 'READ UNCOMMITTED',
+    ISOLATION_LEVEL_READ_COMMITTED: 'READ COMMITTED',
+    ISOLATION_LEVEL_REPEATABLE_READ: 'REPEATABLE READ',
+    ISOLATION_LEVEL_SERIALIZABLE: 'SERIALIZABLE',
+}
+
+
+async def wait( conn ):
+    """
+    Drive an asynchronous psycopg2 connection until the pending operation
+    (connect or query) is done - waiting for its socket through the event
+    loop's reader/writer callbacks.
+    """
+
+    loop = asyncio.get_running_loop()
+    fd = conn.fileno()
+    while 1:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        future = loop.create_future()
+        if state == extensions.POLL_READ:
+            loop.add_reader( fd, _ready, future )
+            try:
+                await future
+            finally:
+                loop.remove_reader( fd )
+        elif state == extensions.POLL_WRITE:
+            loop.add_writer( fd, _ready, future )
+            try:
+                await future
+            finally:
+                loop.remove_writer( fd )
+        else:
+            raise psycopg2.OperationalError( "Bad result from poll: %r" % ( state, ) )
+
+
+def _ready( future ):
+    if not future.done():
+        future.set_result( None )
+
+
+class AsyncPoolConnection( object ):
+    """
+    An asynchronous psycopg2 connection.
+
+    Asynchronous connections are always in autocommit mode. To keep the
+    semantics of the gevent pool's connections `execute` begins a transaction
+    (in the same round trip) if none is open - unless the connection's
+    isolation level is ISOLATION_LEVEL_AUTOCOMMIT - and `commit` / `rollback`
+    end it.
+    """
+
+    __slots__ = ( 'conn', 'initialized_at', 'expires_at', 'iso_level', 'broken' )
+
+    def __init__( self, conn ):
+        self.conn = conn
+        self.initialized_at = time()
+        self.expires_at = None
+        self.iso_level = ISOLATION_LEVEL_READ_COMMITTED
+        self.broken = False
+
+    @classmethod
+    async def connect( cls, dsn ):
+        """
+        :rtype: AsyncPoolConnection
+        :raises: :class:`PoolConnectionException` if the connection could not be opened
+        """
+        try:
+            conn = psycopg2.connect( dsn, async_ = 1 )
+            await wait( conn )
+        except psycopg2.Error as e:
+            raise PoolConnectionException( str( e ) )
+        return cls( conn )
+
+    @property
+    def closed( self ):
+        return self.conn.closed
+
+    @property
+    def in_transaction( self ):
+        return self.conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor( self, cursor_factory = RealDictCursor ):
+        return self.conn.cursor( cursor_factory = cursor_factory )
+
+    async def execute( self, sql, args = None, cursor = None, begin = True ):
+        """
+        Execute a query
+
+        :param string sql: the query
+        :param args: args for the query's placeholders
+        :param cursor: cursor to execute the query on. A new one if None.
+        :param bool begin: begin a transaction first if none is open
+        :rtype: cursor
+        :returns: the cursor that executed the query
+        """
+        if cursor is None:
+            cursor = self.cursor()
+        if begin and self.iso_level != ISOLATION_LEVEL_AUTOCOMMIT and not self.in_transaction:
+            sql = "BEGIN ISOLATION LEVEL %s; %s" % ( ISOLATION_LEVELS[ self.iso_level ], sql )
+        try:
+            cursor.execute( sql, args )
+            await wait( self.conn )
+        except asyncio.CancelledError:
+            # the query is still running on the server
+            self.broken = True
+            try:
+                self.conn.cancel()
+            except psycopg2.Error:
+                pass
+            raise
+        except ( psycopg2.OperationalError, psycopg2.InterfaceError ):
+            self.broken = True
+            raise
+        return cursor
+
+    async def fetch( self, sql, args = None, begin = True ):
+        """
+        :returns: the rows of the query or None if it returns none
+        """
+        cursor = await self.execute( sql, args, begin = begin )
+        try:
+            return cursor.fetchall() if cursor.description is not None else None
+        finally:
+            cursor.close()
+
+    async def commit( self ):
+        if self.in_transaction:
+            await self.execute( "COMMIT;", begin = False )
+
+    async def rollback( self ):
+        if self.in_transaction:
+            await self.execute( "ROLLBACK;", begin = False )
+
+    def close( self ):
+        self.conn.close()
+
+
+class AsyncConnectionPool( object ):
+    """
+    asyncio flavour of :class:`DBConnectionPool`: elastic pool of
+    :class:`AsyncPoolConnection` objects.
+
+    The pool keeps `min_size` connections open and opens new ones while
+    callers wait for a connection up to `max_size`. Connections are recycled
+    after `conn_lifetime` seconds when they are put back. Call
+    :meth:`.open` before using the pool.
+    """
+
+    def __init__( self, dsn, pool_size = 10, min_size = None, max_size = None,
+                  conn_lifetime = 600 ):
+        """
+        :param string dsn: dsn
+        :param int pool_size: Used for `min_size` and `max_size` if they are not set.
+        :param int min_size: Number of connections to open right away and keep open
+        :param int max_size: Maximum number of connections (idle and checked out)
+        :param int conn_lifetime: Seconds after which a connection is recycled. None keeps connections open forever.
+        """
+        self.dsn = dsn
+        self.min_size = pool_size if min_size is None else min_size
+        self.max_size = max( self.min_size, pool_size if max_size is None else max_size )
+        self.conn_lifetime = conn_lifetime
+        self.idle = []
+        self.waiters = deque()
+        self.size = 0
+        self.pending = 0
+        self.tasks = set()
+
+    async def open( self ):
+        """
+        Open `min_size` connections
+
+        :raises: :class:`DBPoolConnectionException` if the connections could not be opened
+        """
+        self.size += self.min_size
+        self.pending += self.min_size
+        results = await asyncio.gather( *[ self._open_connection() for i in range( self.min_size ) ],
+                                        return_exceptions = True )
+        errors = [ str( r ) for r in results if isinstance( r, Exception ) ]
+        if errors:
+            self.close()
+            raise DBPoolConnectionException( "Could not get %s connections for the pool as requested. %s" % ( self.min_size, ' '.join( errors ) ) )
+        return self
+
+    async def _open_connection( self ):
+        # the caller already accounted for the connection in size and pending
+        try:
+            conn = await AsyncPoolConnection.connect( self.dsn )
+        except PoolConnectionException as e:
+            self.pending -= 1
+            self.size -= 1
+            if self.size == 0:
+                while self.waiters:
+                    waiter = self.waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_exception( e )
+            raise
+        self.pending -= 1
+        if self.conn_lifetime:
+            conn.expires_at = conn.initialized_at + self.conn_lifetime
+        self._release( conn )
+
+    def _spawn( self, coro ):
+        task = asyncio.ensure_future( coro )
+        self.tasks.add( task )
+        task.add_done_callback( self._task_done )
+        return task
+
+    def _task_done( self, task ):
+        self.tasks.discard( task )
+        if not task.cancelled():
+            task.exception()
+
+    def _grow( self ):
+        self.size += 1
+        self.pending += 1
+        self._spawn( self._open_connection() )
+
+    def _release( self, conn ):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result( conn )
+                return
+        self.idle.append( conn )
+
+    def _close( self, conn ):
+        self.size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    async def get( self, timeout = None, iso_level = ISOLATION_LEVEL_READ_COMMITTED ):
+        """
+        Get a connection from the pool
+
+        :param float timeout: seconds to wait for a connection or None
+        :param iso_level: transaction isolation level for the transactions on the connection (psycopg2.extensions ISOLATION_LEVEL_*)
+        :rtype: AsyncPoolConnection
+        """
+        if self.idle:
+            conn = self.idle.pop()
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append( waiter )
+            if self.pending < len( self.waiters ) and self.size < self.max_size:
+                self._grow()
+            try:
+                conn = await asyncio.wait_for( waiter, timeout )
+            except asyncio.TimeoutError:
+                raise PoolConnectionException( "Timed out waiting for a connection." )
+            except asyncio.CancelledError:
+                # a connection handed over in the meantime goes to the next one
+                if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                    self._release( waiter.result() )
+                raise
+        conn.iso_level = iso_level
+        return conn
+
+    def put( self, conn, force_recycle = False ):
+        """
+        Put a connection back onto the pool. An open transaction is rolled
+        back first (in the background).
+
+        :param AsyncPoolConnection conn: the connection
+        :param bool force_recycle: close the connection instead of reusing it
+        """
+        if not isinstance( conn, AsyncPoolConnection ):
+            raise PoolConnectionException( "Passed object %s is not an AsyncPoolConnection." % ( conn, ) )
+        expires_at = conn.expires_at
+        if force_recycle or conn.broken or conn.closed or self.size > self.max_size or \
+                ( expires_at is not None and time() >= expires_at ):
+            self._close( conn )
+            if self.waiters or self.size < self.min_size:
+                self._grow()
+        elif conn.in_transaction:
+            self._spawn( self._rollback_and_release( conn ) )
+        else:
+            self._release( conn )
+
+    async def _rollback_and_release( self, conn ):
+        try:
+            await conn.rollback()
+        except Exception:
+            self._close( conn )
+            if self.waiters or self.size < self.min_size:
+                self._grow()
+            return
+        self._release( conn )
+
+    def close( self ):
+        """
+        Close the idle connections and stop opening new ones
+        """
+        for task in list( self.tasks ):
+            task.cancel()
+        while self.idle:
+            self._close( self.idle.pop() )
+
+    @property
+    def qsize( self ):
+        """ nr of idle connections on the pool """
+        return len( self.idle )
+
+    @property
+    def in_use( self ):
+        """ nr of checked out connections """
+        return self.size - self.pending - len( self.idle )
+
+
+class AsyncChannelListener( object ):
+    """
+    asyncio flavour of :class:`PGChannelListener`: one connection per pool
+    LISTENs on the channels of all subscriptions. Its socket is watched with
+    the event loop's reader callback and the notifications are put onto the
+    subscribed :class:`asyncio.Queue` objects.
+    """
+
+    def __init__( self, pool ):
+        self.pool = pool
+        self.conn = None
+        self.watching = False
+        self.subscribers = {}
+        self.lock = asyncio.Lock()
+
+    async def subscribe( self, q, channel_name, unmarshaller = 'pipe_colon' ):
+        unmarshaller = get_unmarshaller( unmarshaller )
+        async with self.lock:
+            if self.conn is None:
+                self.conn = await self.pool.get( iso_level = ISOLATION_LEVEL_AUTOCOMMIT )
+            if channel_name not in self.subscribers:
+                await self._command( "LISTEN %s;" % ( quote_channel_name( channel_name ), ) )
+            self.subscribers.setdefault( channel_name, {} )[ id( q ) ] = ( q, unmarshaller )
+            self._watch()
+
+    async def unsubscribe( self, q, channel_name ):
+        async with self.lock:
+            queues = self.subscribers.get( channel_name )
+            if queues is None or queues.pop( id( q ), None ) is None:
+                return
+            if queues:
+                return
+            del self.subscribers[ channel_name ]
+            try:
+                await self._command( "UNLISTEN %s;" % ( quote_channel_name( channel_name ), ) )
+            except Exception:
+                pass
+            if not self.subscribers:
+                self._unwatch()
+                conn, self.conn = self.conn, None
+                self.pool.put( conn )
+
+    def _watch( self ):
+        if not self.watching and self.conn is not None:
+            asyncio.get_running_loop().add_reader( self.conn.conn.fileno(), self._on_readable )
+            self.watching = True
+
+    def _unwatch( self ):
+        if self.watching:
+            asyncio.get_running_loop().remove_reader( self.conn.conn.fileno() )
+            self.watching = False
+
+    async def _command( self, sql ):
+        # the query's own wait needs the socket's reader callback
+        self._unwatch()
+        try:
+            await self.conn.execute( sql, begin = False )
+        finally:
+            self._dispatch()
+            # the remaining channels still need their notifications
+            if self.subscribers:
+                self._watch()
+
+    def _on_readable( self ):
+        try:
+            self.conn.conn.poll()
+        except psycopg2.Error as e:
+            self._unwatch()
+            conn, self.conn = self.conn, None
+            self.pool.put( conn, force_recycle = True )
+            error = DBInteractionException( "Lost the listener connection: %s" % ( e, ) )
+            for queues in self.subscribers.values():
+                for q, unmarshaller in queues.values():
+                    q.put_nowait( error )
+            self.subscribers = {}
+            return
+        self._dispatch()
+
+    def _dispatch( self ):
+        if self.conn is None:
+            return
+        notifies = self.conn.conn.notifies
+        while notifies:
+            notify = notifies.pop( 0 )
+            for q, unmarshaller in list( self.subscribers.get( notify.channel, {} ).values() ):
+                try:
+                    payload = unmarshaller( notify.payload )
+                except PGChannelListenerException as e:
+                    payload = e
+                q.put_nowait( payload )
+
+
+# ends the iteration over a closed subscription
+SUBSCRIPTION_CLOSED = object()
+
+
+class AsyncChannelSubscription( object ):
+    """
+    Handle of a LISTEN subscription. Iterate over it with ``async for`` to
+    get the payloads; :meth:`.close` (or leaving ``async with``) stops it.
+    """
+
+    def __init__( self, listener, queue, channel_name ):
+        self.listener = listener
+        self.queue = queue
+        self.channel_name = channel_name
+        self.closed = False
+
+    def __aiter__( self ):
+        return self
+
+    async def __anext__( self ):
+        payload = await self.queue.get()
+        if payload is SUBSCRIPTION_CLOSED:
+            raise StopAsyncIteration
+        return payload
+
+    async def __aenter__( self ):
+        return self
+
+    async def __aexit__( self, *exc_info ):
+        await self.close()
+
+    async def close( self ):
+        if not self.closed:
+            self.closed = True
+            await self.listener.unsubscribe( self.queue, self.channel_name )
+            self.queue.put_nowait( SUBSCRIPTION_CLOSED )
+
+
+class AsyncInteractionPool( object ):
+    """
+    asyncio flavour of :class:`DBInteractionPool`
+
+    Runs SQL and coroutine function interactions on named
+    :class:`AsyncConnectionPool` pools - ``rows = await ipool.run( sql, args )`` -
+    and subscribes :class:`asyncio.Queue` objects to LISTEN channels -
+    ``async for payload in await ipool.listen_on( 'channel' )``.
+
+    Use it as ``async with AsyncInteractionPool( dsn ) as ipool:`` or call
+    :meth:`.open` and :meth:`.close`.
+    """
+
+    def __init__( self, dsn, pool_size = 10, pool_name = 'default',
+                  min_size = None, max_size = None, conn_lifetime = 600,
+                  query_timeout = None ):
+        """
+        :param string dsn: DSN for the default pool
+        :param int pool_size: Poolsize of the first/default pool
+        :param string pool_name: Keyname for the first/default pool
+        :param int min_size: Minimum number of connections of the first/default pool
+        :param int max_size: Maximum number of connections of the first/default pool
+        :param int conn_lifetime: Seconds after which connections of the first/default pool are recycled
+        :param float query_timeout: Seconds after which interactions on the first/default pool are cancelled. See :meth:`.add_pool`
+        """
+        self.dsn = dsn
+        self.default_pool_args = dict( pool_size = pool_size, pool_name = pool_name,
+                                       min_size = min_size, max_size = max_size,
+                                       conn_lifetime = conn_lifetime,
+                                       query_timeout = query_timeout,
+                                       default_write_pool = True, default_read_pool = True )
+        self.conn_pools = {}
+        self.listeners = {}
+        self.query_timeouts = {}
+        self.default_write_pool = None
+        self.default_read_pool = None
+
+    async def open( self ):
+        await self.add_pool( self.dsn, **self.default_pool_args )
+        return self
+
+    async def __aenter__( self ):
+        return await self.open()
+
+    async def __aexit__( self, *exc_info ):
+        self.close()
+
+    def close( self ):
+        for pool in self.conn_pools.values():
+            pool.close()
+
+    async def add_pool( self, dsn = None, pool_name = None, pool_size = 10,
+                        default_write_pool = False, default_read_pool = False,
+                        min_size = None, max_size = None, conn_lifetime = 600,
+                        query_timeout = None ):
+        """
+        Add and open a named :class:`AsyncConnectionPool`
+
+        :param string dsn: dsn
+        :param string pool_name: a name for the pool to identify it inside the AsyncInteractionPool
+        :param int pool_size: Number of connections. Used for `min_size` and `max_size` if they are not set.
+        :param bool default_write_pool: Should the added pool used as the default pool for write operations?
+        :param bool default_read_pool: Should the added pool used as the default pool for read operations?
+        :param int min_size: Number of connections to open right away and keep open
+        :param int max_size: Maximum number of connections
+        :param int conn_lifetime: Seconds after which connections are recycled
+        :param float query_timeout: Seconds after which interactions on the pool are cancelled and fail with a :class:`DBInteractionTimeoutException`. None for no timeout.
+        """
+        if pool_name in self.conn_pools:
+            raise DBInteractionException( "Already have a pool with the name: %s. ConnectionPool not added!" % ( pool_name, ) )
+        pool = AsyncConnectionPool( dsn, pool_size = pool_size, min_size = min_size,
+                                    max_size = max_size, conn_lifetime = conn_lifetime )
+        await pool.open()
+        self.conn_pools[ pool_name ] = pool
+        self.query_timeouts[ pool_name ] = query_timeout
+        if default_write_pool:
+            self.default_write_pool = pool_name
+        if default_read_pool:
+            self.default_read_pool = pool_name
+
+    async def run( self, interaction = None, interaction_args = None,
+                   get_result = True, is_write = True, pool = None, conn = None,
+                   partial_txn = False, query_timeout = None, *args, **kwargs ):
+        """
+        Run an interaction on one of the pools.
+
+        :param string|coroutine function interaction: The interaction to run. Either a SQL string or a coroutine function that takes at least a parameter `conn` (an :class:`AsyncPoolConnection` in a transaction: ``await conn.fetch( sql, args )``, ``await conn.commit()``)
+        :param interaction_args: args for the placeholders of a SQL interaction
+        :param bool get_result: return the rows of a SQL interaction - otherwise just True
+        :param bool is_write: If the interaction has no side-effects set to `False`. Without naming a pool the default read pool is used and a SQL interaction runs without a transaction.
+        :param string pool: Keyname of the pool to get the connection from
+        :param AsyncPoolConnection conn: Pass in a connection instead of getting one from the pool (ie. the one of a `partial_txn`)
+        :param bool partial_txn: Return a dict with the result and the connection, in the open transaction, instead of committing (ie. for locks in transactions that span several interactions)
+        :param float query_timeout: Seconds after which the interaction is cancelled (and its query on the server). Defaults to the pool's `query_timeout`.
+        :param list args: positional args for a function interaction
+        :param dict kwargs: kwargs for a function interaction
+        :returns: the result of the interaction
+        :raises: :class:`DBInteractionException`
+        """
+        use_pool = pool or ( self.default_write_pool if is_write else self.default_read_pool )
+        if query_timeout is None:
+            query_timeout = self.query_timeouts.get( use_pool )
+        if isinstance( interaction, str ):
+            transaction = is_write or partial_txn or conn is not None
+            f = self._sql_interaction( interaction, interaction_args, get_result, transaction )
+            commit = is_write
+        elif asyncio.iscoroutinefunction( interaction ):
+            f = lambda conn: interaction( *args, conn = conn, **kwargs )
+            commit = False
+        else:
+            raise DBInteractionException( "%s cannot be run. run() only accepts coroutine functions and strings" % ( interaction, ) )
+        interact = self._interact( use_pool, conn, partial_txn, f, commit )
+        try:
+            if query_timeout:
+                return await asyncio.wait_for( interact, query_timeout )
+            return await interact
+        except asyncio.TimeoutError:
+            raise DBInteractionTimeoutException( "Interaction cancelled after %s seconds." % ( query_timeout, ) )
+        except DBInteractionException:
+            raise
+        except Exception as e:
+            raise DBInteractionException( e ) from e
+
+    def _sql_interaction( self, sql, interaction_args, get_result, transaction ):
+        async def f( conn ):
+            cursor = await conn.execute( sql, interaction_args, begin = transaction )
+            try:
+                if get_result and cursor.description is not None:
+                    return cursor.fetchall()
+                return True
+            finally:
+                cursor.close()
+        return f
+
+    async def _interact( self, use_pool, conn, partial_txn, f, commit ):
+        pool = self.conn_pools[ use_pool ]
+        # a connection passed in with partial_txn stays with the caller
+        owned = conn is None or not partial_txn
+        if conn is None:
+            conn = await pool.get()
+        try:
+            res = await f( conn )
+            if commit and not partial_txn:
+                await conn.commit()
+        except BaseException:
+            if owned:
+                # rolled back (or closed if the query could not be finished) by the pool
+                pool.put( conn )
+            raise
+        if partial_txn:
+            return { 'result': res, 'connection': conn }
+        pool.put( conn )
+        return res
+
+    async def listen_on( self, channel_name, pool = None, result_queue = None,
+                         unmarshaller = 'pipe_colon' ):
+        """
+        Listen for asynchronous events on a named Channel
+
+        :param string channel_name: Name of the channel to LISTEN on
+        :param string pool: Name of the pool to get the connection from. All channels of a pool share one listener connection.
+        :param asyncio.Queue result_queue: Queue to put the payloads onto. A new one if None.
+        :param string|function unmarshaller: How to unmarshall the payloads: 'pipe_colon' (default), 'json', 'msgpack', 'raw' or a function taking the payload string
+
+        :rtype: AsyncChannelSubscription
+        :returns: -- the subscription. ``async for payload in subscription`` and ``await subscription.close()``
+        """
+        use_pool = self.default_write_pool if pool is None else pool
+        listener = self.listeners.get( use_pool )
+        if listener is None:
+            listener = self.listeners[ use_pool ] = AsyncChannelListener( self.conn_pools[ use_pool ] )
+        if result_queue is None:
+            result_queue = asyncio.Queue()
+        try:
+            await listener.subscribe( result_queue, channel_name, unmarshaller )
+        except Exception as e:
+            raise DBInteractionException( e ) from e
+        return AsyncChannelSubscription( listener, result_queue, channel_name )
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# Batching of many executions of one statement into few round trips
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import re
+
+from itertools import islice
+
+
+# INSERT ... VALUES (<one row template>) [ON CONFLICT ... | RETURNING ...]
+VALUES_RE = re.compile( r"^(\s*INSERT\s+INTO\s+.+?\s+VALUES\s*)(\((?:[^()']|'(?:[^']|'')*'|\((?:[^()']|'(?:[^']|'')*')*\))*\))(.*?)\s*;?\s*$",
+                        re.IGNORECASE | re.DOTALL )
+
+
+def split_values_sql( sql ):
+    """
+    Split a single row ``INSERT ... VALUES (...)`` statement into the part
+    before the row template, the row template and the rest of the statement.
+
+    :param string sql: the statement
+    :rtype: tuple
+    :returns: (prefix, row template, suffix) or None if the statement cannot be turned into a multi-row INSERT
+    """
+
+    m = VALUES_RE.match( sql )
+    if m is None:
+        return None
+    prefix, template, suffix = m.groups()
+    # placeholders (or escaped %) outside the row template cannot be repeated per row
+    if '%' in prefix or '%' in suffix or suffix.lstrip()[ :1 ] == ',':
+        return None
+    return prefix, template, suffix
+
+
+def pages( seq, page_size ):
+    """
+    Yield lists of up to `page_size` items of `seq` (any iterable - it is
+    consumed lazily)
+    """
+
+    it = iter( seq )
+    while 1:
+        page = list( islice( it, page_size ) )
+        if not page:
+            return
+        yield page
+
+
+def page_statements( cursor, sql, seq_of_args, page_size = 100 ):
+    """
+    Yield one statement (string) per page of `page_size` args that executes
+    `sql` for all the args of the page in a single round trip.
+
+    Single row INSERTs become one multi-row ``INSERT ... VALUES (...), (...)``
+    per page. All other statements are bound with `cursor.mogrify` and
+    joined with ``;``.
+
+    :param cursor: cursor used to bind the args (must support `mogrify`)
+    :param string sql: statement with placeholders
+    :param seq_of_args: iterable of args for `sql`
+    :param int page_size: number of args per statement
+    :rtype: generator
+    :returns: tuples of ( statement, nr. of args in the page )
+    """
+
+    parts = split_values_sql( sql )
+    if parts is not None:
+        prefix, template, suffix = parts
+        for page in pages( seq_of_args, page_size ):
+            yield ( "%s%s%s;" % ( prefix, ','.join( [ cursor.mogrify( template, args ) for args in page ] ), suffix ),
+                    len( page ) )
+    else:
+        sql = sql.rstrip().rstrip( ';' )
+        for page in pages( seq_of_args, page_size ):
+            yield ( ''.join( [ "%s;" % ( cursor.mogrify( sql, args ), ) for args in page ] ), len( page ) )
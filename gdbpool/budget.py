@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# ConnectionBudget - a connection limit shared by the pools of several
+# processes on a host
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import os, errno, fcntl
+import gevent
+
+from gevent import socket
+from gevent.event import AsyncResult
+from gevent.server import StreamServer
+try:
+    from gevent.lock import RLock
+except ImportError:
+    from gevent.coros import RLock
+from collections import deque
+from time import time
+
+from gdbpool_error import DBPoolBudgetException
+
+
+def _shutdown( sock ):
+    # close() alone leaves the connection open while a file object made
+    # with makefile() (ie. of the reading greenlet) still refers to it
+    try:
+        sock.shutdown( socket.SHUT_RDWR )
+    except socket.error:
+        pass
+    sock.close()
+
+
+class BudgetServer( object ):
+    """
+    Hands out units of a connection budget to the :class:`ConnectionBudget`
+    clients connected on a Unix socket.
+
+    The line based protocol: a client sends ``ACQUIRE`` for each connection
+    it wants to open and gets a ``GRANT`` once there is room in the budget -
+    clients are granted in order of their requests. ``RELEASE`` gives a unit
+    back and ``HOLD <n>`` reports the units a client already holds when it
+    reconnects. When a client disconnects (ie. its process died) all its
+    units go back into the budget.
+
+    A server that takes over from one that died does not know the units the
+    clients still hold, so it waits `grace` seconds for their ``HOLD``
+    reports before it grants anything.
+    """
+
+    def __init__( self, path, limit, grace = 0 ):
+        """
+        :param string path: path of the Unix socket to listen on
+        :param int limit: total number of connections of all clients
+        :param float grace: seconds to only collect ``HOLD`` reports after the start
+        """
+        self.path = path
+        self.limit = limit
+        self.grace = grace
+        self.granting_at = 0
+        self.used = 0
+        self.clients = set()
+        # clients waiting for a GRANT, one entry per ACQUIRE
+        self.waiters = deque()
+        self.server = None
+
+    def start( self ):
+        listener = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        listener.bind( self.path )
+        listener.listen( 128 )
+        self.server = StreamServer( listener, self.handle )
+        self.server.start()
+        if self.grace:
+            self.granting_at = time() + self.grace
+            gevent.spawn_later( self.grace, self._grant )
+
+    def stop( self ):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            for client in list( self.clients ):
+                client.closed = True
+                _shutdown( client.sock )
+            try:
+                os.unlink( self.path )
+            except OSError:
+                pass
+
+    def handle( self, sock, address ):
+        client = _BudgetClientState( sock )
+        self.clients.add( client )
+        try:
+            for line in sock.makefile( 'r' ):
+                command = line.split()
+                if not command:
+                    continue
+                if command[ 0 ] == 'ACQUIRE':
+                    self.waiters.append( client )
+                elif command[ 0 ] == 'RELEASE':
+                    if client.held > 0:
+                        client.held -= 1
+                        self.used -= 1
+                elif command[ 0 ] == 'HOLD':
+                    held = int( command[ 1 ] )
+                    self.used += held - client.held
+                    client.held = held
+                self._grant()
+        except ( socket.error, ValueError, IndexError ):
+            pass
+        finally:
+            client.closed = True
+            self.clients.discard( client )
+            self.used -= client.held
+            client.held = 0
+            _shutdown( sock )
+            self._grant()
+
+    def _grant( self ):
+        if time() < self.granting_at:
+            return
+        while self.waiters and self.used < self.limit:
+            client = self.waiters.popleft()
+            if client.closed:
+                continue
+            try:
+                client.sock.sendall( "GRANT\n" )
+            except socket.error:
+                continue
+            client.held += 1
+            self.used += 1
+
+
+class _BudgetClientState( object ):
+
+    def __init__( self, sock ):
+        self.sock = sock
+        self.held = 0
+        self.closed = False
+
+
+class ConnectionBudget( object ):
+    """
+    Client of a :class:`BudgetServer`: one per process, shared by all pools
+    of the process that connect to the same database server.
+
+    A pool with a budget acquires a unit before it opens a connection and
+    releases it when it closes the connection, so the total number of
+    connections of all processes stays within the budget's limit while each
+    process's pool grows and shrinks with its own demand (use a small
+    `min_size` and an `idle_timeout`).
+
+    If `limit` is given and no server is running on `path` the first
+    process to get there hosts the server (in its gevent hub). If that
+    process dies another one takes over. The clients that hold units
+    reconnect right away and report them to it, and the new server waits
+    `takeover_grace` seconds for those reports before it grants any units.
+    """
+
+    def __init__( self, path, limit = None, connect_timeout = 5,
+                  takeover_grace = 1.0 ):
+        """
+        :param string path: path of the budget server's Unix socket
+        :param int limit: total number of connections when this process has to host the server. None to only connect to a server started elsewhere (see :class:`BudgetServer`)
+        :param float connect_timeout: seconds to wait for a server to come up
+        :param float takeover_grace: seconds a server this process starts in place of one that died waits for the other processes to report their units
+        """
+        self.path = path
+        self.limit = limit
+        self.connect_timeout = connect_timeout
+        self.takeover_grace = takeover_grace
+        self.held = 0
+        self.sock = None
+        self.reader = None
+        self.reconnector = None
+        self.connect_lock = RLock()
+        # if this process was connected to a server before
+        self.connected = False
+        self.server = None
+        self.lock_fd = None
+        # AsyncResults of the ACQUIREs sent, in order
+        self.pending = deque()
+
+    def acquire( self, timeout = None ):
+        """
+        Get a unit of the budget - wait until one is available
+
+        :param float timeout: seconds to wait or None to wait until there is one
+        :raises: :class:`DBPoolBudgetException` if no unit became available in time or the server cannot be reached
+        """
+        self._connect()
+        result = AsyncResult()
+        self.pending.append( result )
+        try:
+            self.sock.sendall( "ACQUIRE\n" )
+        except socket.error, e:
+            self._disconnect( e )
+        try:
+            result.get( timeout = timeout )
+        except gevent.Timeout:
+            # a GRANT that still comes in for it is given back right away
+            result.set_exception( DBPoolBudgetException( "Timed out waiting for the connection budget." ) )
+            raise DBPoolBudgetException( "No connection budget available within %s seconds." % ( timeout, ) )
+
+    def release( self ):
+        """
+        Give a unit back to the budget
+        """
+        if self.held <= 0:
+            return
+        self.held -= 1
+        if self.sock is not None:
+            try:
+                self.sock.sendall( "RELEASE\n" )
+            except socket.error, e:
+                self._disconnect( e )
+
+    def close( self ):
+        if self.reconnector is not None:
+            self.reconnector.kill()
+            self.reconnector = None
+        self._disconnect( DBPoolBudgetException( "The connection budget was closed." ) )
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+        if self.lock_fd is not None:
+            os.close( self.lock_fd )
+            self.lock_fd = None
+
+    def _connect( self ):
+        if self.sock is not None:
+            return
+        with self.connect_lock:
+            # another greenlet may have connected in the meantime
+            if self.sock is None:
+                self._open()
+
+    def _open( self ):
+        waited = 0
+        while 1:
+            sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            try:
+                sock.connect( self.path )
+                break
+            except socket.error, e:
+                sock.close()
+                if e.args[ 0 ] not in ( errno.ENOENT, errno.ECONNREFUSED ):
+                    raise DBPoolBudgetException( "Could not connect to the budget server at %s: %s" % ( self.path, e ) )
+            if self.limit is not None and self._host():
+                continue
+            if waited >= self.connect_timeout:
+                raise DBPoolBudgetException( "No budget server at %s." % ( self.path, ) )
+            gevent.sleep( 0.1 )
+            waited += 0.1
+        self.sock = sock
+        self.connected = True
+        if self.held:
+            sock.sendall( "HOLD %i\n" % ( self.held, ) )
+        self.reader = gevent.spawn( self._read, sock )
+
+    def _reconnect( self ):
+        # report the units this process holds before the next server hands
+        # them out to other processes
+        try:
+            self._connect()
+        except ( DBPoolBudgetException, socket.error ), e:
+            # the next acquire() tries again
+            pass
+        self.reconnector = None
+
+    def _host( self ):
+        # the process holding the lock file runs the server. the OS drops
+        # the lock when the process dies so another one can take over.
+        if self.lock_fd is None:
+            fd = os.open( self.path + '.lock', os.O_RDWR | os.O_CREAT, 0600 )
+            try:
+                fcntl.flock( fd, fcntl.LOCK_EX | fcntl.LOCK_NB )
+            except IOError:
+                os.close( fd )
+                return False
+            self.lock_fd = fd
+        if self.server is None:
+            # a socket nobody listens on is left behind by a server that
+            # died - its clients may still hold units
+            takeover = self.connected or os.path.exists( self.path )
+            try:
+                os.unlink( self.path )
+            except OSError:
+                pass
+            server = BudgetServer( self.path, self.limit,
+                                   grace = self.takeover_grace if takeover else 0 )
+            server.start()
+            self.server = server
+        return True
+
+    def _read( self, sock ):
+        try:
+            for line in sock.makefile( 'r' ):
+                if line.strip() != 'GRANT':
+                    continue
+                self.held += 1
+                result = self.pending.popleft() if self.pending else None
+                if result is None or result.ready():
+                    self.release()
+                else:
+                    result.set( True )
+            e = DBPoolBudgetException( "The budget server closed the connection." )
+        except socket.error, e:
+            pass
+        if self.sock is sock:
+            self._disconnect( e )
+            if self.held > 0 and self.reconnector is None:
+                self.reconnector = gevent.spawn( self._reconnect )
+
+    def _disconnect( self, e ):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            _shutdown( sock )
+        if self.reader is not None and self.reader is not gevent.getcurrent():
+            self.reader.kill( block = False )
+        self.reader = None
+        pending, self.pending = self.pending, deque()
+        for result in pending:
+            if not result.ready():
+                result.set_exception( e if isinstance( e, DBPoolBudgetException ) else DBPoolBudgetException( "Lost the connection to the budget server: %s" % ( e, ) ) )
+
+
+if __name__ == '__main__':
+    import sys
+    if len( sys.argv ) != 3:
+        print "usage: python budget.py <socket path> <limit>"
+        sys.exit( 1 )
+    server = BudgetServer( sys.argv[ 1 ], int( sys.argv[ 2 ] ) )
+    server.start()
+    try:
+        gevent.wait()
+    finally:
+        server.stop()
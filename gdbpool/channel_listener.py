@@ -4,7 +4,7 @@
 #
 # gDBPool - db connection pooling for gevent
 #
-# PGChannelListener - subscribes to a (NOTIFY) channel on postgres
+# PGChannelListener - subscribes to (NOTIFY) channels on postgres
 # via LISTEN and streams the events to the subscribes result_queues
 
 __author__ = "Florian von Bock"
@@ -13,129 +13,255 @@ __version__ = "0.1.3"
 
 
 import gevent
-from gevent import monkey; monkey.patch_all()
-from psyco_ge import make_psycopg_green; make_psycopg_green()
-
 import psycopg2
 
+from gevent.event import Event
 from gevent.select import select
+try:
+    from gevent.lock import RLock
+except ImportError:
+    from gevent.coros import RLock
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
-
-class PGChannelListenerException( Exception ):
-    pass
+from channel_payload import PGChannelListenerException, quote_channel_name, pipe_colon_unmarshall, json_unmarshall, msgpack_unmarshall, raw_unmarshall, UNMARSHALLERS, get_unmarshaller
 
 
-def pipe_colon_unmarshall( payload_string ):
+class ChannelSubscription( object ):
     """
-    Convert a pipe seperated string of <key:value> pairs to a dict
+    Handle for a Queue subscribed to a channel of a :class:`PGChannelListener`.
 
-    :param string payload_string:
-    :rtype: dict
-    :returns: unmarshalled NOTIFY data
+    Closing the handle - or setting the `cancel_event` it was created with -
+    unsubscribes the Queue immediately. There is nothing polling for it in
+    the meantime.
     """
 
-    payload_data = {}
-    try:
-        for kv_pair in payload_string.split( '|' ):
-            k, v = kv_pair.split( ':', 1 )
-            payload_data[ k ] = v
-    except Exception, e:
-        raise PGChannelListenerException( "Unmarshalling of the LISTEN payload failed: %s" % ( e.message, ) )
-    return payload_data
+    def __init__( self, listener, queue, channel_name, cancel_event = None ):
+        """
+        :param PGChannelListener listener: The listener the queue is subscribed on
+        :param gevent.Queue queue: The subscribed Queue
+        :param string channel_name: The channel the queue is subscribed to
+        :param gevent.Event cancel_event: A :class:`gevent.Event` which closes the subscription when set
+        """
+        self.listener = listener
+        self.queue = queue
+        self.channel_name = channel_name
+        self.cancel_event = cancel_event
+        self.closed = False
+        if cancel_event is not None:
+            cancel_event.rawlink( self._on_cancel )
+
+    def _on_cancel( self, event ):
+        self.close()
+
+    def close( self ):
+        """
+        Unsubscribe the queue from the channel. Safe to call more than once.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.cancel_event is not None:
+            self.cancel_event.unlink( self._on_cancel )
+        self.listener.unregister_queue( id( self.queue ), self.channel_name )
 
 
 class PGChannelListener( object ):
     """
     A Listener for Postgres LISTEN/NOTIFY channels using gevent.
 
-    For each channel there will be one :class:`PGChannelListener` instance that fans
-    notifications out to the subscribed :class:`Queue`
+    There is one :class:`PGChannelListener` instance per connection pool. It
+    holds a single connection on which it LISTENs on every channel that has
+    subscribers and fans the notifications out to the subscribed
+    :class:`Queue` by `notify.channel`. Channels are added and removed with
+    ``LISTEN``/``UNLISTEN`` on that same connection.
     """
 
     def __new__(  cls, q, pool, channel_name, *args, **kwargs ):
         if not hasattr( cls, '_instances' ):
             cls._instances = {}
-        spawn = False
-        if not cls._instances.has_key( channel_name ):
-            cls._instances[ channel_name ] = object.__new__( cls )
-            cls._instances[ channel_name ].subscribers = {}
-            cls._instances[ channel_name ].pool = pool
-            cls._instances[ channel_name ].conn = pool.get( iso_level = ISOLATION_LEVEL_AUTOCOMMIT )
-            cls._instances[ channel_name ].cur = None
-            cls._instances[ channel_name ].channel_name = channel_name
-            spawn = True
-
-        # hai hai... using id for this kind of stuff is sort of dangerous.
-        # will come up with something less pointing gun at foot(TM). later. (TM).
-        cls._instances[ channel_name ].subscribers[ id( q ) ] = q
-        if spawn:
-            gevent.spawn( cls._instances[ channel_name ].listen ).join()
-        return cls._instances[ channel_name ]
-
-    def __init__( self, q, pool, channel_name ):
+        while 1:
+            if not cls._instances.has_key( pool ):
+                cls._start( pool )
+            listener = cls._instances[ pool ]
+            # the listener might have been stopped while we waited for it
+            if listener.register_queue( q, channel_name, *args, **kwargs ):
+                return listener
+
+    @classmethod
+    def _start( cls, pool ):
+        listener = object.__new__( cls )
+        listener.pool = pool
+        listener.conn = None
+        listener.cur = None
+        listener.subscribers = {}
+        listener.stop_event = Event()
+        # serializes LISTEN/UNLISTEN and poll() on the shared connection
+        listener.lock = RLock()
+        with listener.lock:
+            cls._instances[ pool ] = listener
+            try:
+                listener.conn = pool.get( iso_level = ISOLATION_LEVEL_AUTOCOMMIT )
+                listener.cur = listener.conn.cursor()
+            except Exception, e:
+                del cls._instances[ pool ]
+                listener.stop_event.set()
+                if listener.conn is not None:
+                    pool.put( listener.conn )
+                raise PGChannelListenerException( "Could not get a connection to LISTEN on: %s" % ( e, ) )
+            listener.greenlet = gevent.spawn( listener.listen )
+
+    def __init__( self, q, pool, channel_name, unmarshaller = pipe_colon_unmarshall,
+                  batch = False ):
         """
-        Create a Listener for a channel_name and pass the notifications to q result `Queue`.
+        Subscribe the q result `Queue` to the notifications on channel_name.
 
         :param gevent.Queue q: Queue to pass asynchronous payloads to
-        :param gDBPool.DBConnectionPool pool: Connection pool to get a connection from and execute ``LISTEN <channel_name>;`` on if no other instance listens on that channel already. In the latter case the q is just being subscribed to the channel.
+        :param gDBPool.DBConnectionPool pool: Connection pool to get the listener connection from if there is no listener for the pool yet. Otherwise the listener connection of the pool is reused and ``LISTEN <channel_name>;`` is executed on it if no other Queue is subscribed to that channel already.
         :param string channel_name: channel to listen on. (``LISTEN <channel_name>;``)
+        :param string|function unmarshaller: Function (or name of one of the :data:`UNMARSHALLERS`) to pass the `notify.payload` string into for unmarshalling into python object (ie. dict) data
+        :param bool batch: Put one list with all payloads received in a poll onto q instead of one payload at a time
 
         :rtype: PGChannelListener
-        :returns: The PGChannelListener instance handling the channel
+        :returns: The PGChannelListener instance handling the pool
         """
 
         pass
 
-    def __del__( self ):
-        print "** __del__", self.channel_name
-        del PGChannelListener._instances[ self.channel_name ]
+    @property
+    def channels( self ):
+        return self.subscribers.keys()
+
+    def register_queue( self, q, channel_name, unmarshaller = pipe_colon_unmarshall,
+                        batch = False ):
+        """
+        Subscribe a Queue to a channel. LISTENs on the channel if it is the
+        first subscriber.
+
+        :param gevent.Queue q: Queue to pass asynchronous payloads to
+        :param string channel_name: channel to listen on
+        :param string|function unmarshaller: Function (or name of one of the :data:`UNMARSHALLERS`) to unmarshall the payloads for this Queue with
+        :param bool batch: Put one list with all payloads received in a poll onto q instead of one payload at a time
+        :rtype: bool
+        :returns: False if the listener was stopped and the Queue could not be subscribed
+        """
+
+        unmarshaller = get_unmarshaller( unmarshaller )
+        with self.lock:
+            if self.stop_event.is_set():
+                return False
+            if not self.subscribers.has_key( channel_name ):
+                self.cur.execute( "LISTEN %s;" % ( quote_channel_name( channel_name ), ) )
+                self.subscribers[ channel_name ] = {}
+            # hai hai... using id for this kind of stuff is sort of dangerous.
+            # will come up with something less pointing gun at foot(TM). later. (TM).
+            self.subscribers[ channel_name ][ id( q ) ] = ( q, unmarshaller, batch )
+            notifies = self._drain_notifies()
+        self._dispatch( notifies )
+        return True
 
-    def unregister_queue( self, q_id ):
+    def unregister_queue( self, q_id, channel_name ):
         """
-        Unregister a Queue from its channel.
+        Unregister a Queue from a channel.
 
-        If it was the last subscriber stop listening on the channel and put the connection used back onto the pool.
+        The Queue does not receive any more notifications once this returns.
+        It does not block so it is safe to call it from event callbacks.
+        If it was the last subscriber on the channel the listener stops
+        listening on it. If it was the last subscriber of the listener the
+        listener stops and puts the connection used back onto the pool.
 
         :param q_id: The id() of the Queue to be unsubscribed from the channel
+        :param string channel_name: channel the Queue is subscribed to
         """
 
-        if self.stop_event.is_set():
+        subscribers = self.subscribers.get( channel_name, {} )
+        if not subscribers.has_key( q_id ):
             return
-        del self.subscribers[ q_id ]
-        if len( self.subscribers ) == 0:
+        del subscribers[ q_id ]
+        if len( subscribers ) == 0:
+            del self.subscribers[ channel_name ]
+            gevent.spawn( self._unlisten, channel_name )
+
+    def _unlisten( self, channel_name ):
+        with self.lock:
+            if self.stop_event.is_set() or self.subscribers.has_key( channel_name ):
+                return
+            if len( self.subscribers ) == 0:
+                self.stop()
+                return
+            self.cur.execute( "UNLISTEN %s;" % ( quote_channel_name( channel_name ), ) )
+            notifies = self._drain_notifies()
+        self._dispatch( notifies )
+
+    def stop( self ):
+        """
+        Stop the listener, drop all subscribers and put the connection back
+        onto the pool.
+        """
+
+        with self.lock:
+            if self.stop_event.is_set():
+                return
             self.stop_event.set()
-            self.cur.close()
+            if PGChannelListener._instances.get( self.pool ) is self:
+                del PGChannelListener._instances[ self.pool ]
+            self.subscribers = {}
+            if gevent.getcurrent() is not self.greenlet:
+                self.greenlet.kill()
+            try:
+                self.cur.execute( "UNLISTEN *;" )
+                self.cur.close()
+            except Exception:
+                pass
             self.pool.put( self.conn )
 
-    def listen( self, unmarshaller = pipe_colon_unmarshall ):
+    def _drain_notifies( self ):
+        notifies = self.conn.notifies[ : ]
+        del self.conn.notifies[ : ]
+        return notifies
+
+    def _dispatch( self, notifies ):
+        # keep the payloads in the order they were sent per channel
+        payloads = {}
+        for notify in notifies:
+            if self.subscribers.has_key( notify.channel ):
+                payloads.setdefault( notify.channel, [] ).append( notify.payload )
+        for channel_name, channel_payloads in payloads.iteritems():
+            # unmarshall once per unmarshaller, not once per subscriber
+            unmarshalled = {}
+            for q, unmarshaller, batch in self.subscribers.get( channel_name, {} ).values():
+                if not unmarshalled.has_key( unmarshaller ):
+                    unmarshalled[ unmarshaller ] = self._unmarshall( unmarshaller, channel_payloads )
+                if batch:
+                    q.put( list( unmarshalled[ unmarshaller ] ) )
+                else:
+                    for payload_data in unmarshalled[ unmarshaller ]:
+                        q.put( payload_data )
+
+    def _unmarshall( self, unmarshaller, payloads ):
+        # a payload that cannot be unmarshalled is passed on as the
+        # PGChannelListenerException instead of killing the listener
+        unmarshalled = []
+        for payload in payloads:
+            try:
+                unmarshalled.append( unmarshaller( payload ) )
+            except PGChannelListenerException, e:
+                unmarshalled.append( e )
+        return unmarshalled
+
+    def listen( self ):
         """
-        Subscribe to the channel and send notification payloads to the
-        results Queue.
+        Wait for notifications on the listener connection and send the
+        payloads to the Queues subscribed to the notification's channel.
 
-        :param function unmarshaller: Function to pass the `notify.payload` string into for unmarshalling into python object (ie. dict) data
+        All notifications pending after a poll are delivered in the order
+        they were received.
         """
 
-        self.stop_event = stop_event = gevent.event.Event()
-        self.cur = self.conn.cursor()
-        self.cur.execute( "LISTEN %s;" % ( self.channel_name, ) )
         while 1:
-            if self.stop_event.is_set():
-                return
-            # TODO: test select with timeout and try/except
-            # maybe try to listen on all channels with just one connection with short timeouts on the select
-            # and then cycle through...
-            if select( [ self.conn ], [], [] ) == ( [], [], [] ):
-                print "LISTEN timeout."
-            else:
+            select( [ self.conn ], [], [] )
+            with self.lock:
                 if self.stop_event.is_set():
                     return
                 self.conn.poll()
-                while self.conn.notifies:
-                    if self.stop_event.is_set():
-                        return
-                    notify = self.conn.notifies.pop()
-                    payload_data = unmarshaller( notify.payload )
-                    for q_id in self.subscribers.iterkeys():
-                        self.subscribers[ q_id ].put( payload_data )
-
+                notifies = self._drain_notifies()
+            self._dispatch( notifies )
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# Channel name quoting and NOTIFY payload unmarshallers shared by the
+# gevent PGChannelListener and the asyncio AsyncChannelListener. Keep this
+# module free of gevent (and valid Python 2 and 3).
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import base64
+try:
+    import ujson as json
+except ImportError:
+    import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class PGChannelListenerException( Exception ):
+    pass
+
+
+def quote_channel_name( channel_name ):
+    """
+    Quote a channel name as identifier so LISTEN/UNLISTEN use the name as
+    given (without folding it to lower case) and it matches `notify.channel`.
+    """
+
+    return '"%s"' % ( channel_name.replace( '"', '""' ), )
+
+
+def pipe_colon_unmarshall( payload_string ):
+    """
+    Convert a pipe seperated string of <key:value> pairs to a dict
+
+    :param string payload_string:
+    :rtype: dict
+    :returns: unmarshalled NOTIFY data
+    """
+
+    payload_data = {}
+    try:
+        for kv_pair in payload_string.split( '|' ):
+            k, v = kv_pair.split( ':', 1 )
+            payload_data[ k ] = v
+    except Exception as e:
+        raise PGChannelListenerException( "Unmarshalling of the LISTEN payload failed: %s" % ( e, ) )
+    return payload_data
+
+
+def json_unmarshall( payload_string ):
+    """
+    Decode a JSON payload
+
+    :param string payload_string:
+    :returns: unmarshalled NOTIFY data
+    """
+
+    try:
+        return json.loads( payload_string )
+    except ValueError as e:
+        raise PGChannelListenerException( "Unmarshalling of the LISTEN payload failed: %s" % ( e, ) )
+
+
+def msgpack_unmarshall( payload_string ):
+    """
+    Decode a base64 encoded msgpack payload. (NOTIFY payloads must be text -
+    ie. ``encode( <msgpack bytea>, 'base64' )`` in the trigger.)
+
+    Requires the msgpack module.
+
+    :param string payload_string:
+    :returns: unmarshalled NOTIFY data
+    """
+
+    if msgpack is None:
+        raise PGChannelListenerException( "Unmarshalling of the LISTEN payload failed: msgpack is not installed." )
+    try:
+        return msgpack.unpackb( base64.b64decode( payload_string ) )
+    except Exception as e:
+        raise PGChannelListenerException( "Unmarshalling of the LISTEN payload failed: %s" % ( e, ) )
+
+
+def raw_unmarshall( payload_string ):
+    """
+    Pass the payload string through as it is
+
+    :param string payload_string:
+    :rtype: string
+    :returns: the NOTIFY payload
+    """
+
+    return payload_string
+
+
+UNMARSHALLERS = {
+    'pipe_colon': pipe_colon_unmarshall,
+    'json': json_unmarshall,
+    'msgpack': msgpack_unmarshall,
+    'raw': raw_unmarshall,
+}
+
+
+def get_unmarshaller( unmarshaller ):
+    """
+    Look up an unmarshaller by name. Callables are passed through.
+
+    :param string|function unmarshaller: one of 'pipe_colon', 'json', 'msgpack', 'raw' or a function taking the payload string
+    :rtype: function
+    """
+
+    if callable( unmarshaller ):
+        return unmarshaller
+    try:
+        return UNMARSHALLERS[ unmarshaller ]
+    except KeyError:
+        raise PGChannelListenerException( "Unknown unmarshaller: %s" % ( unmarshaller, ) )
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# CircuitBreaker - fails the requests for a pool fast while its database is
+# down
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+from time import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker( object ):
+    """
+    Circuit breaker of one pool of a `DBInteractionPool`.
+
+    The breaker is *closed* while the pool works. After `failure_threshold`
+    consecutive failures (connection errors and query timeouts) it *opens*:
+    requests for the pool fail right away instead of waiting for a
+    connection to a database that is down. After `reset_timeout` seconds it
+    is *half open* and lets up to `probes` requests through - it closes
+    again when one of them succeeds and opens for another `reset_timeout`
+    seconds when one fails. Probes that do not report back within
+    `reset_timeout` seconds make room for new ones.
+    """
+
+    def __init__( self, failure_threshold = 5, reset_timeout = 10, probes = 1 ):
+        """
+        :param int failure_threshold: Number of consecutive failures that open the breaker. None to never open it.
+        :param float reset_timeout: Seconds the breaker stays open before it lets probe requests through
+        :param int probes: Number of probe requests let through at a time while half open
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = 0
+        self.probed_at = None
+
+    def allow( self ):
+        """
+        May a request go through? While half open this counts the request as
+        a probe.
+
+        :rtype: bool
+        """
+        if self.state == CLOSED:
+            return True
+        now = time()
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.probing = 0
+        elif now - self.probed_at >= self.reset_timeout:
+            # the probes got lost (ie. streams that were never consumed)
+            self.probing = 0
+        if self.probing >= self.probes:
+            return False
+        self.probing += 1
+        self.probed_at = now
+        return True
+
+    def is_open( self ):
+        """
+        Would requests be failed right now? (Without counting a probe)
+
+        :rtype: bool
+        """
+        return self.state == OPEN and time() - self.opened_at < self.reset_timeout
+
+    def retry_after( self ):
+        """
+        :rtype: float
+        :returns: seconds until the breaker lets probe requests through
+        """
+        if self.state != OPEN:
+            return 0.0
+        return max( 0.0, self.opened_at + self.reset_timeout - time() )
+
+    def record_success( self ):
+        self.failures = 0
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.probing = 0
+
+    def record_failure( self ):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self._open()
+        elif self.state == CLOSED and self.failure_threshold is not None \
+                and self.failures >= self.failure_threshold:
+            self._open()
+
+    def _open( self ):
+        self.state = OPEN
+        self.opened_at = time()
+        self.probing = 0
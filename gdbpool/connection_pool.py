@@ -10,40 +10,135 @@ __version__ = "0.1.3"
 
 
 import gevent
-from gevent import monkey; monkey.patch_all()
-
-import psycopg2
 import sys, traceback
 
-from psyco_ge import make_psycopg_green; make_psycopg_green()
-assert 'gdbpool.psyco_ge' in sys.modules.keys()
-
-from gevent.queue import Queue, Empty as QueueEmptyException
+from gevent.event import AsyncResult
+from collections import deque
+from random import random
 from time import time
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
-psycopg2.extensions.register_type( psycopg2.extensions.UNICODE )
-psycopg2.extensions.register_type( psycopg2.extensions.UNICODEARRAY )
 from psycopg2 import InterfaceError
 
 from pool_connection import PoolConnection
-from gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, StreamEndException
+from metrics import MetricsRegistry
+from gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, StreamEndException, DBPoolDeadlineExceededException, DBPoolBudgetException
+
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+PRIORITIES = ( PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW )
+
+
+class WaiterQueue( object ):
+    """
+    The callers waiting for a connection: one FIFO per priority. Waiters of a
+    higher priority are served first.
+    """
+
+    def __init__( self ):
+        self.queues = dict( [ ( p, deque() ) for p in PRIORITIES ] )
+        self.length = 0
+
+    def __len__( self ):
+        return self.length
+
+    def append( self, entry, priority = PRIORITY_NORMAL ):
+        """
+        :param tuple entry: ( AsyncResult, deadline or None )
+        """
+        self.queues[ priority ].append( entry )
+        self.length += 1
+
+    def remove( self, entry, priority = PRIORITY_NORMAL ):
+        self.queues[ priority ].remove( entry )
+        self.length -= 1
+
+    def popleft( self, low_priority = True ):
+        """
+        :param bool low_priority: also serve PRIORITY_LOW waiters
+        :returns: ( entry, priority ) of the first waiter to serve or ( None, None )
+        """
+        for priority in PRIORITIES:
+            if priority == PRIORITY_LOW and not low_priority:
+                break
+            queue = self.queues[ priority ]
+            if queue:
+                self.length -= 1
+                return queue.popleft(), priority
+        return ( None, None ), None
+
+    def waiting( self, priority ):
+        """
+        :returns: True if callers with `priority` or higher are waiting
+        """
+        for p in PRIORITIES:
+            if p < priority:
+                return False
+            if self.queues[ p ]:
+                return True
+        return False
+
+    def drain( self ):
+        """
+        Remove and return all waiting entries
+        """
+        entries = []
+        for priority in PRIORITIES:
+            entries.extend( self.queues[ priority ] )
+            self.queues[ priority ].clear()
+        self.length = 0
+        return entries
 
 
 class DBConnectionPool( object ):
     """
     The Connection Pool
 
-    "Classic" pool of connections with connection lifecycle management
+    "Classic" pool of connections with connection lifecycle management.
+
+    The pool is elastic: it keeps at least `min_size` connections open, opens
+    new ones on demand while callers are waiting for a connection (up to
+    `max_size` connections in total - idle and checked out) and closes
+    connections again that have been idle for longer than `idle_timeout`.
+
+    Connection lifecycle work happens on a background maintenance greenlet
+    off the request path: it replaces idle connections before they reach
+    their (jittered) lifetime, pings idle connections to find broken ones,
+    reaps idle connections and tops the pool up to `min_size`.
+
+    The pool records its metrics (wait time in :meth:`.get`, checkout
+    duration, recycled connections, errors and its size) in `metrics`, a
+    :class:`MetricsRegistry`.
+
+    With a :class:`ConnectionBudget` the pool takes a unit of the budget for
+    each connection it opens and gives it back when it closes the connection.
+    The pools of several processes sharing a budget then together never have
+    more than the budget's limit of connections.
     """
 
     def __init__( self, dsn, db_module = 'psycopg2', pool_size = 10,
-                  conn_lifetime = 600, do_log = False ):
+                  conn_lifetime = 600, do_log = False, stmt_cache_size = 0,
+                  min_size = None, max_size = None, idle_timeout = None,
+                  lifetime_jitter = 0.1, health_check_interval = 30,
+                  maintenance_interval = 1, low_priority_share = None,
+                  budget = None, budget_timeout = 10 ):
         """
         :param string dsn: DSN for the default `class:DBConnectionPool`
         :param string db_module: name of the DB-API module to use
-        :param int pool_size: Poolsize of the first/default `class:DBConnectionPool`
-        :param int conn_lifetime: Number of seconds after which a connection will be recycled when :meth:`.put` back
+        :param int pool_size: Poolsize of the first/default `class:DBConnectionPool`. Used for `min_size` and `max_size` if they are not set.
+        :param int conn_lifetime: Number of seconds after which a connection will be recycled. None or 0 keep connections open forever.
         :param bool do_log: Log to the console or not
+        :param int stmt_cache_size: Number of prepared statements each connection caches. 0 disables the statement cache.
+        :param int min_size: Number of connections to open right away and keep open
+        :param int max_size: Maximum number of connections (idle and checked out)
+        :param int idle_timeout: Seconds after which idle connections above `min_size` are closed. None keeps them open.
+        :param float lifetime_jitter: Fraction of `conn_lifetime` by which each connection's lifetime is randomly shortened so the connections do not all expire at the same time
+        :param int health_check_interval: Seconds a connection can be idle before the maintenance greenlet checks it is still alive. None disables health checks.
+        :param float maintenance_interval: Seconds between two runs of the maintenance greenlet
+        :param float low_priority_share: Fraction of `max_size` connections PRIORITY_LOW callers can have checked out at the same time. None for no limit.
+        :param ConnectionBudget budget: connection budget shared with the pools of other processes (see :mod:`budget`) or None
+        :param float budget_timeout: Seconds to wait for a unit of the budget before opening a connection fails
         """
         if do_log:
             import logging
@@ -52,98 +147,381 @@ class DBConnectionPool( object ):
         self.do_log = do_log
         self.dsn = dsn
         self.db_module = db_module
-        self.pool_size = pool_size
+        self.min_size = pool_size if min_size is None else min_size
+        self.max_size = max( self.min_size, pool_size if max_size is None else max_size )
+        self.pool_size = self.max_size
+        self.idle_timeout = idle_timeout
         self.CONN_RECYCLE_AFTER = conn_lifetime if conn_lifetime is not None else 0
-        self.pool = Queue( self.pool_size )
+        self.lifetime_jitter = lifetime_jitter
+        self.health_check_interval = health_check_interval
+        self.maintenance_interval = maintenance_interval
+        self.stmt_cache_size = stmt_cache_size
+        self.stmt_cache_stats = { 'hits': 0, 'misses': 0, 'evictions': 0 }
+        # idle connections - the most recently returned one last so busy
+        # connections are reused and the others can go idle and be reaped
+        self.idle = []
+        # ( AsyncResult, deadline ) of the callers waiting in get()
+        self.waiters = WaiterQueue()
+        self.low_priority_share = low_priority_share
+        self.low_in_use = 0
+        self.budget = budget
+        self.budget_timeout = budget_timeout
+        # all connections of the pool: idle, checked out and being opened
+        self.size = 0
+        self.pending = 0
+        self.maintainer = None
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge( 'size', lambda: self.size )
+        self.metrics.gauge( 'idle', lambda: len( self.idle ) )
+        self.metrics.gauge( 'in_use', lambda: self.in_use )
+        self.metrics.gauge( 'waiters', lambda: len( self.waiters ) )
+        self.metrics.gauge( 'stmt_cache', lambda: dict( self.stmt_cache_stats ) )
         __import__( db_module )
-        self.connection_jobs = map( lambda x: gevent.spawn( self.create_connection ), xrange( self.pool_size ) )
-        try:
-            gevent.joinall( self.connection_jobs, timeout = 10 )
-            assert self.pool_size == self.pool.qsize()
-            if self.do_log:
-                self.logger.info( "$ poolsize: %i" % self.pool.qsize() )
-            self.ready = True
-        except AssertionError, e:
-            raise DBPoolConnectionException( "Could not get %s connections for the pool as requested. %s" % ( self.pool_size, e.message ) )
-        except Exception, e:
-            raise e
+        self.connection_jobs = map( lambda x: gevent.spawn( self.create_connection ), xrange( self.min_size ) )
+        gevent.joinall( self.connection_jobs, timeout = 10 )
+        if len( self.idle ) != self.min_size:
+            errors = [ str( job.exception ) for job in self.connection_jobs if job.exception is not None ]
+            self.__del__()
+            raise DBPoolConnectionException( "Could not get %s connections for the pool as requested. %s" % ( self.min_size, ' '.join( errors ) ) )
+        if self.do_log:
+            self.logger.info( "$ poolsize: %i" % len( self.idle ) )
+        if self.maintenance_interval:
+            self.maintainer = gevent.spawn( self._maintain )
+        self.ready = True
 
     def __del__( self ):
-        while not self.pool.empty():
-            conn = self.pool.get()
-            conn.close()
+        if self.maintainer is not None:
+            self.maintainer.kill()
+        while self.idle:
+            self._close( self.idle.pop() )
 
     def create_connection( self ):
         """
-        Try to open a new connection to the database and put it on the pool
+        Try to open a new connection to the database and hand it to a waiting
+        caller or put it on the pool
         """
+        self.size += 1
+        self.pending += 1
+        self._open_connection()
+
+    def _open_connection( self, on_demand = False ):
+        # the caller already accounted for the connection in size and pending
+        if self.budget is not None:
+            started = time()
+            try:
+                self.budget.acquire( timeout = self.budget_timeout )
+            except DBPoolBudgetException, e:
+                self.metrics.incr( 'budget_timeouts' )
+                self._open_failed( e )
+                raise e
+            self.metrics.observe( 'budget_wait', time() - started )
+            if on_demand and not self.waiters:
+                # the callers that needed it got connections in the meantime
+                self.budget.release()
+                self.pending -= 1
+                self.size -= 1
+                return
         try:
-            self.pool.put( PoolConnection( self.db_module, self.dsn ) )
+            conn = PoolConnection( self.db_module, self.dsn,
+                                   stmt_cache_size = self.stmt_cache_size,
+                                   stmt_cache_stats = self.stmt_cache_stats )
         except PoolConnectionException, e:
+            if self.budget is not None:
+                self.budget.release()
+            self.metrics.incr( 'connect_errors' )
+            self._open_failed( e )
             raise e
+        self.pending -= 1
+        if self.CONN_RECYCLE_AFTER:
+            conn.expires_at = conn.initialized_at + self.CONN_RECYCLE_AFTER * ( 1 - random() * self.lifetime_jitter )
+        else:
+            conn.expires_at = None
+        conn.checked_at = conn.initialized_at
+        conn.checked_out_at = None
+        self.metrics.incr( 'connections_opened' )
+        self._release( conn )
+
+    def _open_failed( self, e ):
+        self.pending -= 1
+        self.size -= 1
+        self.metrics.incr( 'errors' )
+        if self.size == 0:
+            # nothing left that could serve the waiters
+            for waiter, deadline in self.waiters.drain():
+                waiter.set_exception( e )
 
-    def resize( self, new_size ):
+    def _grow( self ):
+        try:
+            self._open_connection( on_demand = True )
+        except ( PoolConnectionException, DBPoolBudgetException ), e:
+            if self.do_log:
+                self.logger.info( "could not grow the pool: %s", ( e, ) )
+
+    def _release( self, conn ):
         """
-        Resize the pool (nr. of connections on the pool)
+        Hand a connection to the first waiting caller of the highest priority
+        or put it on the idle stack. Waiters whose deadline passed are failed
+        instead of served.
+        """
+        while self.waiters:
+            ( waiter, deadline ), priority = self.waiters.popleft( self._low_priority_allowed() )
+            if waiter is None:
+                break
+            if waiter.ready():
+                continue
+            if deadline is not None and deadline <= time():
+                self.metrics.incr( 'deadlines_exceeded' )
+                waiter.set_exception( DBPoolDeadlineExceededException( "Deadline passed while waiting for a connection." ) )
+                continue
+            self._checked_out( conn, priority )
+            waiter.set( conn )
+            return
+        conn.idle_since = time()
+        self.idle.append( conn )
+
+    def _low_priority_allowed( self ):
+        if self.low_priority_share is None:
+            return True
+        return self.low_in_use < max( 1, int( self.max_size * self.low_priority_share ) )
+
+    def _wake_capped( self ):
+        # low priority callers may have been waiting for their share while
+        # there were idle connections
+        if self.idle and self.waiters:
+            self._release( self.idle.pop() )
+
+    def _checked_out( self, conn, priority ):
+        conn.priority = priority
+        if priority == PRIORITY_LOW:
+            self.low_in_use += 1
+
+    def _hand_back( self, conn ):
+        # the connection was handed to a waiter that is gone. it was not
+        # used, so it needs no reset.
+        if conn.priority == PRIORITY_LOW:
+            self.low_in_use -= 1
+        conn.priority = None
+        self._release( conn )
+
+    def _close( self, conn ):
+        self.size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+        if self.budget is not None:
+            self.budget.release()
+
+    def _maintain( self ):
+        while 1:
+            gevent.sleep( self.maintenance_interval )
+            try:
+                self.maintain()
+            except Exception, e:
+                if self.do_log:
+                    self.logger.info( "maintenance failed: %s", ( e, ) )
 
-        :param int new_size: nr ob connections the pool should be resized to
+    def maintain( self ):
         """
-        while self.qsize != new_size:
-            if self.qsize < new_size:
+        One maintenance run: close connections idle for longer than
+        `idle_timeout`, replace idle connections that will reach their
+        lifetime before the next run, check connections idle for longer than
+        `health_check_interval` are still alive and open connections up to
+        `min_size`. Runs periodically on the maintenance greenlet.
+        """
+        now = time()
+        for conn in list( self.idle ):
+            if conn not in self.idle:
+                continue
+            if self.idle_timeout and self.size > self.min_size and now - conn.idle_since > self.idle_timeout:
+                if self.do_log:
+                    self.logger.info( "closing idle conn." )
+                self.idle.remove( conn )
+                self._close( conn )
+                self.metrics.incr( 'idle_closed' )
+            elif conn.expires_at is not None and conn.expires_at <= now + self.maintenance_interval:
+                self.idle.remove( conn )
+                self._replace( conn )
+            elif self.health_check_interval and now - max( conn.idle_since, conn.checked_at ) > self.health_check_interval:
+                self.idle.remove( conn )
+                self._check( conn )
+        while self.size < self.min_size:
+            self.create_connection()
+
+    def _replace( self, conn ):
+        # open the new connection before closing the old one so the pool
+        # does not lose capacity. surplus connections are just closed.
+        if self.do_log:
+            self.logger.info( "recycling conn." )
+        self.metrics.incr( 'recycles' )
+        if self.size <= self.min_size or self.waiters:
+            try:
                 self.create_connection()
-            else:
-                conn = self.pool.get()
-                conn.close()
+            except ( PoolConnectionException, DBPoolBudgetException ), e:
+                if self.do_log:
+                    self.logger.info( "could not replace conn: %s", ( e, ) )
+                self._return_idle( conn )
+                return
+        self._close( conn )
+
+    def _check( self, conn ):
+        try:
+            conn.ping()
+        except Exception, e:
+            if self.do_log:
+                self.logger.info( "health check failed: %s", ( e, ) )
+            self.metrics.incr( 'errors' )
+            self.metrics.incr( 'health_check_failures' )
+            self._close( conn )
+            return
+        conn.checked_at = time()
+        self._return_idle( conn )
+
+    def _return_idle( self, conn ):
+        # back onto the pool without counting as use for the idle timeout
+        if self.waiters:
+            self._release( conn )
+        else:
+            self.idle.insert( 0, conn )
+
+    def resize( self, new_size, min_size = None ):
+        """
+        Resize the pool (nr. of connections on the pool)
+
+        Opens connections until the pool has `min_size` connections and closes
+        idle connections above `new_size`. Checked out connections above
+        `new_size` are closed when they are put back.
+
+        :param int new_size: maximum nr of connections the pool should be resized to
+        :param int min_size: nr of connections to keep open. Defaults to `new_size`
+        """
+        self.max_size = self.pool_size = new_size
+        self.min_size = new_size if min_size is None else min( min_size, new_size )
+        while self.size > self.max_size and self.idle:
+            self._close( self.idle.pop( 0 ) )
+        gevent.joinall( [ gevent.spawn( self.create_connection ) for i in xrange( self.min_size - self.size ) ] )
 
-    def get( self, timeout = None, iso_level = ISOLATION_LEVEL_READ_COMMITTED ):
+    def get( self, timeout = None, iso_level = ISOLATION_LEVEL_READ_COMMITTED,
+             priority = PRIORITY_NORMAL, deadline = None ):
         """
         Get a connection from the pool
 
+        If there is no idle connection and the pool has less than `max_size`
+        connections a new one is opened. Waiting callers are served highest
+        priority first, in order of arrival within a priority.
+
         :param int timeout: seconds to wait for a connection or None
-        :param iso_level: transaction isolation level to be set on the connection. Must be one of psycopg2.extensions ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
+        :param iso_level: transaction isolation level to be set on the connection (only changed if the connection is at a different level). Must be one of psycopg2.extensions ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_UNCOMMITTED, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_REPEATABLE_READ, ISOLATION_LEVEL_SERIALIZABLE
+        :param int priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW. PRIORITY_LOW callers are limited to `low_priority_share` of the pool.
+        :param float deadline: time (as in `time.time()`) after which the caller does not need the connection anymore
         :returns: -- a :class:`PoolConnection`
+        :raises: :class:`DBPoolDeadlineExceededException` if the deadline passed before a connection was available
         """
-        try:
-            conn = self.pool.get( timeout = timeout )
-            if iso_level != ISOLATION_LEVEL_READ_COMMITTED:
-                conn.set_isolation_level( iso_level )
-            return conn
-        except gevent.queue.Empty, e:
-            raise PoolConnectionException( e )
+        started = time()
+        if deadline is not None:
+            if deadline <= started:
+                self.metrics.incr( 'deadlines_exceeded' )
+                raise DBPoolDeadlineExceededException( "Deadline passed before asking for a connection." )
+            if timeout is None or deadline - started < timeout:
+                timeout = deadline - started
+        low_allowed = priority != PRIORITY_LOW or self._low_priority_allowed()
+        if self.idle and low_allowed and not self.waiters.waiting( priority ):
+            conn = self.idle.pop()
+            self._checked_out( conn, priority )
+        else:
+            waiter = ( AsyncResult(), deadline )
+            self.waiters.append( waiter, priority )
+            if low_allowed and self.pending < len( self.waiters ) and self.size < self.max_size:
+                self.size += 1
+                self.pending += 1
+                gevent.spawn( self._grow )
+            timer = gevent.Timeout( timeout )
+            timer.start()
+            try:
+                conn = waiter[ 0 ].get()
+            except BaseException, e:
+                # timed out, or killed / an outer timeout of the caller
+                if not waiter[ 0 ].ready():
+                    self.waiters.remove( waiter, priority )
+                    if e is not timer:
+                        raise
+                    if deadline is not None and time() >= deadline:
+                        self.metrics.incr( 'deadlines_exceeded' )
+                        raise DBPoolDeadlineExceededException( "Deadline passed while waiting for a connection." )
+                    self.metrics.incr( 'errors' )
+                    self.metrics.incr( 'get_timeouts' )
+                    raise PoolConnectionException( "Timed out waiting for a connection." )
+                if not waiter[ 0 ].successful():
+                    # opening a connection for the pool failed
+                    waiter[ 0 ].get()
+                if e is not timer:
+                    # nobody is going to use the connection we got handed
+                    self._hand_back( waiter[ 0 ].value )
+                    raise
+                # got handed a connection the moment we timed out
+                conn = waiter[ 0 ].value
+            finally:
+                timer.cancel()
+        conn.checked_out_at = now = time()
+        self.metrics.observe( 'get_wait', now - started )
+        if conn.iso_level != iso_level:
+            conn.set_isolation_level( iso_level )
+            self.metrics.incr( 'isolation_changes' )
+        return conn
 
     def put( self, conn, timeout = 1, force_recycle = False ):
         """
         Put a connection back onto the pool
 
         :param conn: The :class:`PoolConnection` object to be put back onto the pool
-        :param int timeout: timeout in seconds to to put the connection onto the pool
+        :param int timeout: deprecated - putting a connection back never blocks
         :param bool force_recycle: Force connection recycling independent from the pool wide connection lifecycle
         """
         if isinstance( conn, PoolConnection ):
-            if ( self.CONN_RECYCLE_AFTER != 0 and time() - conn.PoolConnection_initialized_at < self.CONN_RECYCLE_AFTER ) and force_recycle == False:
+            if conn.checked_out_at is not None:
+                self.metrics.observe( 'checkout', time() - conn.checked_out_at )
+                conn.checked_out_at = None
+            if conn.priority == PRIORITY_LOW:
+                self.low_in_use -= 1
+            conn.priority = None
+            if self.size > self.max_size:
+                # the pool was resized
+                self._close( conn )
+                self._wake_capped()
+                return
+            expires_at = conn.expires_at
+            if not ( force_recycle or conn.closed or ( expires_at is not None and time() >= expires_at ) ):
                 try:
-                    conn.reset()
-                    if conn.isolation_level != ISOLATION_LEVEL_READ_COMMITTED:
-                        if self.do_log:
-                            self.logger.info( "set ISOLATION_LEVEL_READ_COMMITTED." )
-                        conn.set_isolation_level( ISOLATION_LEVEL_READ_COMMITTED )
-                        conn.commit()
-                    self.pool.put( conn, timeout = timeout )
-                except gevent.queue.Full, e:
-                    raise PoolConnectionException( e )
-            else:
-                if self.do_log:
-                    self.logger.info( "recycling conn." )
-                try:
-                    conn.reset() # ?
-                    conn.close()
-                except InterfaceError:
-                    pass
-                del conn
-                gevent.spawn( self.create_connection ).join()
+                    # the isolation level is left as it is. the next get()
+                    # only changes it if it needs a different one.
+                    conn.reset_session()
+                    self._release( conn )
+                    return
+                except Exception, e:
+                    # a connection that cannot be reset is not reused
+                    if self.do_log:
+                        self.logger.info( "reset failed: %s", ( e, ) )
+            if self.do_log:
+                self.logger.info( "recycling conn." )
+            self.metrics.incr( 'recycles' )
+            self._close( conn )
+            self._wake_capped()
+            del conn
+            # do not make the caller wait for the new connection. if nobody
+            # needs it right now the maintenance greenlet tops the pool up.
+            if self.waiters or self.size < self.min_size:
+                self.size += 1
+                self.pending += 1
+                gevent.spawn( self._grow )
         else:
             raise PoolConnectionException( "Passed object %s is not a PoolConnection." % ( conn, ) )
 
     @property
     def qsize( self ):
-        return self.pool.qsize()
+        """ nr of idle connections on the pool """
+        return len( self.idle )
+
+    @property
+    def in_use( self ):
+        """ nr of checked out connections """
+        return self.size - self.pending - len( self.idle )
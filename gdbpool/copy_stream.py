@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# Incremental encoding/decoding of the COPY text format
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import re
+import json
+
+from psycopg2 import extensions
+
+
+COPY_CHUNK_SIZE = 8192
+
+COPY_ESCAPES = { 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v' }
+# \<1-3 octal digits>, \x<1-2 hex digits> or \<character>
+COPY_ESCAPE_RE = re.compile( r"\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))" )
+# copy_out() sources that are queries rather than table names
+COPY_QUERY_RE = re.compile( r"^\s*(SELECT|WITH|VALUES)\b", re.IGNORECASE )
+
+
+def copy_available( cursor ):
+    """
+    psycopg2 refuses COPY while a wait callback (ie. the gevent one of
+    :mod:`psyco_ge`) is installed. Then COPY has to be emulated.
+
+    :rtype: bool
+    :returns: True if `cursor` can run COPY
+    """
+
+    return hasattr( cursor, 'copy_expert' ) and extensions.get_wait_callback() is None
+
+
+def _cast_text( value, cursor ):
+    return value
+
+
+def register_text_casts( cursor ):
+    """
+    Make `cursor` hand out the values of all types psycopg2 knows as the
+    text PostgreSQL sent - which is what COPY writes and reads - instead
+    of converting them to Python objects (and losing float digits, array
+    and json syntax or bytea escaping on the way back).
+
+    :param cursor: a psycopg2 cursor (others are left alone)
+    """
+
+    if isinstance( cursor, extensions.cursor ):
+        extensions.register_type( extensions.new_type( tuple( extensions.string_types.keys() ),
+                                                       'GDBPOOL_COPY_TEXT', _cast_text ), cursor )
+
+
+def encode_array( value ):
+    """
+    :param list value: a (possibly nested) list or tuple
+    :rtype: string
+    :returns: `value` as a PostgreSQL array literal (ie. ``{"1","2",NULL}``)
+    """
+
+    items = []
+    for item in value:
+        if item is None:
+            items.append( 'NULL' )
+        elif isinstance( item, ( list, tuple ) ):
+            items.append( encode_array( item ) )
+        else:
+            items.append( '"%s"' % ( encode_text( item ).replace( '\\', '\\\\' ).replace( '"', '\\"' ), ) )
+    return "{%s}" % ( ','.join( items ), )
+
+
+def encode_text( value ):
+    """
+    :rtype: string
+    :returns: the PostgreSQL text representation (utf-8) of a Python value that is not None
+    """
+
+    if isinstance( value, str ):
+        return value
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    if isinstance( value, bool ):
+        return 't' if value else 'f'
+    if isinstance( value, float ):
+        # str() rounds to 12 significant digits
+        return repr( value )
+    if isinstance( value, ( list, tuple ) ):
+        return encode_array( value )
+    if isinstance( value, dict ):
+        return json.dumps( value )
+    if isinstance( value, ( buffer, bytearray ) ):
+        return '\\x' + str( value ).encode( 'hex' )
+    return str( value )
+
+
+def encode_copy_value( value, sep = '\t', null = '\\N' ):
+    """
+    :rtype: string
+    :returns: `value` encoded as a COPY text format field (utf-8)
+    """
+
+    if value is None:
+        return null
+    value = encode_text( value )
+    value = value.replace( '\\', '\\\\' ).replace( '\n', '\\n' ).replace( '\r', '\\r' ).replace( '\t', '\\t' )
+    if sep != '\t':
+        value = value.replace( sep, '\\' + sep )
+    return value
+
+
+def encode_copy_row( row, sep = '\t', null = '\\N' ):
+    """
+    :param row: sequence of field values
+    :rtype: string
+    :returns: `row` as a line (including the newline) in COPY text format
+    """
+
+    return "%s\n" % ( sep.join( [ encode_copy_value( value, sep, null ) for value in row ] ), )
+
+
+def encode_copy_rows( rows, sep = '\t', null = '\\N' ):
+    """
+    Yield the COPY text format lines for the row tuples in `rows`. Closes
+    `rows` (if it is a generator) when closed itself.
+    """
+
+    try:
+        for row in rows:
+            yield encode_copy_row( row, sep, null )
+    finally:
+        if hasattr( rows, 'close' ):
+            rows.close()
+
+
+def _unescape_match( m ):
+    octal, hexadecimal, char = m.groups()
+    if octal is not None:
+        # like COPY FROM: the byte value - higher bits are dropped
+        return chr( int( octal, 8 ) & 0xff )
+    if hexadecimal is not None:
+        return chr( int( hexadecimal, 16 ) )
+    return COPY_ESCAPES.get( char, char )
+
+
+def _unescape( field ):
+    return COPY_ESCAPE_RE.sub( _unescape_match, field )
+
+
+def decode_copy_line( line, sep = '\t', null = '\\N' ):
+    """
+    :param string line: a line in COPY text format (without the newline)
+    :rtype: list
+    :returns: the fields of the line - None for NULL
+    """
+
+    fields = []
+    raw = []
+    for m in re.finditer( r"\\.|[^\\%s]+|%s" % ( re.escape( sep ), re.escape( sep ) ), line ):
+        token = m.group( 0 )
+        if token == sep:
+            fields.append( raw )
+            raw = []
+        else:
+            raw.append( token )
+    fields.append( raw )
+    return [ None if ''.join( raw ) == null else _unescape( ''.join( raw ) ) for raw in fields ]
+
+
+def iter_copy_lines( f, chunk_size = COPY_CHUNK_SIZE ):
+    """
+    Yield the lines (without newline) of the COPY text format data read
+    from the file-like object `f` in chunks of `chunk_size`. Stops at the
+    end-of-data marker.
+    """
+
+    rest = ''
+    while 1:
+        chunk = f.read( chunk_size )
+        if not chunk:
+            break
+        lines = ( rest + chunk ).split( '\n' )
+        rest = lines.pop()
+        for line in lines:
+            if line == '\\.':
+                return
+            yield line.rstrip( '\r' )
+    if rest and rest != '\\.':
+        yield rest.rstrip( '\r' )
+
+
+class RowReader( object ):
+    """
+    File-like object that encodes row tuples to COPY text format as they are
+    read - ie. for `cursor.copy_expert` - without building the whole data in
+    memory.
+    """
+
+    def __init__( self, rows, sep = '\t', null = '\\N' ):
+        """
+        :param rows: iterable of row tuples
+        :param string sep: field separator
+        :param string null: representation of NULL
+        """
+        self.rows = iter( rows )
+        self.sep = sep
+        self.null = null
+        self.buffer = ''
+        self.row_count = 0
+
+    def read( self, size = COPY_CHUNK_SIZE ):
+        parts = [ self.buffer ]
+        length = len( self.buffer )
+        while size < 0 or length < size:
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                break
+            line = encode_copy_row( row, self.sep, self.null )
+            parts.append( line )
+            length += len( line )
+            self.row_count += 1
+        data = ''.join( parts )
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[ size: ]
+        return data[ :size ]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# InteractionExecutor - a bounded set of worker greenlets draining a
+# request queue
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import gevent
+import sys, traceback
+
+from gevent.queue import PriorityQueue, Full as QueueFullException
+from itertools import count
+
+from gdbpool_error import DBPoolQueueFullException
+from connection_pool import PRIORITY_NORMAL
+
+
+class InteractionExecutor( object ):
+    """
+    Runs interactions on a fixed number of long-lived worker greenlets.
+
+    Requests are put onto a (optionally bounded) request queue and the workers
+    drain it. That keeps the number of greenlets waiting for a connection
+    constant no matter how many requests come in. Requests of a higher
+    priority are run first. When the queue is full
+    :meth:`.submit` either blocks the caller until there is room again
+    (backpressure) or rejects the request right away.
+    """
+
+    def __init__( self, workers, max_queue_size = None,
+                  reject_when_full = False, do_log = False ):
+        """
+        :param int workers: Number of worker greenlets to spawn
+        :param int max_queue_size: Maximum number of pending requests or None for an unbounded queue
+        :param bool reject_when_full: Raise :class:`DBPoolQueueFullException` instead of blocking when the queue is full
+        :param bool do_log: Log to the console or not
+        """
+        if do_log:
+            import logging
+            self.logger = logging.getLogger()
+        self.do_log = do_log
+        self.max_queue_size = max_queue_size
+        self.reject_when_full = reject_when_full
+        self.request_queue = PriorityQueue( maxsize = max_queue_size )
+        self.request_ids = count()
+        self.workers = [ gevent.spawn( self._work ) for i in xrange( workers ) ]
+
+    def __del__( self ):
+        self.stop()
+
+    def stop( self ):
+        """
+        Kill all worker greenlets. Requests still on the queue are dropped.
+        """
+        gevent.killall( self.workers )
+        self.workers = []
+
+    def submit( self, f, *args, **kwargs ):
+        """
+        Queue a call of `f( *args, **kwargs )` for one of the workers.
+
+        :raises: :class:`DBPoolQueueFullException` if `reject_when_full` is set and the queue is full
+        """
+        self.submit_with_priority( PRIORITY_NORMAL, f, *args, **kwargs )
+
+    def submit_with_priority( self, priority, f, *args, **kwargs ):
+        """
+        Queue a call of `f( *args, **kwargs )` with `priority` (one of the
+        PRIORITY_* constants of :mod:`connection_pool`). See :meth:`.submit`
+        """
+        try:
+            self.request_queue.put( ( -priority, self.request_ids.next(), f, args, kwargs ),
+                                    block = not self.reject_when_full )
+        except QueueFullException, e:
+            raise DBPoolQueueFullException( "Request queue is full (%s pending requests)." % ( self.max_queue_size, ) )
+
+    def _work( self ):
+        while 1:
+            priority, request_id, f, args, kwargs = self.request_queue.get()
+            try:
+                f( *args, **kwargs )
+            except Exception, e:
+                # the interactions report their own errors on their
+                # AsyncResult - whatever ends up here must not kill the worker
+                if self.do_log:
+                    self.logger.info( "executor exception: %s", ( e, ) )
+                traceback.print_exc( file = sys.stdout )
+
+    @property
+    def qsize( self ):
+        return self.request_queue.qsize()
@@ -13,6 +13,9 @@ __version__ = "0.1.3"
 
 import sys, traceback
 
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.extensions import QueryCanceledError, TransactionRollbackError
+
 
 class DBPoolException( Exception ):
     def __init__( self, message ):
@@ -29,3 +32,45 @@ class PoolConnectionException( DBPoolException ):
 
 class StreamEndException( DBPoolException ):
     pass
+
+class DBPoolQueueFullException( DBInteractionException ):
+    pass
+
+class DBPoolDeadlineExceededException( DBInteractionException ):
+    pass
+
+class DBInteractionTimeoutException( DBInteractionException ):
+    pass
+
+class DBPoolBudgetException( DBPoolException ):
+    pass
+
+class DBPoolCircuitOpenException( DBInteractionException ):
+    pass
+
+
+def is_connection_error( e ):
+    """
+    Does the exception mean the connection (or the database behind it) is
+    gone - as opposed to an error in the query or a conflict with another
+    transaction?
+
+    :param Exception e: the exception raised by an interaction
+    :rtype: bool
+    """
+
+    if isinstance( e, ( QueryCanceledError, TransactionRollbackError ) ):
+        return False
+    return isinstance( e, ( OperationalError, InterfaceError, PoolConnectionException, DBPoolConnectionException ) )
+
+def is_serialization_failure( e ):
+    """
+    Did the server roll the transaction back because of a conflict with
+    another transaction (a serialization failure or a deadlock)? Running it
+    again can succeed.
+
+    :param Exception e: the exception raised by an interaction
+    :rtype: bool
+    """
+
+    return isinstance( e, TransactionRollbackError )
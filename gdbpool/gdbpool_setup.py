@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# Process wide initialization - done explicitly or lazily, never on import
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+_patched = False
+_green = False
+
+
+def setup( patch_all = True ):
+    """
+    Initialize gDBPool for the process. Safe to call any number of times.
+
+    * with `patch_all` gevent's ``monkey.patch_all()`` patches the standard library. Call it as early as possible - before other modules import ``socket``, ``threading`` etc.
+    * psycopg2 gets the gevent wait callback (see :mod:`psyco_ge`) so queries only block the greenlet that runs them
+    * psycopg2 returns unicode strings (UNICODE and UNICODEARRAY are registered)
+
+    Importing the gDBPool modules does none of this. The pools call
+    ``setup( patch_all = False )`` before they open their first connection,
+    so a process that does its own monkey patching does not need to call it.
+
+    :param bool patch_all: also monkey patch the standard library
+    """
+
+    global _patched, _green
+    if patch_all and not _patched:
+        from gevent import monkey
+        monkey.patch_all()
+        _patched = True
+    if not _green:
+        import psycopg2.extensions
+        from psyco_ge import make_psycopg_green
+        make_psycopg_green()
+        psycopg2.extensions.register_type( psycopg2.extensions.UNICODE )
+        psycopg2.extensions.register_type( psycopg2.extensions.UNICODEARRAY )
+        _green = True
@@ -10,25 +10,33 @@ __version__ = "0.1.3"
 
 
 import gevent
-from gevent import monkey; monkey.patch_all()
-from psyco_ge import make_psycopg_green; make_psycopg_green()
-import sys
-assert 'gdbpool.psyco_ge' in sys.modules.keys()
-
-import psycopg2
-import traceback
+import sys, traceback
 
 from gevent.queue import Queue, Empty as QueueEmptyException
 from gevent.event import AsyncResult
 from types import FunctionType, MethodType, StringType
-from psycopg2 import DatabaseError
-psycopg2.extensions.register_type( psycopg2.extensions.UNICODE )
-psycopg2.extensions.register_type( psycopg2.extensions.UNICODEARRAY )
+from psycopg2 import DatabaseError, Error
+from psycopg2.extensions import QueryCanceledError
 from inspect import getargspec
+from itertools import chain, count
+from time import time
+
+from connection_pool import DBConnectionPool, PRIORITY_NORMAL
+from channel_listener import PGChannelListener, ChannelSubscription
+from executor import InteractionExecutor
+from batch import page_statements
+from copy_stream import COPY_CHUNK_SIZE, COPY_QUERY_RE, RowReader, copy_available, decode_copy_line, encode_copy_row, iter_copy_lines, register_text_casts
+from metrics import MetricsRegistry, sql_fingerprint
+from replica_balancer import ReplicaBalancer
+from result_cache import ResultCache, freeze_args
+from retry import RetryPolicy
+from row_stream import RowStream
+from circuit_breaker import CircuitBreaker
+from transaction import DBTransaction
+from gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, StreamEndException, DBPoolQueueFullException, DBInteractionTimeoutException, DBPoolCircuitOpenException, is_connection_error
 
-from connection_pool import DBConnectionPool
-from channel_listener import PGChannelListener
-from gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, StreamEndException
+
+CACHE_MISS = object()
 
 
 class DBInteractionPool( object ):
@@ -36,6 +44,11 @@ class DBInteractionPool( object ):
     The DBInteractionPool manages `DBConnectionPool` instances and can run
     queries or functions (ie. several queries wrapped in a function) on one of
     these pools.
+
+    Interaction metrics (execution time per SQL fingerprint or interaction
+    function, errors, request and listener queue depths) are recorded in
+    `metrics`, a :class:`MetricsRegistry`. Each `DBConnectionPool` has its
+    own registry for the connection level metrics. See :meth:`.metrics_snapshot`.
     """
 
     def __new__( cls, dsn, *args, **kwargs ):
@@ -44,12 +57,40 @@ class DBInteractionPool( object ):
         return cls._instance
 
     def __init__( self, dsn, pool_size = 10, pool_name = 'default',
-                  do_log = False ):
+                  do_log = False, workers = None, max_queue_size = None,
+                  reject_when_full = False, stmt_cache_size = 0,
+                  min_size = None, max_size = None, idle_timeout = None,
+                  conn_lifetime = 600, health_check_interval = 30,
+                  read_strategy = 'round_robin', replica_eject_for = 30,
+                  result_cache_size = 1000, result_cache_ttl = 5,
+                  low_priority_share = None, query_timeout = None,
+                  db_module = 'psycopg2', budget = None, retry = None,
+                  breaker_threshold = 5, breaker_timeout = 10 ):
         """
         :param string dsn: DSN for the default `class:DBConnectionPool`
         :param int pool_size: Poolsize of the first/default `class:DBConnectionPool`
         :param string pool_name: Keyname for the first/default `class:DBConnectionPool`
         :param bool do_log: Log to the console or not
+        :param int workers: Number of worker greenlets for the first/default pool. See :meth:`.add_pool`
+        :param int max_queue_size: Maximum number of queued requests for the first/default pool. See :meth:`.add_pool`
+        :param bool reject_when_full: Reject requests right away when the request queue of the first/default pool is full. See :meth:`.add_pool`
+        :param int stmt_cache_size: Number of prepared statements each connection of the first/default pool caches. See :meth:`.add_pool`
+        :param int min_size: Minimum number of connections of the first/default pool. See :meth:`.add_pool`
+        :param int max_size: Maximum number of connections of the first/default pool. See :meth:`.add_pool`
+        :param int idle_timeout: Seconds after which idle connections of the first/default pool above `min_size` are closed. See :meth:`.add_pool`
+        :param int conn_lifetime: Seconds after which connections of the first/default pool are recycled. See :meth:`.add_pool`
+        :param int health_check_interval: Seconds an idle connection of the first/default pool can sit idle before it is checked. See :meth:`.add_pool`
+        :param string|function read_strategy: How to pick one of the read replica pools for read interactions: 'round_robin', 'least_outstanding', 'lowest_latency' or a function. See :class:`ReplicaBalancer`
+        :param int replica_eject_for: Seconds a read replica that failed with a connection error is not used
+        :param int result_cache_size: Maximum number of results in the result cache. See :meth:`.run`
+        :param float result_cache_ttl: Default seconds a cached result stays valid
+        :param float low_priority_share: Fraction of the first/default pool's connections PRIORITY_LOW requests can use at the same time. See :meth:`.add_pool`
+        :param float query_timeout: Seconds after which interactions on the first/default pool are cancelled. See :meth:`.add_pool`
+        :param string db_module: name of the DB-API module pools use unless :meth:`.add_pool` is given another one
+        :param ConnectionBudget budget: connection budget the first/default pool shares with other processes. See :meth:`.add_pool`
+        :param RetryPolicy retry: Default :class:`RetryPolicy` of :meth:`.run`. None for a `RetryPolicy()` (retries reads that failed with a connection error), False to not retry.
+        :param int breaker_threshold: Consecutive failures after which the circuit breaker of the first/default pool opens. See :meth:`.add_pool`
+        :param float breaker_timeout: Seconds the circuit breaker of the first/default pool stays open. See :meth:`.add_pool`
         """
 
         if do_log == True:
@@ -57,20 +98,45 @@ class DBInteractionPool( object ):
             logging.basicConfig( level = logging.INFO, format = "%(asctime)s %(message)s" )
             self.logger = logging.getLogger()
         self.do_log = do_log
-        self.request_queue = Queue( maxsize = None )
-        self.db_module = 'psycopg2'
+        self.executors = {}
+        self.stream_ids = count()
+        self.fingerprints = {}
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge( 'request_queue_depths', lambda: dict( [ ( p, e.qsize ) for p, e in self.executors.items() ] ) )
+        self.metrics.gauge( 'listener_queue_depths', self._listener_queue_depths )
+        self.db_module = db_module
         self.conn_pools = {}
         self.default_write_pool = None
         self.default_read_pool = None
         self.default_pool = None
+        self.replica_balancer = ReplicaBalancer( strategy = read_strategy,
+                                                 eject_for = replica_eject_for )
         self.active_listeners = {}
+        self.in_flight = {}
+        self.query_timeouts = {}
+        self.breakers = {}
+        self.retry = RetryPolicy() if retry is None else ( retry or None )
+        self.result_cache = ResultCache( max_size = result_cache_size, default_ttl = result_cache_ttl )
+        self.metrics.gauge( 'result_cache', lambda: dict( self.result_cache.stats, size = len( self.result_cache ) ) )
         self.add_pool( dsn = dsn, pool_name = pool_name, pool_size = pool_size,
                        default_write_pool = True, default_read_pool = True,
-                       db_module = self.db_module )
+                       db_module = self.db_module, workers = workers,
+                       max_queue_size = max_queue_size,
+                       reject_when_full = reject_when_full,
+                       stmt_cache_size = stmt_cache_size, min_size = min_size,
+                       max_size = max_size, idle_timeout = idle_timeout,
+                       conn_lifetime = conn_lifetime,
+                       health_check_interval = health_check_interval,
+                       low_priority_share = low_priority_share,
+                       query_timeout = query_timeout, budget = budget,
+                       breaker_threshold = breaker_threshold,
+                       breaker_timeout = breaker_timeout )
 
     def __del__( self ):
         if self.do_log:
             self.logger.info( "__del__ DBInteractionPool" )
+        for p in self.executors:
+            self.executors[ p ].stop()
         for p in self.conn_pools:
             self.conn_pools[ p ].__del__()
 
@@ -80,31 +146,68 @@ class DBInteractionPool( object ):
 
     def add_pool( self, dsn = None, pool_name = None, pool_size = 10,
                   default_write_pool = False, default_read_pool = False,
-                  default_pool = False, db_module = 'psycopg2' ):
+                  default_pool = False, db_module = None, workers = None,
+                  max_queue_size = None, reject_when_full = False,
+                  stmt_cache_size = 0, min_size = None, max_size = None,
+                  idle_timeout = None, conn_lifetime = 600,
+                  health_check_interval = 30, read_replica = False,
+                  low_priority_share = None, query_timeout = None,
+                  budget = None, breaker_threshold = 5, breaker_timeout = 10 ):
         """
         Add a named `:class:DBConnectionPool`
 
         :param string dsn: dsn
         :param string pool_name: a name for the pool to identify it inside the DBInteractionPool
-        :param int pool_size: Number of connections the pool should have.
+        :param int pool_size: Number of connections the pool should have. Used for `min_size` and `max_size` if they are not set.
         :param bool default_write_pool: Should the added pool used as the default pool for write operations?
         :param bool default_read_pool: Should the added pool used as the default pool for read operations?
         :param bool default_pool: Should the added pool used as the default pool? (*must* be a write pool)
-        :param string db_module: name of the DB-API module to use
+        :param string db_module: name of the DB-API module to use. Defaults to the `db_module` of the DBInteractionPool.
+        :param int workers: Number of long-lived worker greenlets that run the interactions for this pool. When None every :meth:`.run` spawns its own greenlet.
+        :param int max_queue_size: Maximum number of requests waiting for a worker or None for no limit. Only applies when `workers` is set.
+        :param bool reject_when_full: When the request queue is full fail the request with a :class:`DBPoolQueueFullException` instead of blocking the caller until there is room. Only applies when `workers` is set.
+        :param int stmt_cache_size: Number of prepared statements each connection caches (LRU, keyed by SQL text). SQL interactions are then transparently run as ``EXECUTE`` of the cached statement. 0 disables the cache. Hit/miss counters are in the pool's `stmt_cache_stats`.
+        :param int min_size: Number of connections to open right away and keep open
+        :param int max_size: Maximum number of connections. Connections above `min_size` are opened on demand while requests wait for a connection.
+        :param int idle_timeout: Seconds after which idle connections above `min_size` are closed. None keeps them open.
+        :param int conn_lifetime: Seconds after which connections are recycled (jittered per connection). Idle connections are replaced in the background ahead of time. None keeps connections open forever.
+        :param int health_check_interval: Seconds a connection can sit idle before the pool's maintenance greenlet checks it is still alive. None disables health checks.
+        :param float low_priority_share: Fraction of `max_size` connections PRIORITY_LOW requests (ie. batch jobs) can have checked out at the same time. None for no limit.
+        :param float query_timeout: Seconds after which the queries of an interaction on the pool are cancelled on the server. The interaction then fails with a :class:`DBInteractionTimeoutException`. None for no timeout. Can be overridden per :meth:`.run`.
+        :param ConnectionBudget budget: A :class:`ConnectionBudget` the pool takes a unit of for each connection it opens. Share one budget (per database server) among the pools of all processes on a host to cap their total number of connections - and give the pool a small `min_size` and an `idle_timeout` so it only holds the connections it needs.
+        :param int breaker_threshold: Consecutive failures (connection errors and query timeouts) after which the pool's :class:`CircuitBreaker` opens. Requests for the pool then fail right away with a :class:`DBPoolCircuitOpenException` instead of waiting for a database that is down. None disables the breaker.
+        :param float breaker_timeout: Seconds the circuit breaker stays open before it lets a probe request through. A successful probe closes it again.
+        :param bool read_replica: Add the pool as a read replica. Read interactions without a named pool are balanced across all read replicas (see `read_strategy`) and only go to the default read pool if all replicas are ejected.
 
         .. note::
-            db_module right now ONLY supports psycopg2 and the option most likely will be removed in the future
+            db_module is meant for psycopg2 (or a module that behaves like it, ie. the fake driver of the benchmarks). Other DB-API modules are not supported.
         """
 
         if not self.conn_pools.has_key( pool_name ):
-            self.conn_pools[ pool_name ] = DBConnectionPool( dsn, db_module = self.db_module,
-                                                             pool_size = pool_size, do_log = self.do_log )
+            self.conn_pools[ pool_name ] = DBConnectionPool( dsn, db_module = db_module or self.db_module,
+                                                             pool_size = pool_size, do_log = self.do_log,
+                                                             stmt_cache_size = stmt_cache_size,
+                                                             min_size = min_size, max_size = max_size,
+                                                             idle_timeout = idle_timeout,
+                                                             conn_lifetime = conn_lifetime,
+                                                             health_check_interval = health_check_interval,
+                                                             low_priority_share = low_priority_share,
+                                                             budget = budget )
+            self.query_timeouts[ pool_name ] = query_timeout
+            self.breakers[ pool_name ] = CircuitBreaker( failure_threshold = breaker_threshold,
+                                                         reset_timeout = breaker_timeout )
+            if workers:
+                self.executors[ pool_name ] = InteractionExecutor( workers, max_queue_size = max_queue_size,
+                                                                   reject_when_full = reject_when_full,
+                                                                   do_log = self.do_log )
             if default_write_pool:
                 self.default_write_pool = pool_name
                 if self.default_pool or self.default_pool is None:
                     self.default_pool = pool_name
             if default_read_pool:
                 self.default_read_pool = pool_name
+            if read_replica:
+                self.replica_balancer.add( pool_name )
         else:
             raise DBInteractionException( "Already have a pool with the name: %s. ConnectionPool not added!" % ( pool_name, ) )
 
@@ -114,7 +217,11 @@ class DBInteractionPool( object ):
 
     def run( self, interaction = None, interaction_args = None,
              get_result = True, is_write = True, pool = None, conn = None,
-             cursor = None, partial_txn = False, dry_run = False, *args,
+             cursor = None, partial_txn = False, dry_run = False,
+             stream = False, itersize = 2000, stream_queue = None,
+             cancel_event = None, cache = False, cache_ttl = None,
+             cache_tags = None, coalesce = False, priority = PRIORITY_NORMAL,
+             deadline = None, query_timeout = None, retry = None, *args,
              **kwargs ):
         """
         Run an interaction on one of the managed `:class:DBConnectionPool` pools.
@@ -126,141 +233,729 @@ class DBInteractionPool( object ):
         :param string pool: Keyname of the pool to get the a connection from
         :param connection conn: Pass in a `Connection` instead of getting one from the pool. (ie. for locks in transactions that span several interactions. Use `partial_txn = True` to retrieve the Connection and then pass it into the next interaction run.)
         :param cursor cursor: Pass in a `Cursor` instead of getting one from the `Connection` (ie. for locks in transactions that span several interactions.  Use `partial_txn = True` to retrieve the Cursor and then pass it into the next interaction run.)
-        :param bool partial_txn: Return connection and cursor after executing the interaction (ie. for locks in transactions that span several interactions)
+        :param bool partial_txn: Return connection and cursor after executing the interaction (ie. for locks in transactions that span several interactions). The connection has to be passed into a following run() that ends the transaction - :meth:`.transaction` takes care of that.
         :param bool dry_run: Run the query with `mogrify` instead of `execute` and output the query that would have run. (Only applies to query interactions)
+        :param bool stream: Run the query on a named server-side cursor and hand the rows back incrementally instead of fetching the whole result set. (Only applies to query interactions)
+        :param int itersize: Number of rows to fetch from the server-side cursor per round trip when streaming
+        :param gevent.Queue stream_queue: When streaming push the rows into this queue instead of returning a :class:`RowStream`. The end of the stream is marked by a :class:`StreamEndException` instance (or the :class:`DBInteractionException` that ended it early).
+        :param gevent.Event cancel_event: A :class:`gevent.Event` which stops a stream pushed into `stream_queue` when set
+        :param bool cache: Serve the result of a read (`is_write = False`) query from the result cache if it is there and cache it otherwise. Keyed on pool, query, and interaction_args. Cached results are shared - do not modify them.
+        :param float cache_ttl: Seconds the result stays cached. Defaults to `result_cache_ttl`.
+        :param list cache_tags: Tags to invalidate the cached result by. See :meth:`.invalidate_cache_on`
+        :param int priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW (see :mod:`connection_pool`). Requests of a higher priority get connections (and workers) first.
+        :param float deadline: time (as in `time.time()`) after which the result is not needed anymore. A request still waiting for a connection then fails with a :class:`DBPoolDeadlineExceededException` without ever using one.
+        :param float query_timeout: Seconds after which the queries of the interaction are cancelled on the server. The :class:`gevent.AsyncResult` then holds a :class:`DBInteractionTimeoutException` and the connection goes back onto the pool rolled back (or is replaced if the server did not react to the cancel). Defaults to the pool's `query_timeout`. A `deadline` also bounds the queries.
+        :param RetryPolicy retry: Which failures to run the interaction again for - on a fresh connection, after a backoff. Defaults to the pool's `retry`. False to not retry. Interactions on a passed in `conn`, with `partial_txn`, and streams are never retried.
+        :param bool coalesce: Share one execution of a read (`is_write = False`) query among all concurrent callers with the same pool, query, interaction_args, priority, query_timeout, and retry. Requests with a `deadline` are not coalesced. They all get the same :class:`gevent.AsyncResult` (and result - do not modify it).
         :param list args: positional args for the interaction
         :param dict kwargs: kwargs for the interaction
 
         :rtype: gevent.AsyncResult
         :returns: -- a :class:`gevent.AsyncResult` that will hold the result of the interaction once it finished. When `partial_txn = True` it will return a dict that will hold the result, the connection, and the cursor that ran the transaction. (use for locking with SELECT FOR UPDATE)
+
+        .. note::
+            With `stream = True` the :class:`gevent.AsyncResult` holds a :class:`RowStream` iterator yielding the rows - or the number of rows pushed once the stream finished if a `stream_queue` was passed in. The connection goes back onto the pool once the stream is exhausted, cancelled or closed - close streams that are not iterated to the end or use them in a ``with`` statement. The query timeout / deadline applies to each fetch of the stream.
+
+        .. note::
+            If the pool was added with `workers` the interaction is queued for one of the pool's worker greenlets. If the request queue is full and the pool rejects requests the returned :class:`gevent.AsyncResult` holds a :class:`DBPoolQueueFullException`.
         """
 
         async_result = AsyncResult()
-        if is_write:
-            use_pool = self.default_write_pool if pool is None else pool
-        else:
-            use_pool = self.default_read_pool if pool is None else pool
+        cache_key = None
+        if ( cache or coalesce ) and not is_write and isinstance( interaction, StringType ) \
+                and not ( stream or dry_run or partial_txn or conn or cursor ):
+            key = ( pool, interaction, freeze_args( interaction_args ), get_result )
+            if cache:
+                cached = self.result_cache.get( key, CACHE_MISS )
+                if cached is not CACHE_MISS:
+                    async_result.set( cached )
+                    return async_result
+                cache_key = key
+                cache_generation = self.result_cache.generation
+            if coalesce and deadline is None:
+                # callers share the outcome - so only join requests that run
+                # under the same limits (a deadline is each caller's own)
+                flight_key = key + ( priority, query_timeout, retry )
+                in_flight = self.in_flight.get( flight_key )
+                if in_flight is not None:
+                    self.metrics.incr( 'coalesced' )
+                    return in_flight
+                self.in_flight[ flight_key ] = async_result
+                async_result.rawlink( lambda res: self._landed( flight_key, res ) )
+        use_pool = self._use_pool( is_write, pool )
+        if query_timeout is None:
+            query_timeout = self.query_timeouts.get( use_pool )
+        if conn or cursor or partial_txn or dry_run:
+            retry = None
+        elif retry is None:
+            retry = self.retry
 
         if isinstance( interaction, FunctionType ) or isinstance( interaction, MethodType ):
             def wrapped_transaction_f( async_res, interaction, conn = None,
                                        cursor = None, *args ):
+                pool_name = use_pool
+                attempt = 1
+                while 1:
+                    requested = time()
+                    failure = None
+                    try:
+                        if not conn:
+                            conn = self.conn_pools[ pool_name ].get( priority = priority, deadline = deadline )
+                        conn.set_query_deadline( self._query_deadline( query_timeout, deadline ) )
+                        kwargs[ 'conn' ] = conn
+                        if cursor:
+                            kwargs[ 'cursor' ] = cursor
+                        elif 'cursor' in getargspec( interaction )[ 0 ]:
+                            kwargs[ 'cursor' ] = kwargs[ 'conn' ].cursor()
+                        started = time()
+                        res = interaction( *args, **kwargs )
+                        self.metrics.observe( 'interaction:%s' % ( interaction.__name__, ), time() - started )
+                        self._interaction_succeeded( pool_name, time() - requested )
+                        if not partial_txn:
+                            async_res.set( res )
+                            if cursor and not cursor.closed:
+                                cursor.close()
+                        else:
+                            async_res.set( { 'result': res,
+                                             'connection': conn,
+                                             'cursor': kwargs[ 'cursor' ] } )
+                    except DatabaseError, e:
+                        failure = e
+                        self._interaction_failed( pool_name, e )
+                        if self.do_log:
+                            self.logger.info( "exception: %s", ( e, ) )
+                    except Exception, e:
+                        failure = e
+                        self._interaction_failed( pool_name, e )
+                        if self.do_log:
+                            self.logger.info( "exception: %s", ( e, ) )
+                    finally:
+                        if conn:
+                            conn.set_query_deadline( None )
+                        if conn and not partial_txn:
+                            self._put_back( pool_name, conn, failure )
+                    if failure is None:
+                        return
+                    pool_name = self._retry_pool( retry, failure, attempt, is_write, pool, pool_name, deadline )
+                    if pool_name is None:
+                        async_res.set_exception( self._interaction_error( failure ) )
+                        return
+                    conn = None
+                    attempt += 1
+
+            self._dispatch( use_pool, async_result, priority, wrapped_transaction_f,
+                            async_result, interaction, conn = conn,
+                            cursor = cursor, *args )
+            return async_result
+
+        elif isinstance( interaction, StringType ) and stream and not dry_run:
+            def stream_f( async_res, sql, conn = None, *args ):
+                release = not conn
+                query_deadline = self._query_deadline( query_timeout, deadline )
                 try:
                     if not conn:
-                        conn = self.conn_pools[ use_pool ].get()
-                    kwargs[ 'conn' ] = conn
-                    if cursor:
-                        kwargs[ 'cursor' ] = cursor
-                    elif 'cursor' in getargspec( interaction )[ 0 ]:
-                        kwargs[ 'cursor' ] = kwargs[ 'conn' ].cursor()
-                    res = interaction( *args, **kwargs )
-                    if not partial_txn:
-                        async_res.set( res )
-                        if cursor and not cursor.closed:
-                            cursor.close()
-                    else:
-                        async_res.set( { 'result': res,
-                                         'connection': conn,
-                                         'cursor': kwargs[ 'cursor' ] } )
-                except DatabaseError, e:
+                        conn = self.conn_pools[ use_pool ].get( priority = priority, deadline = deadline )
+                    cursor = conn.cursor( 'gdbpool_stream_%i' % ( self.stream_ids.next(), ) )
+                    cursor.itersize = itersize
+                    conn.set_query_deadline( query_deadline )
+                    try:
+                        if interaction_args is not None:
+                            cursor.execute( sql, interaction_args )
+                        else:
+                            cursor.execute( sql )
+                    finally:
+                        conn.set_query_deadline( None )
+                except Exception, e:
+                    self._interaction_failed( use_pool, e )
                     if self.do_log:
                         self.logger.info( "exception: %s", ( e, ) )
-                    async_result.set_exception( DBInteractionException( e ) )
+                    if conn and release:
+                        self._put_back( use_pool, conn, e )
+                    async_res.set_exception( self._interaction_error( e ) )
+                    return
+                self._interaction_succeeded( use_pool )
+
+                # the fetches run the query - the deadline bounds them too
+                rows = RowStream( conn, cursor, itersize, self._stream_release( use_pool, release ),
+                                  deadline = query_deadline )
+                if stream_queue is None:
+                    async_res.set( rows )
+                    return
+                row_count = 0
+                try:
+                    for row in rows:
+                        if cancel_event is not None and cancel_event.is_set():
+                            break
+                        stream_queue.put( row )
+                        row_count += 1
+                    rows.close()
+                    stream_queue.put( StreamEndException( "Stream ended after %i rows." % ( row_count, ) ) )
+                    async_res.set( row_count )
                 except Exception, e:
+                    self._interaction_failed( use_pool, e )
                     if self.do_log:
                         self.logger.info( "exception: %s", ( e, ) )
-                    async_result.set_exception( DBInteractionException( e ) )
-                finally:
-                    if conn and not partial_txn:
-                        self.conn_pools[ use_pool ].put( conn )
+                    rows.close()
+                    stream_queue.put( self._interaction_error( e ) )
+                    async_res.set_exception( self._interaction_error( e ) )
 
-            gevent.spawn( wrapped_transaction_f, async_result, interaction,
-                          conn = conn, cursor = cursor, *args )
+            self._dispatch( use_pool, async_result, priority, stream_f, async_result,
+                            interaction, conn = conn, *args )
             return async_result
 
         elif isinstance( interaction, StringType ):
             def transaction_f( async_res, sql, conn = None, cursor = None,
                                *args ):
-                try:
-                    if not conn:
-                        conn = self.conn_pools[ use_pool ].get()
-                    if not cursor:
-                        cursor = conn.cursor()
-                    if not dry_run:
-                        if interaction_args is not None:
-                            cursor.execute( sql, interaction_args )
+                pool_name = use_pool
+                attempt = 1
+                while 1:
+                    requested = time()
+                    failure = None
+                    try:
+                        if not conn:
+                            conn = self.conn_pools[ pool_name ].get( priority = priority, deadline = deadline )
+                        if not cursor:
+                            cursor = conn.cursor()
+                        if not dry_run:
+                            started = time()
+                            conn.set_query_deadline( self._query_deadline( query_timeout, deadline ) )
+                            conn.execute( cursor, sql, interaction_args )
+                            if get_result:
+                                res = cursor.fetchall()
+                            else:
+                                res = True
+                            self.metrics.observe( self._query_metric( sql ), time() - started )
+                            self._interaction_succeeded( pool_name, time() - requested )
+                            if cache_key is not None:
+                                self.result_cache.set( cache_key, res, cache_ttl, cache_tags, cache_generation )
+                            if is_write and not partial_txn:
+                                conn.commit()
                         else:
-                            cursor.execute( sql )
-                        if get_result:
-                            res = cursor.fetchall()
+                            res = cursor.mogrify( sql, interaction_args )
+                        if not partial_txn:
+                            cursor.close()
+                            async_res.set( res )
                         else:
-                            res = True
-                        if is_write and not partial_txn:
-                            conn.commit()
-                    else:
-                        res = cursor.mogrify( sql, interaction_args )
-                    if not partial_txn:
-                        cursor.close()
-                        async_res.set( res )
+                            async_res.set( { 'result': res,
+                                             'connection': conn,
+                                             'cursor': cursor} )
+                    except DatabaseError, e:
+                        failure = e
+                        self._interaction_failed( pool_name, e )
+                        if self.do_log:
+                            self.logger.info( "exception: %s", ( e, ) )
+                    except Exception, e:
+                        failure = e
+                        self._interaction_failed( pool_name, e )
+                        traceback.print_exc( file = sys.stdout )
+                        # if is_write and partial_txn: # ??
+                        if conn:
+                            conn.rollback()
+                        if self.do_log:
+                            self.logger.info( "exception: %s", ( e, ) )
+                    finally:
+                        if conn:
+                            conn.set_query_deadline( None )
+                        if conn and not partial_txn:
+                            self._put_back( pool_name, conn, failure )
+                    if failure is None:
+                        return
+                    pool_name = self._retry_pool( retry, failure, attempt, is_write, pool, pool_name, deadline )
+                    if pool_name is None:
+                        async_res.set_exception( self._interaction_error( failure ) )
+                        return
+                    conn = cursor = None
+                    attempt += 1
+
+            self._dispatch( use_pool, async_result, priority, transaction_f,
+                            async_result, interaction, conn = conn,
+                            cursor = cursor, *args )
+            return async_result
+        else:
+            raise DBInteractionException( "%s cannot be run. run() only accepts FunctionTypes, MethodType, and StringTypes" % interacetion )
+
+    def transaction( self, pool = None, iso_level = None, priority = None,
+                     timeout = None, deadline = None, query_timeout = None ):
+        """
+        Start a transaction on one pinned connection
+
+        :param string pool: Keyname of the pool to get the connection from. Defaults to the default write pool.
+        :param iso_level: transaction isolation level (psycopg2.extensions ISOLATION_LEVEL_*)
+        :param int priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW for getting the connection
+        :param float timeout: seconds to wait for a connection
+        :param float deadline: time (as in `time.time()`) after which the connection is not needed anymore
+        :param float query_timeout: Seconds after which each query of the transaction is cancelled. Defaults to the pool's `query_timeout`.
+
+        :rtype: DBTransaction
+        :returns: -- a :class:`DBTransaction` to use as context manager: ``with ipool.transaction() as txn: txn.run( sql, args )``. It commits (or rolls back if the block raised) and puts the connection back onto the pool when the block is left.
+        """
+
+        use_pool = self._use_pool( True, pool )
+        if query_timeout is None:
+            query_timeout = self.query_timeouts.get( use_pool )
+        return DBTransaction( self, use_pool, iso_level = iso_level, priority = priority,
+                              timeout = timeout, deadline = deadline,
+                              query_timeout = query_timeout )
+
+    def run_many( self, sql, seq_of_args, pool = None, page_size = 100,
+                  conn = None, partial_txn = False ):
+        """
+        Run a statement for every args in `seq_of_args` on one connection in
+        one transaction.
+
+        The executions are sent in pages of `page_size`: a single row
+        ``INSERT ... VALUES (...)`` becomes one multi-row INSERT per page, any
+        other statement is sent as the page's executions joined with ``;``
+        in one round trip. `seq_of_args` is consumed lazily - one page at a
+        time.
+
+        :param string sql: The statement to run. (with placeholders for the args)
+        :param seq_of_args: iterable of args (sequences or mappings) for `sql`
+        :param string pool: Keyname of the pool to get the a connection from. Defaults to the default write pool.
+        :param int page_size: Number of executions per round trip
+        :param connection conn: Pass in a `Connection` instead of getting one from the pool. (see :meth:`.run`)
+        :param bool partial_txn: Do not commit and return connection and cursor with the result (see :meth:`.run`)
+
+        :rtype: gevent.AsyncResult
+        :returns: -- a :class:`gevent.AsyncResult` that will hold the list of row counts per page. When `partial_txn = True` it will hold a dict with the result, the connection, and the cursor.
+
+        .. note::
+            For pages of joined statements the driver only reports the row count of the page's last statement.
+        """
+
+        def batch_f( conn, cursor ):
+            row_counts = []
+            for statement, n in page_statements( cursor, sql, seq_of_args, page_size ):
+                cursor.execute( statement )
+                row_counts.append( cursor.rowcount )
+            return row_counts
+
+        return self._run_bulk( self._use_pool( True, pool ), 'batch:%s' % ( self._query_metric( sql )[ 6: ], ),
+                               batch_f, conn = conn, partial_txn = partial_txn )
+
+    def copy_in( self, table, source, columns = None, pool = None,
+                 sep = '\t', null = '\\N', page_size = 1000, conn = None,
+                 partial_txn = False ):
+        """
+        Bulk load rows into a table (``COPY ... FROM STDIN``) in one transaction.
+
+        `source` is read and encoded incrementally. psycopg2 refuses COPY
+        while the gevent wait callback is installed (see :mod:`psyco_ge`) -
+        then the rows are loaded with multi-row INSERTs of `page_size` rows
+        (see :meth:`.run_many`) instead.
+
+        :param string table: name of the table to load into
+        :param source: a file-like object with data in COPY text format or an iterable of row tuples
+        :param list columns: names of the columns the fields of a row go to. All columns of the table if None.
+        :param string sep: field separator of the COPY text format
+        :param string null: representation of NULL in the COPY text format
+        :param string pool: Keyname of the pool to get the a connection from. Defaults to the default write pool.
+        :param int page_size: Number of rows per INSERT when COPY is not available
+        :param connection conn: Pass in a `Connection` instead of getting one from the pool. (see :meth:`.run`)
+        :param bool partial_txn: Do not commit and return connection and cursor with the result (see :meth:`.run`)
+
+        :rtype: gevent.AsyncResult
+        :returns: -- a :class:`gevent.AsyncResult` that will hold the number of rows loaded
+        """
+
+        column_list = " (%s)" % ( ', '.join( columns ), ) if columns else ""
+
+        def copy_in_f( conn, cursor ):
+            if copy_available( cursor ):
+                if hasattr( source, 'read' ):
+                    f = source
+                else:
+                    f = RowReader( source, sep, null )
+                cursor.copy_expert( "COPY %s%s FROM STDIN WITH DELIMITER AS %s NULL AS %s;" % (
+                                        table, column_list, cursor.mogrify( '%s', ( sep, ) ), cursor.mogrify( '%s', ( null, ) ) ),
+                                    f, size = COPY_CHUNK_SIZE )
+                return cursor.rowcount if cursor.rowcount >= 0 else getattr( f, 'row_count', -1 )
+
+            if hasattr( source, 'read' ):
+                rows = ( decode_copy_line( line, sep, null ) for line in iter_copy_lines( source ) )
+            else:
+                rows = iter( source )
+            try:
+                first = rows.next()
+            except StopIteration:
+                return 0
+            sql = "INSERT INTO %s%s VALUES (%s);" % ( table, column_list, ', '.join( [ '%s' ] * len( first ) ) )
+            row_count = 0
+            for statement, n in page_statements( cursor, sql, chain( [ first ], rows ), page_size ):
+                cursor.execute( statement )
+                row_count += n
+            return row_count
+
+        return self._run_bulk( self._use_pool( True, pool ), 'copy_in:%s' % ( table, ), copy_in_f,
+                               conn = conn, partial_txn = partial_txn )
+
+    def copy_out( self, query, dest = None, query_args = None, columns = None,
+                  pool = None, sep = '\t', null = '\\N', itersize = 2000,
+                  conn = None ):
+        """
+        Export a table or the result of a query in COPY text format
+        (``COPY ... TO STDOUT``).
+
+        Rows are exported incrementally: written to `dest` in chunks or
+        handed back as an iterator of lines. When psycopg2 cannot run COPY
+        (while the gevent wait callback is installed - see :mod:`psyco_ge`)
+        or no `dest` is passed, the rows are fetched from a named
+        server-side cursor `itersize` rows at a time and encoded to the COPY
+        text format on the fly - the cursor hands out the values in their
+        PostgreSQL text representation, so floats, arrays, json, and bytea
+        come out as COPY would write them.
+
+        :param string query: name of a table or a SELECT query
+        :param dest: file-like object to write the data to. If None an iterator of lines is returned.
+        :param query_args: args for the placeholders in `query`
+        :param list columns: names of the columns to export when `query` is a table
+        :param string sep: field separator of the COPY text format
+        :param string null: representation of NULL in the COPY text format
+        :param string pool: Keyname of the pool to get the a connection from. Defaults to the default read pool or one of the read replicas.
+        :param int itersize: Number of rows to fetch per round trip / write per chunk
+        :param connection conn: Pass in a `Connection` instead of getting one from the pool. (see :meth:`.run`)
+
+        :rtype: gevent.AsyncResult
+        :returns: -- a :class:`gevent.AsyncResult` that will hold the number of rows written to `dest` - or a :class:`RowStream` yielding the lines (including the newline) if `dest` is None. The connection goes back onto the pool once it is exhausted or closed (ie. at the end of a ``with`` statement).
+        """
+
+        async_result = AsyncResult()
+        use_pool = self._use_pool( False, pool )
+        is_query = COPY_QUERY_RE.match( query ) is not None
+        column_list = ', '.join( columns ) if columns else None
+
+        def copy_out_f( async_res, conn = None ):
+            release = not conn
+            try:
+                if not conn:
+                    conn = self.conn_pools[ use_pool ].get()
+                cursor = conn.cursor()
+                if dest is not None and copy_available( cursor ):
+                    if is_query:
+                        copy_source = "(%s)" % ( cursor.mogrify( query.strip().rstrip( ';' ), query_args ), )
                     else:
-                        async_res.set( { 'result': res,
-                                         'connection': conn,
-                                         'cursor': cursor} )
-                except DatabaseError, e:
-                    if self.do_log:
-                        self.logger.info( "exception: %s", ( e, ) )
-                    async_result.set_exception( DBInteractionException( e ) )
-                except Exception, e:
-                    traceback.print_exc( file = sys.stdout )
-                    # if is_write and partial_txn: # ??
-                    conn.rollback()
-                    if self.do_log:
-                        self.logger.info( "exception: %s", ( e, ) )
-                    async_result.set_exception( DBInteractionException( e ) )
-                finally:
-                    if conn and not partial_txn:
+                        copy_source = "%s (%s)" % ( query, column_list ) if column_list else query
+                    cursor.copy_expert( "COPY %s TO STDOUT WITH DELIMITER AS %s NULL AS %s;" % (
+                                            copy_source, cursor.mogrify( '%s', ( sep, ) ), cursor.mogrify( '%s', ( null, ) ) ),
+                                        dest, size = COPY_CHUNK_SIZE )
+                    row_count = cursor.rowcount
+                    cursor.close()
+                    self._interaction_succeeded( use_pool )
+                    if release:
+                        conn.rollback()
                         self.conn_pools[ use_pool ].put( conn )
+                    async_res.set( row_count )
+                    return
+                cursor.close()
+                # plain tuple rows - the pool's cursors return dicts
+                cursor = conn.conn.cursor( 'gdbpool_copy_%i' % ( self.stream_ids.next(), ) )
+                cursor.itersize = itersize
+                # the values as text - as COPY would write them
+                register_text_casts( cursor )
+                if is_query:
+                    cursor.execute( query, query_args )
+                else:
+                    cursor.execute( "SELECT %s FROM %s;" % ( column_list or '*', query ) )
+            except Exception, e:
+                self._interaction_failed( use_pool, e )
+                if self.do_log:
+                    self.logger.info( "exception: %s", ( e, ) )
+                if conn and release:
+                    self._put_back( use_pool, conn, e )
+                async_res.set_exception( self._interaction_error( e ) )
+                return
+            self._interaction_succeeded( use_pool )
+
+            lines = RowStream( conn, cursor, itersize, self._stream_release( use_pool, release ),
+                               transform = lambda row: encode_copy_row( row, sep, null ) )
+            if dest is None:
+                async_res.set( lines )
+                return
+            row_count = 0
+            try:
+                chunk = []
+                for line in lines:
+                    chunk.append( line )
+                    if len( chunk ) >= itersize:
+                        dest.write( ''.join( chunk ) )
+                        row_count += len( chunk )
+                        chunk = []
+                if chunk:
+                    dest.write( ''.join( chunk ) )
+                    row_count += len( chunk )
+                async_res.set( row_count )
+            except Exception, e:
+                self._interaction_failed( use_pool, e )
+                if self.do_log:
+                    self.logger.info( "exception: %s", ( e, ) )
+                lines.close()
+                async_res.set_exception( self._interaction_error( e ) )
+
+        self._dispatch( use_pool, async_result, PRIORITY_NORMAL, copy_out_f, async_result, conn = conn )
+        return async_result
+
+    def _use_pool( self, is_write, pool ):
+        # name of the pool an interaction runs on
+        if is_write:
+            return self.default_write_pool if pool is None else pool
+        elif pool is None and self.replica_balancer.replicas:
+            return self.replica_balancer.choose( self.conn_pools, self.breakers ) or self.default_read_pool
+        else:
+            return self.default_read_pool if pool is None else pool
 
-            gevent.spawn( transaction_f, async_result, interaction,
-                          conn = conn, cursor = cursor, *args )
-            return async_result
+    def _run_bulk( self, use_pool, metric, f, conn = None, partial_txn = False ):
+        """
+        Run `f( conn, cursor )` on one connection of `use_pool` and commit.
+        Returns an AsyncResult for the return value of `f`.
+        """
+
+        async_result = AsyncResult()
+
+        def bulk_f( async_res, conn = None ):
+            release = not conn
+            try:
+                if not conn:
+                    conn = self.conn_pools[ use_pool ].get()
+                cursor = conn.cursor()
+                started = time()
+                res = f( conn, cursor )
+                if not partial_txn:
+                    conn.commit()
+                self.metrics.observe( metric, time() - started )
+                self._interaction_succeeded( use_pool )
+                if not partial_txn:
+                    cursor.close()
+                    async_res.set( res )
+                else:
+                    async_res.set( { 'result': res,
+                                     'connection': conn,
+                                     'cursor': cursor } )
+            except Exception, e:
+                self._interaction_failed( use_pool, e )
+                if self.do_log:
+                    self.logger.info( "exception: %s", ( e, ) )
+                if conn and release:
+                    try:
+                        conn.rollback()
+                    except DatabaseError:
+                        pass
+                    self._put_back( use_pool, conn, e )
+                    conn = None
+                async_res.set_exception( self._interaction_error( e ) )
+            finally:
+                if conn and release and not partial_txn:
+                    self.conn_pools[ use_pool ].put( conn )
+
+        self._dispatch( use_pool, async_result, PRIORITY_NORMAL, bulk_f, async_result, conn = conn )
+        return async_result
+
+    def _landed( self, key, async_result ):
+        # a coalesced interaction finished - later callers run it again
+        if self.in_flight.get( key ) is async_result:
+            del self.in_flight[ key ]
+
+    def _query_deadline( self, query_timeout, deadline ):
+        # when the queries of an interaction get cancelled
+        if query_timeout is None:
+            return deadline
+        if deadline is None:
+            return time() + query_timeout
+        return min( time() + query_timeout, deadline )
+
+    def _interaction_error( self, e ):
+        # the exception to hand to the caller
+        if isinstance( e, DBInteractionException ):
+            return e
+        if isinstance( e, QueryCanceledError ):
+            return DBInteractionTimeoutException( e )
+        return DBInteractionException( e )
+
+    def _put_back( self, pool_name, conn, e = None ):
+        # a connection an interaction failed on with a connection error is
+        # closed instead of going back onto the pool for the next request
+        self.conn_pools[ pool_name ].put( conn, force_recycle = e is not None and is_connection_error( e ) )
+
+    def _retry_pool( self, retry, e, attempt, is_write, pool, pool_name, deadline ):
+        """
+        Back off and return the name of the pool to run an interaction that
+        failed with `e` on again - or None if it is not retried.
+        """
+        if not retry or not retry.should_retry( e, attempt, is_write ):
+            return None
+        delay = retry.delay( attempt )
+        if deadline is not None and time() + delay >= deadline:
+            return None
+        self.metrics.incr( 'retries' )
+        gevent.sleep( delay )
+        if pool is None and not is_write:
+            # fail over to another read replica - the failed one got ejected
+            pool_name = self._use_pool( False, None )
+        if self._circuit_open( pool_name ) is not None:
+            return None
+        return pool_name
+
+    def _circuit_open( self, pool_name ):
+        """
+        Returns the :class:`DBPoolCircuitOpenException` to fail a request for
+        `pool_name` with while the pool's circuit breaker is open - or None.
+        """
+        breaker = self.breakers.get( pool_name )
+        if breaker is None or breaker.allow():
+            return None
+        self.metrics.incr( 'circuit_open' )
+        return DBPoolCircuitOpenException( "The circuit breaker of pool %s is open. Retry in %.1f seconds." % (
+                                           pool_name, breaker.retry_after() ) )
+
+    def _interaction_succeeded( self, pool_name, latency = None ):
+        # bookkeeping for an interaction the database answered
+        self.breakers[ pool_name ].record_success()
+        if latency is not None:
+            self.replica_balancer.report_success( pool_name, latency )
+
+    def _interaction_failed( self, pool_name, e ):
+        # bookkeeping for a failed interaction
+        self.metrics.incr( 'errors' )
+        if isinstance( e, QueryCanceledError ):
+            self.metrics.incr( 'query_timeouts' )
+        if is_connection_error( e ):
+            self.metrics.incr( 'connection_errors' )
+            self.replica_balancer.report_failure( pool_name )
+        breaker = self.breakers.get( pool_name )
+        if breaker is None:
+            return
+        if is_connection_error( e ) or isinstance( e, QueryCanceledError ):
+            breaker.record_failure()
+        elif isinstance( e, DatabaseError ):
+            # an error in the query - the database is answering
+            breaker.record_success()
+
+    def _query_metric( self, sql ):
+        # fingerprinting is a couple of regexes - only do it once per query
+        name = self.fingerprints.get( sql )
+        if name is None:
+            if len( self.fingerprints ) > 10000:
+                self.fingerprints = {}
+            name = self.fingerprints[ sql ] = 'query:%s' % ( sql_fingerprint( sql ), )
+        return name
+
+    def _listener_queue_depths( self ):
+        depths = {}
+        for listener in self.active_listeners.values():
+            for channel_name, subscribers in listener.subscribers.items():
+                depths.setdefault( channel_name, [] ).extend( [ s[ 0 ].qsize() for s in subscribers.values() ] )
+        return depths
+
+    def metrics_snapshot( self ):
+        """
+        Snapshot of the interaction metrics and the metrics of all managed
+        `DBConnectionPool` instances.
+
+        :rtype: dict
+        :returns: {'interactions': <snapshot>, 'pools': {<pool_name>: <snapshot>}} - see :meth:`MetricsRegistry.snapshot`
+        """
+        return { 'interactions': self.metrics.snapshot(),
+                 'pools': dict( [ ( name, pool.metrics.snapshot() ) for name, pool in self.conn_pools.items() ] ) }
+
+    def _stream_release( self, pool_name, release ):
+        """
+        Returns the function a :class:`RowStream` hands its connection to
+        when it ends - rolls back and puts the connection back onto the pool
+        (or closes it if the stream broke it). None if the connection was
+        passed in and stays with the caller.
+        """
+        if not release:
+            return None
+
+        def release_f( conn, e ):
+            if e is None:
+                try:
+                    conn.rollback()
+                except Error, e:
+                    pass
+            if e is not None and self.do_log:
+                self.logger.info( "exception closing stream: %s", ( e, ) )
+            self._put_back( pool_name, conn, e )
+
+        return release_f
+
+    def _dispatch( self, pool_name, async_result, priority, f, *args, **kwargs ):
+        """
+        Run `f` on a new greenlet or - if the pool has an executor - queue it
+        with `priority` for one of the pool's workers. Requests that would
+        need a connection of a pool whose circuit breaker is open fail right
+        away. Requests that bring their own connection (ie. the continuation
+        of a `partial_txn`) always get a new greenlet: queued behind workers
+        that wait for that very connection they could never run.
+        """
+        if kwargs.get( 'conn' ) is None:
+            e = self._circuit_open( pool_name )
+            if e is not None:
+                async_result.set_exception( e )
+                return
+        executor = self.executors.get( pool_name )
+        if executor is None or kwargs.get( 'conn' ) is not None:
+            gevent.spawn( f, *args, **kwargs )
         else:
-            raise DBInteractionException( "%s cannot be run. run() only accepts FunctionTypes, MethodType, and StringTypes" % interacetion )
+            try:
+                executor.submit_with_priority( priority, f, *args, **kwargs )
+            except DBPoolQueueFullException, e:
+                self.metrics.incr( 'rejected' )
+                if self.do_log:
+                    self.logger.info( "rejected request: %s", ( e, ) )
+                async_result.set_exception( e )
+
+    def invalidate_cache_on( self, channel_name, pool = None, cancel_event = None ):
+        """
+        Invalidate cached results when a notification arrives on a channel.
+        The payload is the tag of the results to drop (ie. sent by a trigger
+        with ``pg_notify( 'cache_invalidation', TG_TABLE_NAME )``). An empty
+        payload drops all cached results.
+
+        :param string channel_name: Name of the channel to LISTEN on
+        :param string pool: Name of the pool to get the listener connection from
+        :param gevent.Event cancel_event: A :class:`gevent.Event` which stops the invalidation when set
+
+        :rtype: ChannelSubscription
+        :returns: -- a :class:`ChannelSubscription` handle. Call its `close()` to stop the invalidation.
+        """
+
+        return self.listen_on( self.result_cache, channel_name, pool = pool,
+                               cancel_event = cancel_event, unmarshaller = 'raw' )
 
     def listen_on( self, result_queue = None, channel_name = None, pool = None,
-                   cancel_event = None, sleep_cycle = 0.1 ):
+                   cancel_event = None, sleep_cycle = None,
+                   unmarshaller = 'pipe_colon', batch = False ):
         """
         Listen for asynchronous events on a named Channel and pass them to the result_queue
 
-        :param gevent.Queue result_queue: The :class:`gevent.Queue` to pass event payloads to
+        :param gevent.Queue result_queue: The :class:`gevent.Queue` to pass event payloads to. A new Queue is created if None.
         :param string channel_name: Name of the channel to LISTEN on
-        :param string pool: Name of the pool to get the connection from
-        :param gevent.Event cancel_event: A :class:`gevent.Event` which will break the listening loop when set
+        :param string pool: Name of the pool to get the connection from. All channels of a pool share one listener connection.
+        :param gevent.Event cancel_event: A :class:`gevent.Event` which unsubscribes the result_queue when set
+        :param sleep_cycle: deprecated - ignored. Cancellation no longer polls.
+        :param string|function unmarshaller: How to unmarshall the payloads: 'pipe_colon' (default), 'json', 'msgpack' (base64 encoded), 'raw' or a function taking the payload string
+        :param bool batch: Put one list of all payloads received in a poll onto the result_queue instead of one payload at a time
+
+        :rtype: ChannelSubscription
+        :returns: -- a :class:`ChannelSubscription` handle. Call its `close()` (or set the cancel_event) to stop listening. The handle's `queue` is the result_queue.
         """
 
-        if self.db_module != 'psycopg2':
-            raise DBInteractionException( "This feature requires PostgreSQL 9.x." )
         use_pool = self.default_write_pool if pool is None else pool
+        if result_queue is None:
+            result_queue = Queue( maxsize = None )
         try:
-            def start_listener():
-                self.active_listeners[ channel_name ] = PGChannelListener( result_queue, self.conn_pools[ use_pool ], channel_name )
-
-            # do we need a listen loop for all PGChannelListeners? maybe one is enough...
-            def listen( result_queue, cancel_event ):
-                while 1:
-                    if cancel_event.is_set():
-                        self.active_listeners[ channel_name ].unregister_queue( id( result_queue ) )
-                        if self.do_log:
-                            self.logger.info( "stopped listening on: %s", ( channel_name, ) )
-                        break
-                    gevent.sleep( sleep_cycle )
-
-            listener_jobs = [ gevent.spawn( start_listener ),
-                              gevent.spawn( listen, result_queue, cancel_event ) ]
-            gevent.joinall( listener_jobs )
+            listener = PGChannelListener( result_queue, self.conn_pools[ use_pool ], channel_name,
+                                          unmarshaller = unmarshaller, batch = batch )
         except Exception, e:
-            print "# FRAKK", e
             if self.do_log:
                 self.logger.info( e )
+            raise DBInteractionException( e )
+        self.active_listeners[ use_pool ] = listener
+        subscription = ChannelSubscription( listener, result_queue, channel_name,
+                                            cancel_event = cancel_event )
+        if self.do_log:
+            self.logger.info( "listening on: %s", ( channel_name, ) )
+        return subscription
 
 
 
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# MetricsRegistry - counters, latency histograms and gauges for the pools
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import re
+
+from bisect import bisect_left
+
+
+# 100us, 200us, 400us, ... ~52s
+HISTOGRAM_BOUNDS = tuple( [ 0.0001 * 2 ** i for i in xrange( 20 ) ] )
+
+FINGERPRINT_LITERALS_RE = re.compile( r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b" )
+FINGERPRINT_SPACE_RE = re.compile( r"\s+" )
+
+
+def sql_fingerprint( sql, max_length = 200 ):
+    """
+    Normalize a query for grouping its metrics: literals are replaced by
+    ``?`` and whitespace is collapsed.
+
+    :param string sql: the query
+    :param int max_length: truncate the fingerprint to this many characters
+    :rtype: string
+    """
+
+    sql = FINGERPRINT_LITERALS_RE.sub( '?', sql )
+    return FINGERPRINT_SPACE_RE.sub( ' ', sql ).strip()[ :max_length ]
+
+
+class Histogram( object ):
+    """
+    Latency histogram with fixed, exponentially growing buckets.
+
+    Recording a value is a bisect and a few additions. Percentiles are
+    estimated as the upper bound of the bucket they fall into.
+    """
+
+    __slots__ = ( 'counts', 'count', 'total', 'min', 'max' )
+
+    def __init__( self ):
+        self.counts = [ 0 ] * ( len( HISTOGRAM_BOUNDS ) + 1 )
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe( self, value ):
+        self.counts[ bisect_left( HISTOGRAM_BOUNDS, value ) ] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile( self, p ):
+        """
+        :param float p: percentile between 0 and 100
+        :returns: upper bound of the bucket the percentile falls into (the max for the last bucket) or None if nothing was recorded
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate( self.counts ):
+            seen += n
+            if seen >= rank and n:
+                return min( HISTOGRAM_BOUNDS[ i ], self.max ) if i < len( HISTOGRAM_BOUNDS ) else self.max
+        return self.max
+
+    def snapshot( self ):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile( 50 ),
+            'p90': self.percentile( 90 ),
+            'p99': self.percentile( 99 ),
+        }
+
+
+class MetricsRegistry( object ):
+    """
+    Counters, latency histograms and gauges of a pool.
+
+    Recording is a dict lookup plus an addition (a bisect for histograms) so
+    the registry can stay on in production. Gauges are functions that are
+    only called when a snapshot is taken. Hooks are called with
+    ``( kind, name, value )`` for every recorded value - ie. to forward
+    metrics to statsd - and cost nothing when there are none.
+    """
+
+    def __init__( self, max_histograms = 1000 ):
+        """
+        :param int max_histograms: Maximum number of distinct histograms. Values for further names are recorded under 'other'.
+        """
+        self.max_histograms = max_histograms
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.hooks = []
+
+    def incr( self, name, value = 1 ):
+        """
+        Increment the counter `name`
+        """
+        self.counters[ name ] = self.counters.get( name, 0 ) + value
+        if self.hooks:
+            self._call_hooks( 'counter', name, value )
+
+    def observe( self, name, value ):
+        """
+        Record `value` (ie. a duration in seconds) in the histogram `name`
+        """
+        histogram = self.histograms.get( name )
+        if histogram is None:
+            if len( self.histograms ) >= self.max_histograms:
+                name = 'other'
+                histogram = self.histograms.get( name )
+            if histogram is None:
+                histogram = self.histograms[ name ] = Histogram()
+        histogram.observe( value )
+        if self.hooks:
+            self._call_hooks( 'histogram', name, value )
+
+    def gauge( self, name, f ):
+        """
+        Register a gauge: `f()` is called for its value on :meth:`.snapshot`
+        """
+        self.gauges[ name ] = f
+
+    def add_hook( self, hook ):
+        """
+        Register a callback `hook( kind, name, value )` that is called for every recorded counter increment ('counter') or histogram value ('histogram')
+        """
+        self.hooks.append( hook )
+
+    def remove_hook( self, hook ):
+        self.hooks.remove( hook )
+
+    def _call_hooks( self, kind, name, value ):
+        for hook in self.hooks:
+            try:
+                hook( kind, name, value )
+            except Exception:
+                pass
+
+    def snapshot( self ):
+        """
+        :rtype: dict
+        :returns: the current 'counters', 'histograms' (count, sum, min, max, mean, p50, p90, p99) and 'gauges'
+        """
+        gauges = {}
+        for name, f in self.gauges.items():
+            try:
+                gauges[ name ] = f()
+            except Exception, e:
+                gauges[ name ] = None
+        return {
+            'counters': dict( self.counters ),
+            'histograms': dict( [ ( name, h.snapshot() ) for name, h in self.histograms.items() ] ),
+            'gauges': gauges,
+        }
+
+    def reset( self ):
+        """
+        Reset all counters and histograms. Gauges and hooks are kept.
+        """
+        self.counters = {}
+        self.histograms = {}
@@ -10,17 +10,28 @@ __version__ = "0.1.3"
 
 
 import gevent
-from gevent import monkey; monkey.patch_all()
 
 import psycopg2
 import sys, traceback
 
-from psyco_ge import make_psycopg_green; make_psycopg_green()
-assert 'gdbpool.psyco_ge' in sys.modules.keys()
+from psyco_ge import set_deadline
+from gdbpool_setup import setup
 from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_COMMITTED
 from time import time
 
 from gdbpool_error import PoolConnectionException
+from statement_cache import StatementCache
+
+
+# DISCARD ALL without DEALLOCATE ALL (which would drop the prepared
+# statements of the statement cache) and DISCARD PLANS (which would make
+# them all re-plan on their next execution - the server invalidates plans
+# that schema changes affect anyway)
+RESET_SESSION_SQL = "CLOSE ALL; SET SESSION AUTHORIZATION DEFAULT; RESET ALL; UNLISTEN *; " \
+                    "SELECT pg_advisory_unlock_all(); DISCARD TEMP; DISCARD SEQUENCES;"
+# only runs outside a transaction block - ie. on its own in autocommit mode
+DISCARD_ALL_SQL = "DISCARD ALL;"
 
 
 class PoolConnection( object ):
@@ -29,37 +40,186 @@ class PoolConnection( object ):
 
     On object initialization the object initializes the DB connection
     (a standard Db-API connection object).
-    Direct access to the object is only possible when the member name
-    is prefixed with "PoolConnection\_". Otherwise member access goes
-    to the 'inner' connection object.
+    The methods used on every interaction (`cursor`, `commit`, `rollback`,
+    `reset`, `close`, `set_isolation_level`, ...) and the connection state
+    attributes are delegated explicitly. Any other member access falls
+    through to the 'inner' connection object. The wrapper's own members can
+    still be accessed with the old "PoolConnection\_" prefix.
+
+    The isolation level (and with that the autocommit state) is tracked
+    client-side so setting the level the connection already has costs
+    nothing.
     """
 
-    def __init__( self, db_module, dsn, cursor_type = None ):
+    __slots__ = ( 'db_module_name', 'cursor_type', 'db_module', 'conn',
+                  'initialized_at', 'stmt_cache', 'idle_since', 'expires_at',
+                  'checked_at', 'checked_out_at', 'iso_level', 'priority',
+                  '__weakref__' )
+
+    def __init__( self, db_module, dsn, cursor_type = None,
+                  stmt_cache_size = 0, stmt_cache_stats = None ):
+        """
+        :param string db_module: name of the DB-API module to use
+        :param string dsn: DSN to connect to
+        :param cursor_type: cursor_factory for new cursors (default: RealDictCursor)
+        :param int stmt_cache_size: Number of prepared statements to cache on the connection. 0 disables the cache.
+        :param dict stmt_cache_stats: hits/misses/evictions counters the statement cache updates
+        """
         self.db_module_name = db_module
+        if cursor_type is None and db_module == 'psycopg2':
+            cursor_type = RealDictCursor
         self.cursor_type = cursor_type
         self.db_module = sys.modules[ db_module ]
+        self.stmt_cache = StatementCache( stmt_cache_size, stmt_cache_stats ) if stmt_cache_size else None
+        self.idle_since = None
+        self.expires_at = None
+        self.checked_at = None
+        self.checked_out_at = None
+        self.priority = None
+        # new sessions start with the server default
+        self.iso_level = ISOLATION_LEVEL_READ_COMMITTED
+        setup( patch_all = False )
         try:
-            self.conn = self.PoolConnection_db_module.connect( dsn )
+            self.conn = self.db_module.connect( dsn )
             self.initialized_at = time()
         except Exception, e:
             raise PoolConnectionException( "PoolConnection failed: Could not connect to database: %s" % e )
 
-    def __getattribute__( self, name ):
-        if name.startswith( 'PoolConnection_' ) or name == 'cursor':
-            if name == 'cursor':
-                return object.__getattribute__( self, name )
-            else:
-                return object.__getattribute__( self, name[15:] )
-        else:
-            return object.__getattribute__( self.PoolConnection_conn, name )
+    def __getattr__( self, name ):
+        # only called for names that are not found on the wrapper itself
+        if name.startswith( 'PoolConnection_' ):
+            return getattr( self, name[ 15: ] )
+        if name == 'conn':
+            raise AttributeError( name )
+        return getattr( self.conn, name )
 
     def cursor( self, *args, **kwargs ):
-        if self.PoolConnection_db_module_name == 'psycopg2':
-            kwargs[ 'cursor_factory' ] = RealDictCursor if self.PoolConnection_cursor_type is None else self.PoolConnection_cursor_type
-            return self.PoolConnection_conn.cursor( *args, **kwargs )
+        if self.cursor_type is not None:
+            kwargs[ 'cursor_factory' ] = self.cursor_type
+        return self.conn.cursor( *args, **kwargs )
         # deprecated
         #elif self.PoolConnection_db_module_name == 'MySQLdb':
         #    args.append( MySQLdb.cursors.DictCursor if self.PoolConnection_cursor_type is None else self.PoolConnection_cursor_type )
         #    return self.PoolConnection_conn.cursor( *args, **kwargs )
 
+    def commit( self ):
+        return self.conn.commit()
+
+    def rollback( self ):
+        return self.conn.rollback()
+
+    def reset( self ):
+        self.conn.reset()
+        self.iso_level = ISOLATION_LEVEL_READ_COMMITTED
+
+    def close( self ):
+        return self.conn.close()
+
+    def set_isolation_level( self, level ):
+        """
+        Set the isolation level (ISOLATION_LEVEL_AUTOCOMMIT to switch to
+        autocommit) - does nothing if the connection is at that level already.
+        """
+        if level != self.iso_level:
+            self.conn.set_isolation_level( level )
+            self.iso_level = level
+
+    def get_transaction_status( self ):
+        return self.conn.get_transaction_status()
+
+    def poll( self ):
+        return self.conn.poll()
+
+    def fileno( self ):
+        return self.conn.fileno()
+
+    def cancel( self ):
+        return self.conn.cancel()
 
+    def set_query_deadline( self, deadline ):
+        """
+        Cancel the running query on the server once `deadline` (as in
+        `time.time()`) passed. None removes the deadline.
+        """
+        set_deadline( self.conn, deadline )
+
+    @property
+    def isolation_level( self ):
+        return self.iso_level
+
+    @property
+    def closed( self ):
+        return self.conn.closed
+
+    @property
+    def notifies( self ):
+        return self.conn.notifies
+
+    def _get_autocommit( self ):
+        return self.iso_level == ISOLATION_LEVEL_AUTOCOMMIT
+
+    def _set_autocommit( self, value ):
+        if value != ( self.iso_level == ISOLATION_LEVEL_AUTOCOMMIT ):
+            self.conn.autocommit = value
+            self.iso_level = ISOLATION_LEVEL_AUTOCOMMIT if value else ISOLATION_LEVEL_READ_COMMITTED
+
+    autocommit = property( _get_autocommit, _set_autocommit )
+
+    def execute( self, cursor, sql, args = None ):
+        """
+        Execute sql on cursor. Goes through the statement cache if the
+        connection has one.
+        """
+        if self.stmt_cache is not None:
+            self.stmt_cache.execute( self, cursor, sql, args )
+        elif args is not None:
+            cursor.execute( sql, args )
+        else:
+            cursor.execute( sql )
+
+    def ping( self ):
+        """
+        Check the connection is alive with a trivial query. Raises if not.
+        """
+        conn = self.conn
+        cursor = conn.cursor()
+        cursor.execute( "SELECT 1;" )
+        cursor.fetchall()
+        cursor.close()
+        conn.rollback()
+
+    def reset_session( self ):
+        """
+        Reset the connection before it goes back onto the pool: roll back the
+        pending transaction and run what ``DISCARD ALL`` does, so cursors,
+        session settings, LISTENs, advisory locks, temp tables and sequence
+        state do not leak to the next checkout. Connections with a statement
+        cache keep their prepared statements (and plans).
+
+        Unlike `reset()` this keeps the connection's isolation level, so a
+        connection put back with a level other than READ COMMITTED does not
+        have to switch again for the next caller that wants it.
+
+        The reset runs in autocommit mode - one round trip, without a BEGIN
+        and COMMIT around it (the rollback only costs one if a transaction
+        is open).
+        """
+        stmt_cache = self.stmt_cache
+        conn = self.conn
+        try:
+            conn.rollback()
+            autocommit = self.iso_level == ISOLATION_LEVEL_AUTOCOMMIT
+            if not autocommit:
+                conn.autocommit = True
+            try:
+                cursor = conn.cursor()
+                cursor.execute( DISCARD_ALL_SQL if stmt_cache is None else RESET_SESSION_SQL )
+                cursor.close()
+            finally:
+                if not autocommit:
+                    # the isolation level set on the connection stays as it is
+                    conn.autocommit = False
+        except Exception:
+            if stmt_cache is not None:
+                stmt_cache.clear()
+            raise
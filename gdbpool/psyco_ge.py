@@ -27,7 +27,14 @@ Use `make_psycopg_green()` to enable gevent support in Psycopg.
 import psycopg2
 from psycopg2 import extensions
 
-from gevent.socket import wait_read, wait_write
+from gevent.socket import wait_read, wait_write, timeout as socket_timeout
+from time import time
+
+# seconds a cancelled query gets to stop before the connection is given up
+CANCEL_GRACE = 5
+
+# connection -> time after which its running query is cancelled
+_deadlines = {}
 
 def make_psycopg_green():
     """Configure Psycopg to be used with gevent in non-blocking way."""
@@ -38,16 +45,49 @@ def make_psycopg_green():
 
     extensions.set_wait_callback(gevent_wait_callback)
 
+def set_deadline(conn, deadline):
+    """Cancel whatever `conn` runs once `deadline` (as in `time.time()`)
+    passed. None removes the deadline."""
+    if deadline is None:
+        _deadlines.pop(conn, None)
+    else:
+        _deadlines[conn] = deadline
+
 def gevent_wait_callback(conn, timeout=None):
-    """A wait callback useful to allow gevent to work with Psycopg."""
+    """A wait callback useful to allow gevent to work with Psycopg.
+
+    If a deadline is set for the connection (see `set_deadline()`) and it
+    passes, the query is cancelled on the server and the callback keeps
+    waiting for the resulting error. If the server does not react within
+    `CANCEL_GRACE` seconds QueryCanceledError is raised, which makes
+    Psycopg close the connection."""
+    deadline = _deadlines.get(conn)
+    cancelled = False
     while 1:
         state = conn.poll()
         if state == extensions.POLL_OK:
             break
-        elif state == extensions.POLL_READ:
-            wait_read(conn.fileno(), timeout=timeout)
-        elif state == extensions.POLL_WRITE:
-            wait_write(conn.fileno(), timeout=timeout)
-        else:
-            raise psycopg2.OperationalError(
-                "Bad result from poll: %r" % state)
+        wait = timeout
+        if deadline is not None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                if cancelled:
+                    raise extensions.QueryCanceledError(
+                        "query did not stop after being cancelled")
+                conn.cancel()
+                cancelled = True
+                deadline = time() + CANCEL_GRACE
+                continue
+            if wait is None or remaining < wait:
+                wait = remaining
+        try:
+            if state == extensions.POLL_READ:
+                wait_read(conn.fileno(), timeout=wait)
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno(), timeout=wait)
+            else:
+                raise psycopg2.OperationalError(
+                    "Bad result from poll: %r" % state)
+        except socket_timeout:
+            if deadline is None or deadline > time():
+                raise
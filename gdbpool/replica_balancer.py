@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# ReplicaBalancer - picks one of several read replica pools for read
+# interactions
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+from itertools import count
+from time import time
+
+from gdbpool_error import DBInteractionException
+
+
+def round_robin( balancer, candidates, conn_pools ):
+    """
+    Use the replicas in turn
+    """
+
+    return candidates[ balancer.turns.next() % len( candidates ) ]
+
+
+def least_outstanding( balancer, candidates, conn_pools ):
+    """
+    Use the replica with the fewest checked out connections and waiters
+    """
+
+    return min( candidates, key = lambda p: conn_pools[ p ].in_use + len( conn_pools[ p ].waiters ) )
+
+
+def lowest_latency( balancer, candidates, conn_pools ):
+    """
+    Use the replica with the lowest observed latency (exponentially weighted
+    moving average). Replicas without observations are tried first.
+    """
+
+    return min( candidates, key = lambda p: balancer.latency.get( p, 0.0 ) )
+
+
+STRATEGIES = {
+    'round_robin': round_robin,
+    'least_outstanding': least_outstanding,
+    'lowest_latency': lowest_latency,
+}
+
+
+class ReplicaBalancer( object ):
+    """
+    Picks one of the read replica pools of a `DBInteractionPool` for read
+    interactions.
+
+    Replicas that fail with connection errors are ejected for `eject_for`
+    seconds and re-admitted afterwards. (A failure after re-admission ejects
+    them again.) Replicas whose circuit breaker is open are not used either.
+    """
+
+    def __init__( self, strategy = 'round_robin', eject_for = 30,
+                  latency_decay = 0.2 ):
+        """
+        :param string|function strategy: 'round_robin', 'least_outstanding', 'lowest_latency' or a function `f( balancer, candidates, conn_pools )` returning one of the candidate pool names
+        :param int eject_for: Seconds a failing replica is not used
+        :param float latency_decay: Weight of a new latency observation in the moving average
+        """
+        self.replicas = []
+        self.eject_for = eject_for
+        self.latency_decay = latency_decay
+        self.ejected_until = {}
+        self.latency = {}
+        self.turns = count()
+        self.set_strategy( strategy )
+
+    def set_strategy( self, strategy ):
+        """
+        :param string|function strategy: see :meth:`.__init__`
+        """
+        if callable( strategy ):
+            self.strategy = strategy
+        elif STRATEGIES.has_key( strategy ):
+            self.strategy = STRATEGIES[ strategy ]
+        else:
+            raise DBInteractionException( "Unknown read replica strategy: %s" % ( strategy, ) )
+
+    def add( self, pool_name ):
+        if pool_name not in self.replicas:
+            self.replicas.append( pool_name )
+
+    def remove( self, pool_name ):
+        if pool_name in self.replicas:
+            self.replicas.remove( pool_name )
+        self.ejected_until.pop( pool_name, None )
+        self.latency.pop( pool_name, None )
+
+    def available( self, breakers = None ):
+        """
+        :param dict breakers: the `CircuitBreaker` instances by pool name
+        :returns: the replicas that are not ejected (and whose circuit breaker is not open)
+        """
+        now = time()
+        return [ p for p in self.replicas if self.ejected_until.get( p, 0 ) <= now
+                 and not ( breakers and p in breakers and breakers[ p ].is_open() ) ]
+
+    def choose( self, conn_pools, breakers = None ):
+        """
+        :param dict conn_pools: the `DBConnectionPool` instances by name
+        :param dict breakers: the `CircuitBreaker` instances by pool name
+        :returns: the name of the replica pool to use or None if there is no available replica
+        """
+        candidates = self.available( breakers )
+        if not candidates:
+            return None
+        if len( candidates ) == 1:
+            return candidates[ 0 ]
+        return self.strategy( self, candidates, conn_pools )
+
+    def report_success( self, pool_name, latency ):
+        """
+        Record the latency of a successful interaction on a replica
+        """
+        if pool_name not in self.replicas:
+            return
+        previous = self.latency.get( pool_name )
+        if previous is None:
+            self.latency[ pool_name ] = latency
+        else:
+            self.latency[ pool_name ] = previous + self.latency_decay * ( latency - previous )
+
+    def report_failure( self, pool_name ):
+        """
+        Eject a replica after a connection failure
+        """
+        if pool_name not in self.replicas:
+            return
+        self.ejected_until[ pool_name ] = time() + self.eject_for
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# ResultCache - in-process LRU cache of query results with TTL and tags
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+from collections import OrderedDict
+from time import time
+
+
+def freeze_args( args ):
+    """
+    Turn query args (sequences, mappings, nested) into something hashable to
+    use them in a cache key.
+    """
+
+    if isinstance( args, dict ):
+        return tuple( sorted( [ ( k, freeze_args( v ) ) for k, v in args.items() ] ) )
+    if isinstance( args, ( list, tuple ) ):
+        return tuple( [ freeze_args( a ) for a in args ] )
+    if isinstance( args, ( set, frozenset ) ):
+        return frozenset( [ freeze_args( a ) for a in args ] )
+    return args
+
+
+class ResultCache( object ):
+    """
+    Size bounded LRU cache of query results with a TTL per entry.
+
+    Entries can be tagged (ie. with the names of the tables a query reads)
+    and invalidated by tag. The cache can be subscribed to a channel of a
+    :class:`PGChannelListener` like a Queue (it has `put` and `qsize`): a
+    payload invalidates the entries tagged with it, an empty payload
+    invalidates everything.
+
+    Cached results are shared by all callers - they must not be modified.
+    """
+
+    def __init__( self, max_size = 1000, default_ttl = 5 ):
+        """
+        :param int max_size: Maximum number of cached results
+        :param float default_ttl: Seconds a result stays valid if no ttl is given for it
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.generation = 0
+        self.stats = { 'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0, 'invalidations': 0 }
+
+    def __len__( self ):
+        return len( self.entries )
+
+    def get( self, key, default = None ):
+        """
+        :returns: the cached result for `key` or `default` if there is none or it expired
+        """
+        entry = self.entries.pop( key, None )
+        if entry is None:
+            self.stats[ 'misses' ] += 1
+            return default
+        expires_at, tags, value = entry
+        if expires_at <= time():
+            self._untag( key, tags )
+            self.stats[ 'expired' ] += 1
+            self.stats[ 'misses' ] += 1
+            return default
+        self.entries[ key ] = entry
+        self.stats[ 'hits' ] += 1
+        return value
+
+    def set( self, key, value, ttl = None, tags = None, generation = None ):
+        """
+        Cache `value` for `key`
+
+        :param float ttl: Seconds the value stays valid. Defaults to `default_ttl`.
+        :param list tags: tags to invalidate the entry by
+        :param int generation: the cache's `generation` when the value was requested. If anything was invalidated since, the value might be stale and is not cached.
+        """
+        if generation is not None and generation != self.generation:
+            return
+        old = self.entries.pop( key, None )
+        if old is not None:
+            self._untag( key, old[ 1 ] )
+        while len( self.entries ) >= self.max_size:
+            evicted_key, evicted = self.entries.popitem( last = False )
+            self._untag( evicted_key, evicted[ 1 ] )
+            self.stats[ 'evictions' ] += 1
+        tags = tuple( tags ) if tags else ()
+        self.entries[ key ] = ( time() + ( self.default_ttl if ttl is None else ttl ), tags, value )
+        for tag in tags:
+            self.tags.setdefault( tag, set() ).add( key )
+
+    def _untag( self, key, tags ):
+        for tag in tags:
+            keys = self.tags.get( tag )
+            if keys is not None:
+                keys.discard( key )
+                if not keys:
+                    del self.tags[ tag ]
+
+    def invalidate( self, tag ):
+        """
+        Drop all entries tagged with `tag`
+        """
+        self.generation += 1
+        self.stats[ 'invalidations' ] += 1
+        for key in self.tags.pop( tag, () ):
+            entry = self.entries.pop( key, None )
+            if entry is not None:
+                self._untag( key, entry[ 1 ] )
+
+    def clear( self ):
+        """
+        Drop all entries
+        """
+        self.generation += 1
+        self.stats[ 'invalidations' ] += 1
+        self.entries.clear()
+        self.tags.clear()
+
+    def put( self, payload, block = True, timeout = None ):
+        """
+        Queue interface for :class:`PGChannelListener` subscriptions: the
+        payload is the tag to invalidate. An empty payload (or one that could
+        not be unmarshalled) clears the whole cache.
+        """
+        if isinstance( payload, list ):
+            for p in payload:
+                self.put( p )
+        elif not payload or isinstance( payload, Exception ):
+            self.clear()
+        else:
+            self.invalidate( payload )
+
+    def qsize( self ):
+        return 0
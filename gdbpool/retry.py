@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# RetryPolicy - which failed interactions to run again and when
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+from random import random
+
+from gdbpool_error import DBPoolConnectionException, PoolConnectionException, is_connection_error, is_serialization_failure
+
+
+class RetryPolicy( object ):
+    """
+    Decides whether an interaction that failed with a transient error runs
+    again - on a fresh connection - and how long to back off before it does.
+
+    * Interactions that could not get a connection at all (nothing was sent
+      to the server yet) are retried.
+    * Read interactions (`is_write = False`) that failed with a connection
+      error are retried if `reads` is set. Without a named pool the retry
+      can go to another read replica. Writes are not: the server might have
+      committed them before the connection broke.
+    * Interactions whose transaction the server rolled back because of a
+      serialization failure or a deadlock are retried if
+      `serialization_failures` is set - reads and writes, a function
+      interaction is called again as a whole.
+
+    The backoff doubles with each attempt (up to `max_backoff`) and is
+    jittered so the retries of concurrent interactions spread out.
+    """
+
+    def __init__( self, attempts = 3, backoff = 0.05, max_backoff = 1.0,
+                  jitter = 0.5, reads = True, serialization_failures = False ):
+        """
+        :param int attempts: maximum number of times an interaction runs (including the first)
+        :param float backoff: seconds to wait before the first retry
+        :param float max_backoff: upper bound of the seconds to wait before a retry
+        :param float jitter: fraction of the backoff that is randomly taken off (0 for none, 1 for "full jitter")
+        :param bool reads: retry read interactions that failed with a connection error
+        :param bool serialization_failures: retry interactions that failed with a serialization failure or deadlock
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.reads = reads
+        self.serialization_failures = serialization_failures
+
+    def should_retry( self, e, attempt, is_write ):
+        """
+        :param Exception e: the exception the interaction failed with
+        :param int attempt: number of the attempt that failed (starting at 1)
+        :param bool is_write: if the interaction has side-effects
+        :rtype: bool
+        """
+        if attempt >= self.attempts:
+            return False
+        if isinstance( e, ( PoolConnectionException, DBPoolConnectionException ) ):
+            return True
+        if is_serialization_failure( e ):
+            return self.serialization_failures
+        if is_connection_error( e ):
+            return self.reads and not is_write
+        return False
+
+    def delay( self, attempt ):
+        """
+        :param int attempt: number of the attempt that failed (starting at 1)
+        :rtype: float
+        :returns: seconds to wait before the next attempt
+        """
+        delay = min( self.max_backoff, self.backoff * 2 ** ( attempt - 1 ) )
+        return delay - delay * self.jitter * random()
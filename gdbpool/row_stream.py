@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# RowStream - the rows of a server-side cursor, fetched incrementally
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import gevent
+import warnings
+import weakref
+
+from psycopg2 import Error
+
+
+# weak references to the streams that still hold a connection. the
+# references live here and not on the streams so their callbacks also run
+# for streams that are part of a reference cycle.
+_unclosed = set()
+
+
+def _close( conn, cursor, release, e = None ):
+    try:
+        cursor.close()
+    except Error, close_error:
+        if e is None:
+            e = close_error
+    if release is not None:
+        release( conn, e )
+
+
+def _on_collected( conn, cursor, release ):
+    def collected( ref ):
+        _unclosed.discard( ref )
+        warnings.warn( "RowStream was garbage collected without being closed - close it or use it in a with statement", RuntimeWarning )
+        # closing talks to the server - not from within the garbage collector
+        gevent.spawn( _close, conn, cursor, release )
+    return collected
+
+
+class RowStream( object ):
+    """
+    Iterator over the rows of a named server-side cursor that fetches
+    `itersize` rows per round trip.
+
+    Once the stream is exhausted, failed or closed the cursor is closed and
+    the connection is handed to `release`. Close streams that are not
+    iterated to the end - ``with rows: ...`` does. A stream that is garbage
+    collected while still open warns and is closed on a new greenlet.
+    """
+
+    def __init__( self, conn, cursor, itersize, release = None,
+                  deadline = None, transform = None ):
+        """
+        :param PoolConnection conn: the connection the cursor runs on
+        :param cursor: named cursor the query was executed on
+        :param int itersize: Number of rows to fetch per round trip
+        :param function release: called with the connection and the exception that ended the stream (or None) when it ends. None to leave the connection to the caller.
+        :param float deadline: time (as in `time.time()`) after which a running fetch is cancelled on the server
+        :param function transform: applied to each row before it is handed out (ie. to encode it)
+        """
+        self.conn = conn
+        self.cursor = cursor
+        self.itersize = itersize
+        self.release = release
+        self.deadline = deadline
+        self.transform = transform
+        self.rows = []
+        self.pos = 0
+        self.closed = False
+        self.ref = None
+        if release is not None:
+            self.ref = weakref.ref( self, _on_collected( conn, cursor, release ) )
+            _unclosed.add( self.ref )
+
+    def __iter__( self ):
+        return self
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.close()
+
+    def next( self ):
+        if self.pos >= len( self.rows ):
+            if self.closed:
+                raise StopIteration
+            try:
+                self.conn.set_query_deadline( self.deadline )
+                try:
+                    self.rows = self.cursor.fetchmany( self.itersize )
+                finally:
+                    self.conn.set_query_deadline( None )
+            except Exception, e:
+                self.close( e )
+                raise
+            self.pos = 0
+            if not self.rows:
+                self.close()
+                raise StopIteration
+        row = self.rows[ self.pos ]
+        self.pos += 1
+        if self.transform is not None:
+            return self.transform( row )
+        return row
+
+    def close( self, e = None ):
+        """
+        Stop the stream: close the cursor and release the connection
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.rows = []
+        # without a reference left the weakref and its callback are gone
+        _unclosed.discard( self.ref )
+        self.ref = None
+        _close( self.conn, self.cursor, self.release, e )
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# StatementCache - LRU cache of PREPAREd statements for a PoolConnection
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import re
+
+from collections import OrderedDict
+from itertools import count
+from psycopg2 import DatabaseError
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+
+# pyformat placeholders as psycopg2 understands them
+PLACEHOLDER_RE = re.compile( r"%%|%\((\w+)\)s|%s|%" )
+PREPARABLE_RE = re.compile( r"^\s*(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b", re.IGNORECASE )
+SQLSTATE_INVALID_STATEMENT_NAME = '26000'
+# "cached plan must not change result type" (ie. a table behind SELECT * was altered)
+SQLSTATE_FEATURE_NOT_SUPPORTED = '0A000'
+
+
+def convert_placeholders( sql, bound = True ):
+    """
+    Convert a query with psycopg2 (pyformat) placeholders to one with
+    PostgreSQL positional parameters ($1, $2, ...) for PREPARE.
+
+    :param string sql: query using %s or %(name)s placeholders
+    :param bool bound: if args are bound to the query. psycopg2 sends a query without args as it is - '%%' and '%s' included - so it is prepared verbatim.
+    :rtype: tuple
+    :returns: the converted query and the list of parameter names for named placeholders (None for positional ones) or (None, None) if the query cannot be prepared
+    """
+
+    if not PREPARABLE_RE.match( sql ) or ';' in sql.rstrip().rstrip( ';' ):
+        return None, None
+    if not bound:
+        return sql.rstrip().rstrip( ';' ), None
+    parts = []
+    names = []
+    positional = 0
+    pos = 0
+    for m in PLACEHOLDER_RE.finditer( sql ):
+        parts.append( sql[ pos:m.start() ] )
+        pos = m.end()
+        token = m.group( 0 )
+        if token == '%%':
+            parts.append( '%' )
+        elif token == '%s':
+            positional += 1
+            parts.append( '$%i' % ( positional, ) )
+        elif m.group( 1 ) is not None:
+            if m.group( 1 ) not in names:
+                names.append( m.group( 1 ) )
+            parts.append( '$%i' % ( names.index( m.group( 1 ) ) + 1, ) )
+        else:
+            return None, None
+    if positional and names:
+        return None, None
+    parts.append( sql[ pos: ] )
+    return ''.join( parts ).rstrip().rstrip( ';' ), names if names else None
+
+
+class StatementCache( object ):
+    """
+    LRU cache of PREPAREd statements keyed by their SQL text (and whether
+    args are bound to it).
+
+    Every cache belongs to exactly one connection (prepared statements live
+    in the database session). Queries that cannot be prepared (several
+    statements, DDL, placeholders PREPARE does not understand, ...) are
+    remembered and executed as they are.
+    """
+
+    def __init__( self, size, stats = None ):
+        """
+        :param int size: Maximum number of prepared statements to keep on the connection
+        :param dict stats: dict with 'hits', 'misses' and 'evictions' counters to update. (ie. shared by all connections of a pool)
+        """
+        self.size = size
+        self.stats = stats if stats is not None else { 'hits': 0, 'misses': 0, 'evictions': 0 }
+        self.statements = OrderedDict()
+        self.unpreparable = OrderedDict()
+        # names of dropped statements that still need a DEALLOCATE
+        self.stale = []
+        self.statement_ids = count()
+
+    def __len__( self ):
+        return len( self.statements )
+
+    def clear( self ):
+        """
+        Forget all statements. Call this when the session's prepared
+        statements are gone. (ie. after ``DISCARD ALL`` or a reconnect)
+        """
+        self.statements.clear()
+        self.stale = []
+
+    def execute( self, conn, cursor, sql, args = None ):
+        """
+        Execute sql on cursor - as EXECUTE of a prepared statement if possible.
+
+        :param conn: the DB-API connection the cursor belongs to
+        :param cursor: the cursor to execute on
+        :param string sql: the query
+        :param args: query args (sequence for %s, mapping for %(name)s placeholders)
+        """
+        key = ( sql, args is not None )
+        statement = self.statements.pop( key, None )
+        if statement is not None:
+            self.statements[ key ] = statement
+            self.stats[ 'hits' ] += 1
+        elif self.unpreparable.has_key( key ):
+            self._execute( cursor, sql, args )
+            return
+        else:
+            self.stats[ 'misses' ] += 1
+            statement = self._prepare( conn, cursor, key )
+            if statement is None:
+                self._execute( cursor, sql, args )
+                return
+
+        name, param_names = statement
+        if param_names is not None:
+            args = [ args[ n ] for n in param_names ]
+        try:
+            if args:
+                cursor.execute( "EXECUTE %s (%s);" % ( name, ', '.join( [ '%s' ] * len( args ) ) ), args )
+            else:
+                cursor.execute( "EXECUTE %s;" % ( name, ) )
+        except DatabaseError, e:
+            pgcode = getattr( e, 'pgcode', None )
+            if pgcode == SQLSTATE_INVALID_STATEMENT_NAME:
+                # the session lost its prepared statements behind our back
+                self.clear()
+            elif pgcode == SQLSTATE_FEATURE_NOT_SUPPORTED:
+                # the statement can never run again - the next call prepares
+                # it anew. the failed EXECUTE may have aborted the caller's
+                # transaction, so the DEALLOCATE waits for the next PREPARE.
+                del self.statements[ key ]
+                self.stale.append( name )
+            raise
+
+    def _execute( self, cursor, sql, args ):
+        if args is not None:
+            cursor.execute( sql, args )
+        else:
+            cursor.execute( sql )
+
+    def _prepare( self, conn, cursor, key ):
+        sql, bound = key
+        prepare_sql, param_names = convert_placeholders( sql, bound )
+        if prepare_sql is None:
+            self._remember_unpreparable( key )
+            return None
+
+        name = "gdbpool_stmt_%i" % ( self.statement_ids.next(), )
+        prepare = "PREPARE %s AS %s;" % ( name, prepare_sql )
+        in_txn = conn.isolation_level != ISOLATION_LEVEL_AUTOCOMMIT
+        try:
+            if in_txn:
+                # a failing PREPARE must not abort the caller's transaction
+                cursor.execute( "SAVEPOINT gdbpool_prepare; %s RELEASE SAVEPOINT gdbpool_prepare;" % ( prepare, ) )
+            else:
+                cursor.execute( prepare )
+        except DatabaseError, e:
+            if in_txn:
+                cursor.execute( "ROLLBACK TO SAVEPOINT gdbpool_prepare; RELEASE SAVEPOINT gdbpool_prepare;" )
+            self._remember_unpreparable( key )
+            return None
+
+        while self.stale:
+            cursor.execute( "DEALLOCATE %s;" % ( self.stale.pop(), ) )
+        while len( self.statements ) >= self.size:
+            evicted_key, ( evicted_name, evicted_params ) = self.statements.popitem( last = False )
+            cursor.execute( "DEALLOCATE %s;" % ( evicted_name, ) )
+            self.stats[ 'evictions' ] += 1
+        self.statements[ key ] = ( name, param_names )
+        return self.statements[ key ]
+
+    def _remember_unpreparable( self, key ):
+        self.unpreparable[ key ] = True
+        if len( self.unpreparable ) > self.size * 4:
+            self.unpreparable.popitem( last = False )
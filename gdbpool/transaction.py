@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - db connection pooling for gevent
+#
+# DBTransaction - several interactions in one transaction on a pinned connection
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+from types import FunctionType, MethodType, StringType
+from inspect import getargspec
+from time import time
+
+from gdbpool_error import DBInteractionException, is_connection_error
+
+
+class DBTransaction( object ):
+    """
+    A transaction on one connection of a pool, pinned for the lifetime of the
+    transaction. Use it as a context manager::
+
+        with ipool.transaction() as txn:
+            row = txn.run( "SELECT * FROM test_values WHERE id = %s FOR UPDATE;", [ 1 ] )[ 0 ]
+            txn.run( "UPDATE test_values SET val2 = %s WHERE id = %s;", [ row[ 'val2' ] + 1, 1 ], get_result = False )
+
+    The interactions run right away in the calling greenlet (not on a new
+    greenlet or the pool's workers) and return their results. Leaving the
+    block commits the transaction - or rolls it back if the block raised or
+    an interaction failed - and always puts the connection back onto the
+    pool.
+    """
+
+    def __init__( self, ipool, pool_name, iso_level = None, priority = None,
+                  timeout = None, deadline = None, query_timeout = None ):
+        """
+        :param DBInteractionPool ipool: the interaction pool (for metrics and error handling)
+        :param string pool_name: name of the pool to get the connection from
+        :param iso_level: transaction isolation level (psycopg2.extensions ISOLATION_LEVEL_*). Defaults to the pool's default.
+        :param int priority: priority to get the connection with. See :meth:`DBConnectionPool.get`
+        :param float timeout: seconds to wait for a connection
+        :param float deadline: time (as in `time.time()`) after which a connection is not needed anymore
+        :param float query_timeout: seconds after which each query of the transaction is cancelled
+        """
+        self.ipool = ipool
+        self.pool_name = pool_name
+        self.pool = ipool.conn_pools[ pool_name ]
+        self.get_kwargs = dict( [ ( k, v ) for k, v in ( ( 'iso_level', iso_level ),
+                                                          ( 'priority', priority ),
+                                                          ( 'timeout', timeout ),
+                                                          ( 'deadline', deadline ) ) if v is not None ] )
+        self.deadline = deadline
+        self.query_timeout = query_timeout
+        self.conn = None
+        self.failed = False
+        self.broken = False
+
+    def __enter__( self ):
+        self.begin()
+        return self
+
+    def __exit__( self, exc_type, exc_value, tb ):
+        if self.conn is None:
+            return False
+        if exc_type is None and not self.failed:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def begin( self ):
+        """
+        Get the connection from the pool. (Done by entering the with block.)
+        """
+        if self.conn is not None:
+            raise DBInteractionException( "The transaction already began." )
+        e = self.ipool._circuit_open( self.pool_name )
+        if e is not None:
+            raise e
+        try:
+            self.conn = self.pool.get( **self.get_kwargs )
+        except Exception, e:
+            self.ipool._interaction_failed( self.pool_name, e )
+            raise self.ipool._interaction_error( e )
+        self.failed = False
+        self.broken = False
+
+    def run( self, interaction, interaction_args = None, get_result = True,
+             *args, **kwargs ):
+        """
+        Run an interaction in the transaction
+
+        :param function|method|string interaction: a SQL string or a function that takes at least a parameter `conn` (and optionally `cursor`)
+        :param interaction_args: args for the placeholders of a SQL interaction
+        :param bool get_result: return cursor.fetchall() of a SQL interaction - otherwise just True
+        :param list args: positional args for a function interaction
+        :param dict kwargs: kwargs for a function interaction
+        :returns: the result of the interaction
+        :raises: :class:`DBInteractionException` - the transaction is then rolled back when it ends
+        """
+        conn = self.conn
+        if conn is None:
+            raise DBInteractionException( "The transaction is not active." )
+        if self.failed:
+            raise DBInteractionException( "An interaction of the transaction failed. It can only be rolled back." )
+        started = time()
+        conn.set_query_deadline( self.ipool._query_deadline( self.query_timeout, self.deadline ) )
+        try:
+            if isinstance( interaction, StringType ):
+                cursor = conn.cursor()
+                try:
+                    conn.execute( cursor, interaction, interaction_args )
+                    res = cursor.fetchall() if get_result else True
+                finally:
+                    cursor.close()
+                self.ipool.metrics.observe( self.ipool._query_metric( interaction ), time() - started )
+                self.ipool._interaction_succeeded( self.pool_name )
+            elif isinstance( interaction, ( FunctionType, MethodType ) ):
+                kwargs[ 'conn' ] = conn
+                if 'cursor' in getargspec( interaction )[ 0 ]:
+                    kwargs[ 'cursor' ] = conn.cursor()
+                res = interaction( *args, **kwargs )
+                self.ipool.metrics.observe( 'interaction:%s' % ( interaction.__name__, ), time() - started )
+                self.ipool._interaction_succeeded( self.pool_name )
+            else:
+                raise DBInteractionException( "%s cannot be run. run() only accepts FunctionTypes, MethodType, and StringTypes" % ( interaction, ) )
+        except Exception, e:
+            self.failed = True
+            self.broken = is_connection_error( e )
+            self.ipool._interaction_failed( self.pool_name, e )
+            raise self.ipool._interaction_error( e )
+        finally:
+            conn.set_query_deadline( None )
+        return res
+
+    def commit( self ):
+        """
+        Commit the transaction and put the connection back onto the pool
+        """
+        if self.conn is None:
+            raise DBInteractionException( "The transaction is not active." )
+        try:
+            self.conn.commit()
+        except Exception, e:
+            self.failed = True
+            self.broken = is_connection_error( e )
+            self.ipool._interaction_failed( self.pool_name, e )
+            self._end()
+            raise self.ipool._interaction_error( e )
+        self._end()
+
+    def rollback( self ):
+        """
+        Roll the transaction back and put the connection back onto the pool
+        """
+        if self.conn is None:
+            return
+        try:
+            self.conn.rollback()
+        except Exception, e:
+            self.broken = True
+        self._end()
+
+    def _end( self ):
+        conn, self.conn = self.conn, None
+        self.pool.put( conn, force_recycle = self.broken )
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2011-2012 Florian von Bock (f at vonbock dot info)
+#
+# gDBPool - Tests of the asyncio pool (Python 3)
+
+__author__ = "Florian von Bock"
+__email__ = "f at vonbock dot info"
+__version__ = "0.1.3"
+
+
+import os, sys
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ).rpartition( '/' )[ 0 ] )
+
+import asyncio
+import unittest
+
+from gdbpool.gdbpool_error import DBInteractionException
+from gdbpool.aio import AsyncInteractionPool, SUBSCRIPTION_CLOSED
+
+dsn = "host=127.0.0.1 port=5432 user=postgres dbname=gdbpool_test"
+
+
+class gDBPoolAsyncTests( unittest.IsolatedAsyncioTestCase ):
+
+    async def asyncSetUp( self ):
+        self.ipool = await AsyncInteractionPool( dsn, pool_size = 4 ).open()
+        self.pool = self.ipool.conn_pools[ 'default' ]
+
+    async def asyncTearDown( self ):
+        self.ipool.close()
+
+    async def test_run( self ):
+        """Test SQL and coroutine function interactions"""
+
+        res = await self.ipool.run( "SELECT %s AS v;", [ 7 ] )
+        self.assertEqual( res[ 0 ][ 'v' ], 7 )
+        res = await self.ipool.run( "SELECT 1 AS v;", is_write = False )
+        self.assertEqual( res[ 0 ][ 'v' ], 1 )
+        res = await asyncio.gather( *[ self.ipool.run( "SELECT %s AS v;", [ i ] ) for i in range( 20 ) ] )
+        self.assertEqual( [ r[ 0 ][ 'v' ] for r in res ], list( range( 20 ) ) )
+
+        async def interaction( conn, pk ):
+            rows = await conn.fetch( "SELECT id FROM test_values WHERE id = %s;", [ pk ] )
+            await conn.commit()
+            return rows
+
+        res = await self.ipool.run( interaction, pk = 20000 )
+        self.assertEqual( res[ 0 ][ 'id' ], 20000 )
+        with self.assertRaises( DBInteractionException ):
+            await self.ipool.run( "SELECT * FROM test_values_not_here;" )
+        await asyncio.sleep( 0.1 )
+        self.assertEqual( self.pool.qsize, 4 )
+
+    async def test_transaction( self ):
+        """Test a transaction spanning several interactions on the connection of a partial_txn"""
+
+        txn = await self.ipool.run( "SELECT val2 FROM test_values WHERE id = %s FOR UPDATE;",
+                                    [ 20000 ], partial_txn = True )
+        conn = txn[ 'connection' ]
+        val2 = txn[ 'result' ][ 0 ][ 'val2' ]
+        self.assertTrue( conn.in_transaction )
+        self.assertEqual( self.pool.qsize, 3 )
+        await self.ipool.run( "UPDATE test_values SET val2 = %s WHERE id = %s;", [ val2 + 1, 20000 ], conn = conn )
+        self.assertFalse( conn.in_transaction )
+        self.assertEqual( self.pool.qsize, 4 )
+        res = await self.ipool.run( "SELECT val2 FROM test_values WHERE id = %s;", [ 20000 ] )
+        self.assertEqual( res[ 0 ][ 'val2' ], val2 + 1 )
+
+        # a failing interaction rolls the transaction back
+        txn = await self.ipool.run( "UPDATE test_values SET val2 = %s WHERE id = %s;",
+                                    [ val2, 20000 ], partial_txn = True )
+        with self.assertRaises( DBInteractionException ):
+            await self.ipool.run( "SELECT * FROM test_values_not_here;", conn = txn[ 'connection' ] )
+        await asyncio.sleep( 0.1 )
+        self.assertEqual( self.pool.qsize, 4 )
+        res = await self.ipool.run( "SELECT val2 FROM test_values WHERE id = %s;", [ 20000 ] )
+        self.assertEqual( res[ 0 ][ 'val2' ], val2 + 1 )
+
+        # ... but with partial_txn the connection stays with the caller
+        txn = await self.ipool.run( "SELECT 1;", partial_txn = True )
+        conn = txn[ 'connection' ]
+        with self.assertRaises( DBInteractionException ):
+            await self.ipool.run( "SELECT * FROM test_values_not_here;", conn = conn, partial_txn = True )
+        await asyncio.sleep( 0.1 )
+        self.assertEqual( self.pool.qsize, 3 )
+        self.pool.put( conn )
+        await asyncio.sleep( 0.1 )
+        self.assertEqual( self.pool.qsize, 4 )
+        self.assertEqual( len( set( self.pool.idle ) ), 4 )
+
+    async def test_listen_on( self ):
+        """Test that a subscription gets the payloads of its channel"""
+
+        subscription = await self.ipool.listen_on( 'notify_test_aio' )
+        self.assertEqual( self.pool.qsize, 3 )
+        for i in range( 3 ):
+            await self.ipool.run( "NOTIFY notify_test_aio, 'k:%i';" % ( i, ) )
+        payloads = [ await asyncio.wait_for( subscription.queue.get(), 1 ) for i in range( 3 ) ]
+        self.assertEqual( payloads, [ { 'k': '0' }, { 'k': '1' }, { 'k': '2' } ] )
+        await subscription.close()
+        await asyncio.sleep( 0.1 )
+        self.assertEqual( self.pool.qsize, 4 )
+
+    async def test_unsubscribe_one_channel( self ):
+        """Test that the other channels keep getting their payloads when one channel is unsubscribed"""
+
+        sub_a = await self.ipool.listen_on( 'notify_test_aio_a' )
+        sub_b = await self.ipool.listen_on( 'notify_test_aio_b', unmarshaller = 'raw' )
+        self.assertEqual( self.pool.qsize, 3 )
+        await sub_a.close()
+        self.assertEqual( self.pool.qsize, 3 )
+        await self.ipool.run( "NOTIFY notify_test_aio_a, 'k:a';" )
+        await self.ipool.run( "NOTIFY notify_test_aio_b, 'k:b';" )
+        self.assertEqual( await asyncio.wait_for( sub_b.queue.get(), 1 ), 'k:b' )
+        self.assertIs( sub_a.queue.get_nowait(), SUBSCRIPTION_CLOSED )
+        self.assertEqual( sub_a.queue.qsize(), 0 )
+        await sub_b.close()
+        await asyncio.sleep( 0.1 )
+        self.assertEqual( self.pool.qsize, 4 )
+
+
+if __name__ == '__main__':
+    unittest.main( verbosity = 1 )
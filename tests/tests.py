@@ -18,15 +18,23 @@ sys.path.insert( 0, os.path.dirname( __file__ ).rpartition( '/' )[ 0 ] )
 import unittest
 import random
 import logging
+import time
+import subprocess
+
+from StringIO import StringIO
 
 from gevent.select import select
 from gevent.queue import Queue
 from gevent.queue import Empty as QueueEmptyException
 
-from gdbpool.gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, StreamEndException
+from gdbpool.gdbpool_error import DBInteractionException, DBPoolConnectionException, PoolConnectionException, StreamEndException, DBPoolQueueFullException, DBPoolDeadlineExceededException, DBInteractionTimeoutException, DBPoolBudgetException, DBPoolCircuitOpenException
 from gdbpool.interaction_pool import DBInteractionPool
-from gdbpool.connection_pool import DBConnectionPool
+from gdbpool.connection_pool import DBConnectionPool, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
 from gdbpool.pool_connection import PoolConnection
+from gdbpool.budget import ConnectionBudget
+from gdbpool.retry import RetryPolicy
+from gdbpool.copy_stream import decode_copy_line
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, ISOLATION_LEVEL_READ_COMMITTED, ISOLATION_LEVEL_SERIALIZABLE, TransactionRollbackError, QueryCanceledError
 
 logging.basicConfig( level = logging.INFO, format = "%(asctime)s %(message)s" )
 logger = logging.getLogger()
@@ -57,6 +65,75 @@ class gDBPoolTests( unittest.TestCase ):
     def _test_connect_pool_size_too_big( self ):
         pass
 
+    def _run_child( self, code ):
+        # a fresh interpreter - this one is monkey patched already
+        child = "import sys\nsys.path.insert( 0, %r )\n%s\n" % ( os.path.dirname( os.path.abspath( __file__ ) ).rpartition( '/' )[ 0 ], code )
+        return subprocess.check_output( [ sys.executable, '-c', child ] ).split()
+
+    def test_import_side_effects( self ):
+        """Test that importing the gDBPool modules neither monkey patches nor sets the psycopg2 wait callback"""
+
+        patched, green = self._run_child( """
+import gdbpool, gdbpool.interaction_pool, gdbpool.connection_pool, gdbpool.pool_connection
+from gevent import monkey
+import psycopg2.extensions
+print monkey.is_module_patched( 'socket' ), psycopg2.extensions.get_wait_callback() is not None
+""" )
+        self.assertEqual( ( patched, green ), ( 'False', 'False' ) )
+
+    def test_setup( self ):
+        """Test that gdbpool.setup() patches and sets the wait callback once, however often it is called"""
+
+        patch_calls, patched, green, same_callback = self._run_child( """
+from gevent import monkey
+calls = []
+patch_all = monkey.patch_all
+monkey.patch_all = lambda *args, **kwargs: calls.append( 1 ) or patch_all( *args, **kwargs )
+import gdbpool
+import psycopg2.extensions
+gdbpool.setup()
+wait_callback = psycopg2.extensions.get_wait_callback()
+gdbpool.setup()
+gdbpool.setup( patch_all = False )
+print len( calls ), monkey.is_module_patched( 'socket' ), wait_callback is not None, psycopg2.extensions.get_wait_callback() is wait_callback
+""" )
+        self.assertEqual( ( patch_calls, patched, green, same_callback ), ( '1', 'True', 'True', 'True' ) )
+
+        patched, green = self._run_child( """
+import gdbpool
+from gevent import monkey
+import psycopg2.extensions
+gdbpool.setup( patch_all = False )
+gdbpool.setup( patch_all = False )
+print monkey.is_module_patched( 'socket' ), psycopg2.extensions.get_wait_callback() is not None
+""" )
+        self.assertEqual( ( patched, green ), ( 'False', 'True' ) )
+
+    def test_benchmark_harness( self ):
+        """Test the pools against the fake driver of the benchmarks and a short run of the harness"""
+
+        benchmarks = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ).rpartition( '/' )[ 0 ], 'benchmarks' )
+        sys.path.insert( 0, benchmarks )
+        try:
+            import fake_driver
+        finally:
+            sys.path.remove( benchmarks )
+        ipool = DBInteractionPool( 'fake', pool_size = 2, db_module = fake_driver.MODULE_NAME )
+        try:
+            self.assertEqual( ipool.run( "SELECT 1;" ).get(), fake_driver.ROWS )
+            subscription = ipool.listen_on( Queue(), 'fake_channel', unmarshaller = 'raw' )
+            gevent.sleep( 0.1 )
+            ipool.run( "NOTIFY fake_channel, 'payload';" ).get()
+            self.assertEqual( subscription.queue.get( timeout = 1 ), 'payload' )
+            subscription.close()
+        finally:
+            ipool.__del__()
+
+        out = subprocess.check_output( [ sys.executable, os.path.join( benchmarks, 'bench.py' ),
+                                         '-n', '200', '-c', '10', '--subscribers', '5' ] )
+        for scenario in ( 'getput', 'run', 'listen' ):
+            self.assertIn( "\n%-8s %8i ops" % ( scenario, 200 ), out )
+
     def test_invalid_query( self ):
         """Test running an invalid SQL interactions on the DBInteractionPool"""
 
@@ -156,6 +233,564 @@ class gDBPoolTests( unittest.TestCase ):
         gevent.joinall( greenlets, timeout = 10, raise_error = True )
         gevent.sleep( 1 )
 
+    def test_run_on_executor( self ):
+        """Test running queries on a pool with a bounded set of worker greenlets"""
+
+        self.ipool.add_pool( dsn = dsn, pool_name = 'executor', pool_size = 2,
+                             workers = 2, max_queue_size = 4,
+                             reject_when_full = True )
+        results = [ self.ipool.run( "SELECT pg_sleep( 0.1 );", pool = 'executor' ) for i in xrange( 10 ) ]
+        rejected = 0
+        for res in results:
+            try:
+                res.get()
+            except DBPoolQueueFullException:
+                rejected += 1
+        self.assertEqual( rejected, 6 )
+
+    def test_executor_partial_txn( self ):
+        """Test that the continuation of a partial_txn runs while all workers wait for its connection"""
+
+        self.ipool.add_pool( dsn = dsn, pool_name = 'executor', pool_size = 1, workers = 2 )
+        txn = self.ipool.run( "SELECT 1 AS one;", pool = 'executor', partial_txn = True ).get()
+        waiting = [ self.ipool.run( "SELECT 2 AS two;", pool = 'executor' ) for i in xrange( 2 ) ]
+        gevent.sleep( 0.1 )
+        res = self.ipool.run( "SELECT 3 AS three;", conn = txn[ 'connection' ], pool = 'executor' )
+        self.assertEqual( res.get( timeout = 2 )[ 0 ][ 'three' ], 3 )
+        for res in waiting:
+            self.assertEqual( res.get( timeout = 2 )[ 0 ][ 'two' ], 2 )
+
+    def test_stream_query( self ):
+        """Test streaming a result set from a server-side cursor"""
+
+        sql = """
+        SELECT id, val1, val2 FROM test_values ORDER BY id LIMIT 1000;
+        """
+
+        rows = self.ipool.run( sql, stream = True, itersize = 100 ).get()
+        self.assertEqual( len( list( rows ) ), len( self.ipool.run( sql ).get() ) )
+
+        rq = Queue( maxsize = 10 )
+        res = self.ipool.run( sql, stream = True, itersize = 100, stream_queue = rq )
+        streamed = 0
+        while 1:
+            row = rq.get()
+            if isinstance( row, StreamEndException ):
+                break
+            streamed += 1
+        self.assertEqual( res.get(), streamed )
+
+    def test_stream_release( self ):
+        """Test that a stream that is closed or dropped before it was iterated puts its connection back"""
+
+        import gc, warnings
+
+        sql = "SELECT id FROM test_values ORDER BY id LIMIT 100;"
+        pool = self.ipool.conn_pools[ 'default' ]
+        idle = pool.qsize
+        rows = self.ipool.run( sql, stream = True ).get()
+        self.assertEqual( pool.qsize, idle - 1 )
+        rows.close()
+        self.assertEqual( pool.qsize, idle )
+        with self.ipool.run( sql, stream = True ).get() as rows:
+            self.assertEqual( rows.next()[ 'id' ], 1 )
+        self.assertEqual( pool.qsize, idle )
+        with warnings.catch_warnings( record = True ) as caught:
+            warnings.simplefilter( 'always' )
+            rows = self.ipool.run( sql, stream = True ).get()
+            gevent.sleep( 0 )
+            del rows
+            # also when the stream is part of a reference cycle
+            rows = self.ipool.run( sql, stream = True ).get()
+            rows.cycle = rows
+            gevent.sleep( 0 )
+            del rows
+            gc.collect()
+            gevent.sleep( 0.1 )
+        self.assertEqual( pool.qsize, idle )
+        self.assertEqual( len( [ w for w in caught if 'RowStream' in str( w.message ) ] ), 2 )
+        lines = self.ipool.copy_out( sql ).get()
+        self.assertEqual( pool.qsize, idle - 1 )
+        lines.close()
+        self.assertEqual( pool.qsize, idle )
+
+    def test_run_many( self ):
+        """Test running a batch of inserts in pages on one connection"""
+
+        sql = """
+        INSERT INTO test_values ( val1, val2 ) VALUES ( %s, %s );
+        """
+
+        res = self.ipool.run_many( sql, ( ( i, i ) for i in xrange( 250 ) ), page_size = 100, partial_txn = True ).get()
+        self.assertEqual( res[ 'result' ], [ 100, 100, 50 ] )
+        conn = res[ 'connection' ]
+        inserted = self.ipool.run( "SELECT count(*) AS c FROM test_values WHERE id > ( SELECT max(id) - 250 FROM test_values );",
+                                   conn = conn, partial_txn = True ).get()
+        self.assertEqual( inserted[ 'result' ][ 0 ][ 'c' ], 250 )
+        conn.rollback()
+        self.ipool.pool.put( conn )
+
+    def test_copy_in_out( self ):
+        """Test bulk loading and exporting rows in COPY text format"""
+
+        res = self.ipool.copy_in( 'test_values', ( ( i, i ) for i in xrange( 250 ) ), columns = [ 'val1', 'val2' ],
+                                  page_size = 100, partial_txn = True ).get()
+        self.assertEqual( res[ 'result' ], 250 )
+        conn = res[ 'connection' ]
+        lines = self.ipool.copy_out( "SELECT val1, val2 FROM test_values ORDER BY id DESC LIMIT 3;", conn = conn ).get()
+        self.assertEqual( list( lines ), [ "249\t249\n", "248\t248\n", "247\t247\n" ] )
+        conn.rollback()
+        self.ipool.pool.put( conn )
+
+    def test_copy_types( self ):
+        """Test that floats, arrays, json and bytea survive a copy_in / copy_out round trip"""
+
+        def create_f( conn, cursor ):
+            cursor.execute( "CREATE TEMP TABLE copy_types ( id int, f float8, a int[], t text[], j json, b bytea );" )
+            cursor.execute( "CREATE TEMP TABLE copy_types_back ( LIKE copy_types );" )
+
+        conn = self.ipool.run( create_f, partial_txn = True ).get()[ 'connection' ]
+        rows = [ ( 1, 0.1234567890123456, [ 1, 2, None ], [ u'a "b"', u'c\\d', u'\xe4\t' ], '{"a": [1, 2]}', buffer( '\x00\x01\\\n' ) ),
+                 ( 2, 1e-300, [], [ u'' ], '[]', None ) ]
+        self.ipool.copy_in( 'copy_types', rows, conn = conn, partial_txn = True ).get()
+        lines = list( self.ipool.copy_out( 'copy_types', conn = conn ).get() )
+        self.ipool.copy_in( 'copy_types_back', StringIO( ''.join( lines ) ), conn = conn, partial_txn = True ).get()
+
+        sql = "SELECT id, f, a, t, j::text AS j, encode( b, 'hex' ) AS b FROM %s ORDER BY id;"
+        original = self.ipool.run( sql % ( 'copy_types', ), conn = conn, partial_txn = True ).get()[ 'result' ]
+        back = self.ipool.run( sql % ( 'copy_types_back', ), conn = conn, partial_txn = True ).get()[ 'result' ]
+        self.assertEqual( original[ 0 ][ 'f' ], 0.1234567890123456 )
+        self.assertEqual( original[ 0 ][ 'a' ], [ 1, 2, None ] )
+        self.assertEqual( original[ 0 ][ 'b' ], '00015c0a' )
+        self.assertEqual( back, original )
+        conn.rollback()
+        self.ipool.pool.put( conn )
+
+    def test_copy_escapes( self ):
+        """Test that copy_in decodes the backslash escapes of the COPY text format like COPY FROM does"""
+
+        line = '\t'.join( [ r"a\101b", r"\x41\x4a", r"\xz", r"\\x41", r"\N", r"\n\t\0" ] )
+        self.assertEqual( decode_copy_line( line ), [ 'aAb', 'AJ', 'xz', '\\x41', None, '\n\t\0' ] )
+        conn = self.ipool.run( "CREATE TEMP TABLE copy_escapes ( id int, t text );", partial_txn = True ).get()[ 'connection' ]
+        data = "1\ta\\101b\n2\t\\x41\\x4A\\x\n3\t\\\\101\n"
+        self.ipool.copy_in( 'copy_escapes', StringIO( data ), conn = conn, partial_txn = True ).get()
+        res = self.ipool.run( "SELECT t FROM copy_escapes ORDER BY id;", conn = conn, partial_txn = True ).get()[ 'result' ]
+        self.assertEqual( [ row[ 't' ] for row in res ], [ 'aAb', 'AJx', '\\101' ] )
+        conn.rollback()
+        self.ipool.pool.put( conn )
+
+    def test_result_cache( self ):
+        """Test caching read results and invalidating them with a NOTIFY"""
+
+        sql = """
+        SELECT val1, count(id) FROM test_values WHERE val2 = %s GROUP BY val1 ORDER BY val1;
+        """
+
+        res = self.ipool.run( sql, [ 10 ], is_write = False, cache = True, cache_tags = [ 'test_values' ] ).get()
+        self.assertIs( self.ipool.run( sql, [ 10 ], is_write = False, cache = True ).get(), res )
+        self.assertIsNot( self.ipool.run( sql, [ 11 ], is_write = False, cache = True ).get(), res )
+
+        subscription = self.ipool.invalidate_cache_on( 'gdbpool_cache_test' )
+        self.ipool.run( "NOTIFY gdbpool_cache_test, 'test_values';", get_result = False ).get()
+        gevent.sleep( 0.5 )
+        self.assertIsNot( self.ipool.run( sql, [ 10 ], is_write = False, cache = True ).get(), res )
+        subscription.close()
+
+    def test_coalesce( self ):
+        """Test that identical concurrent reads share one execution"""
+
+        sql = """
+        SELECT val1, count(id) FROM test_values GROUP BY val1 ORDER BY val1;
+        """
+
+        results = [ self.ipool.run( sql, is_write = False, coalesce = True ) for i in xrange( 50 ) ]
+        self.assertEqual( len( set( [ id( r ) for r in results ] ) ), 1 )
+        self.assertEqual( self.ipool.metrics.counters.get( 'coalesced' ), 49 )
+        res = results[ 0 ].get()
+        gevent.sleep( 0 )
+        self.assertIsNot( self.ipool.run( sql, is_write = False, coalesce = True ), results[ 0 ] )
+
+        first = self.ipool.run( sql, is_write = False, coalesce = True )
+        self.assertIsNot( self.ipool.run( sql, is_write = False, coalesce = True, deadline = time.time() + 5 ), first )
+        self.assertIsNot( self.ipool.run( sql, is_write = False, coalesce = True, query_timeout = 5 ), first )
+        self.assertIsNot( self.ipool.run( sql, is_write = False, coalesce = True, priority = PRIORITY_HIGH ), first )
+        self.assertIs( self.ipool.run( sql, is_write = False, coalesce = True ), first )
+        first.get()
+
+    def test_query_timeout( self ):
+        """Test that a query running longer than its timeout is cancelled"""
+
+        started = time.time()
+        with self.assertRaises( DBInteractionTimeoutException ):
+            self.ipool.run( "SELECT pg_sleep( 5 );", query_timeout = 0.5 ).get()
+        self.assertTrue( time.time() - started < 2 )
+        self.assertEqual( self.ipool.run( "SELECT 1 AS one;" ).get(), [ { 'one': 1 } ] )
+
+    def test_stream_query_timeout( self ):
+        """Test that the query timeout also cancels the fetches of a streamed query"""
+
+        pool = self.ipool.conn_pools[ 'default' ]
+        idle = pool.qsize
+        started = time.time()
+        rows = self.ipool.run( "SELECT pg_sleep( 5 ) FROM generate_series( 1, 2 );", stream = True, query_timeout = 0.5 ).get()
+        with self.assertRaises( QueryCanceledError ):
+            list( rows )
+        self.assertTrue( time.time() - started < 2 )
+        self.assertEqual( pool.qsize, idle )
+
+    def test_retry( self ):
+        """Test that reads are retried on a fresh connection after a connection error and serialization failures only when asked to"""
+
+        backends = []
+        def read_f( conn, cursor ):
+            cursor.execute( "SELECT pg_backend_pid() AS pid;" )
+            backends.append( cursor.fetchone()[ 'pid' ] )
+            if len( backends ) == 1:
+                # the server closes the connection on us
+                cursor.execute( "SELECT pg_terminate_backend( pg_backend_pid() );" )
+            return backends[ -1 ]
+
+        self.assertEqual( self.ipool.run( read_f, is_write = False ).get(), backends[ 1 ] )
+        self.assertNotEqual( backends[ 0 ], backends[ 1 ] )
+        self.assertEqual( self.ipool.metrics.snapshot()[ 'counters' ][ 'retries' ], 1 )
+        del backends[ : ]
+        with self.assertRaises( DBInteractionException ):
+            self.ipool.run( read_f, is_write = True ).get()
+        self.assertEqual( len( backends ), 1 )
+
+        calls = []
+        def conflicting_f( conn ):
+            calls.append( 1 )
+            if len( calls ) == 1:
+                raise TransactionRollbackError( "could not serialize access due to concurrent update" )
+            return len( calls )
+
+        with self.assertRaises( DBInteractionException ):
+            self.ipool.run( conflicting_f ).get()
+        del calls[ : ]
+        self.assertEqual( self.ipool.run( conflicting_f, retry = RetryPolicy( serialization_failures = True ) ).get(), 2 )
+
+    def test_circuit_breaker( self ):
+        """Test that a pool's circuit breaker opens after consecutive timeouts, fails fast, and closes after a successful probe"""
+
+        self.ipool.add_pool( dsn = dsn, pool_name = 'breaker', pool_size = 2,
+                             breaker_threshold = 2, breaker_timeout = 1 )
+        for i in xrange( 2 ):
+            with self.assertRaises( DBInteractionTimeoutException ):
+                self.ipool.run( "SELECT pg_sleep( 1 );", pool = 'breaker', query_timeout = 0.1 ).get()
+        started = time.time()
+        with self.assertRaises( DBPoolCircuitOpenException ):
+            self.ipool.run( "SELECT 1 AS one;", pool = 'breaker' ).get()
+        self.assertTrue( time.time() - started < 0.1 )
+        self.assertEqual( self.ipool.run( "SELECT 1 AS one;" ).get(), [ { 'one': 1 } ] )
+        gevent.sleep( 1 )
+        self.assertEqual( self.ipool.run( "SELECT 1 AS one;", pool = 'breaker' ).get(), [ { 'one': 1 } ] )
+        self.assertEqual( self.ipool.breakers[ 'breaker' ].state, 'closed' )
+
+    def test_statement_cache( self ):
+        """Test running queries as cached prepared statements"""
+
+        self.ipool.add_pool( dsn = dsn, pool_name = 'stmt_cache', pool_size = 1,
+                             stmt_cache_size = 10 )
+        sql = """
+        SELECT val1, count(id) FROM test_values WHERE val2 = %s GROUP BY val1 order by val1;
+        """
+        for i in xrange( 5 ):
+            res = self.ipool.run( sql, [ i ], pool = 'stmt_cache' ).get()
+            self.assertEqual( res, self.ipool.run( sql, [ i ] ).get() )
+        stats = self.ipool.conn_pools[ 'stmt_cache' ].stmt_cache_stats
+        self.assertEqual( stats[ 'misses' ], 1 )
+        self.assertEqual( stats[ 'hits' ], 4 )
+        # psycopg2 sends queries without args as they are - '%%' included
+        for sql, args in ( ( "SELECT 'a%%b' AS v;", None ), ( "SELECT 'a%%b' || %s AS v;", [ 'c' ] ) ):
+            for i in xrange( 2 ):
+                self.assertEqual( self.ipool.run( sql, args, pool = 'stmt_cache' ).get(),
+                                  self.ipool.run( sql, args ).get() )
+        self.assertEqual( self.ipool.run( "SELECT 'a%%b' AS v;", pool = 'stmt_cache' ).get()[ 0 ][ 'v' ], 'a%%b' )
+
+    def test_statement_cache_altered_table( self ):
+        """Test that a cached statement is prepared anew once its result type changed"""
+
+        self.ipool.add_pool( dsn = dsn, pool_name = 'stmt_cache', pool_size = 1,
+                             stmt_cache_size = 10 )
+        self.ipool.run( "DROP TABLE IF EXISTS test_stmt_cache_alter; CREATE TABLE test_stmt_cache_alter ( a integer ); INSERT INTO test_stmt_cache_alter VALUES ( 1 );" ).get()
+        try:
+            sql = "SELECT * FROM test_stmt_cache_alter;"
+            self.assertEqual( self.ipool.run( sql, pool = 'stmt_cache' ).get(), [ { 'a': 1 } ] )
+            self.assertEqual( self.ipool.run( sql, pool = 'stmt_cache' ).get(), [ { 'a': 1 } ] )
+            self.ipool.run( "ALTER TABLE test_stmt_cache_alter ADD COLUMN b integer DEFAULT 2;" ).get()
+            # "cached plan must not change result type"
+            with self.assertRaises( DBInteractionException ):
+                self.ipool.run( sql, pool = 'stmt_cache' ).get()
+            self.assertEqual( self.ipool.run( sql, pool = 'stmt_cache' ).get(), [ { 'a': 1, 'b': 2 } ] )
+            self.assertEqual( self.ipool.run( sql, pool = 'stmt_cache' ).get(), [ { 'a': 1, 'b': 2 } ] )
+            stats = self.ipool.conn_pools[ 'stmt_cache' ].stmt_cache_stats
+            self.assertEqual( stats[ 'misses' ], 2 )
+        finally:
+            self.ipool.run( "DROP TABLE test_stmt_cache_alter;" ).get()
+
+    def test_pool_connection( self ):
+        """Test the PoolConnection wrapper's delegation to the inner connection"""
+
+        conn = PoolConnection( 'psycopg2', dsn )
+        self.assertIs( conn.PoolConnection_conn, conn.conn )
+        self.assertEqual( conn.PoolConnection_initialized_at, conn.initialized_at )
+        # not delegated explicitly - falls through to the inner connection
+        self.assertEqual( conn.get_backend_pid(), conn.conn.get_backend_pid() )
+        self.assertEqual( conn.dsn, conn.conn.dsn )
+        with self.assertRaises( AttributeError ):
+            conn.not_here
+        with self.assertRaises( AttributeError ):
+            conn.not_here = 1
+        cursor = conn.cursor()
+        cursor.execute( "SELECT 1 AS one;" )
+        self.assertEqual( cursor.fetchone()[ 'one' ], 1 )
+        cursor.close()
+        conn.rollback()
+        conn.autocommit = True
+        self.assertTrue( conn.conn.autocommit )
+        self.assertEqual( conn.isolation_level, ISOLATION_LEVEL_AUTOCOMMIT )
+        conn.set_isolation_level( ISOLATION_LEVEL_READ_COMMITTED )
+        self.assertFalse( conn.autocommit )
+        self.assertFalse( conn.conn.autocommit )
+        conn.close()
+        self.assertTrue( conn.closed )
+
+    def test_reset_session( self ):
+        """Test that put() drops advisory locks and temp tables of a connection but keeps its cached statements"""
+
+        pool = DBConnectionPool( dsn, pool_size = 1, stmt_cache_size = 10 )
+        conn = pool.get()
+        cursor = conn.cursor()
+        conn.execute( cursor, "SELECT %s AS one;", [ 1 ] )
+        cursor.execute( "SELECT pg_advisory_lock( 4242 ); CREATE TEMP TABLE reset_session_tmp ( id int );" )
+        conn.commit()
+        cursor.close()
+        pool.put( conn )
+        conn = pool.get()
+        cursor = conn.cursor()
+        cursor.execute( "SELECT count(*) AS locks FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid();" )
+        self.assertEqual( cursor.fetchone()[ 'locks' ], 0 )
+        cursor.execute( "SELECT to_regclass( 'pg_temp.reset_session_tmp' ) AS tmp;" )
+        self.assertEqual( cursor.fetchone()[ 'tmp' ], None )
+        conn.execute( cursor, "SELECT %s AS one;", [ 1 ] )
+        self.assertEqual( pool.stmt_cache_stats[ 'hits' ], 1 )
+        cursor.close()
+        pool.put( conn )
+        pool.__del__()
+
+    def test_elastic_pool( self ):
+        """Test that the pool grows on demand and reaps idle connections"""
+
+        pool = DBConnectionPool( dsn, min_size = 1, max_size = 4, idle_timeout = 0.5 )
+        self.assertEqual( pool.size, 1 )
+        conns = [ pool.get( timeout = 5 ) for i in xrange( 4 ) ]
+        self.assertEqual( pool.size, 4 )
+        with self.assertRaises( PoolConnectionException ):
+            pool.get( timeout = 0.1 )
+        for conn in conns:
+            pool.put( conn )
+        self.assertEqual( pool.qsize, 4 )
+        gevent.sleep( 1.5 )
+        self.assertEqual( pool.size, 1 )
+        pool.__del__()
+
+    def test_maintenance_recycle( self ):
+        """Test that the maintenance greenlet replaces connections before their jittered lifetime ends"""
+
+        pool = DBConnectionPool( dsn, pool_size = 4, conn_lifetime = 2, lifetime_jitter = 0.5,
+                                 maintenance_interval = 0.2 )
+        conns = list( pool.idle )
+        for conn in conns:
+            self.assertTrue( 1.0 <= conn.expires_at - conn.initialized_at <= 2.0 )
+        gevent.sleep( 2.5 )
+        self.assertEqual( pool.size, 4 )
+        self.assertEqual( pool.qsize, 4 )
+        self.assertFalse( any( conn in pool.idle for conn in conns ) )
+        self.assertTrue( all( conn.closed for conn in conns ) )
+        self.assertTrue( pool.metrics.counters.get( 'recycles' ) >= 4 )
+        pool.__del__()
+
+    def test_maintenance_health_check( self ):
+        """Test that the maintenance greenlet replaces idle connections that fail their health check"""
+
+        pool = DBConnectionPool( dsn, pool_size = 2, health_check_interval = 0.1,
+                                 maintenance_interval = 0.2 )
+        broken = pool.idle[ 0 ]
+        self.ipool.run( "SELECT pg_terminate_backend( %s );", [ broken.get_backend_pid() ] ).get()
+        gevent.sleep( 1 )
+        self.assertEqual( pool.metrics.counters.get( 'health_check_failures' ), 1 )
+        self.assertNotIn( broken, pool.idle )
+        self.assertEqual( pool.size, 2 )
+        self.assertEqual( pool.qsize, 2 )
+        conn = pool.get()
+        conn.ping()
+        pool.put( conn )
+        pool.__del__()
+
+    def test_maintenance_stop( self ):
+        """Test that __del__ stops the maintenance greenlet"""
+
+        pool = DBConnectionPool( dsn, pool_size = 1, maintenance_interval = 0.1 )
+        maintainer = pool.maintainer
+        gevent.sleep( 0.3 )
+        self.assertFalse( maintainer.dead )
+        pool.__del__()
+        gevent.sleep( 0 )
+        self.assertTrue( maintainer.dead )
+        self.assertEqual( pool.size, 0 )
+        gevent.sleep( 0.3 )
+        self.assertEqual( pool.size, 0 )
+
+    def test_isolation_level_tracking( self ):
+        """Test that get() only changes the isolation level of a connection when it differs - with and without statement cache"""
+
+        for stmt_cache_size in ( 0, 10 ):
+            pool = DBConnectionPool( dsn, pool_size = 1, stmt_cache_size = stmt_cache_size )
+            conn = pool.get( iso_level = ISOLATION_LEVEL_SERIALIZABLE )
+            self.assertEqual( conn.isolation_level, ISOLATION_LEVEL_SERIALIZABLE )
+            pool.put( conn )
+            conn = pool.get( iso_level = ISOLATION_LEVEL_SERIALIZABLE )
+            self.assertEqual( conn.isolation_level, ISOLATION_LEVEL_SERIALIZABLE )
+            cursor = conn.cursor()
+            cursor.execute( "SHOW transaction_isolation;" )
+            self.assertEqual( cursor.fetchone()[ 'transaction_isolation' ], 'serializable' )
+            cursor.close()
+            self.assertEqual( pool.metrics.counters.get( 'isolation_changes' ), 1 )
+            pool.put( conn )
+            conn = pool.get( iso_level = ISOLATION_LEVEL_AUTOCOMMIT )
+            self.assertTrue( conn.autocommit )
+            pool.put( conn )
+            conn = pool.get()
+            self.assertEqual( conn.isolation_level, ISOLATION_LEVEL_READ_COMMITTED )
+            self.assertFalse( conn.autocommit )
+            self.assertEqual( pool.metrics.counters.get( 'isolation_changes' ), 3 )
+            pool.put( conn )
+            pool.__del__()
+
+    def test_priorities( self ):
+        """Test that waiters are served by priority and expired deadlines are dropped"""
+
+        pool = DBConnectionPool( dsn, pool_size = 1 )
+        conn = pool.get()
+        served = []
+        def get( name, priority, deadline = None ):
+            try:
+                pool.put( pool.get( priority = priority, deadline = deadline ) )
+                served.append( name )
+            except DBPoolDeadlineExceededException:
+                served.append( name + ' deadline' )
+        waiting = [ gevent.spawn( get, 'low', PRIORITY_LOW ),
+                    gevent.spawn( get, 'normal', PRIORITY_NORMAL ),
+                    gevent.spawn( get, 'high', PRIORITY_HIGH ),
+                    gevent.spawn( get, 'expired', PRIORITY_HIGH, time.time() + 0.1 ) ]
+        gevent.sleep( 0.2 )
+        pool.put( conn )
+        gevent.joinall( waiting )
+        self.assertEqual( served, [ 'expired deadline', 'high', 'normal', 'low' ] )
+        pool.__del__()
+
+    def test_get_killed( self ):
+        """Test that a waiter that is killed or times out on its own leaves no trace in the pool"""
+
+        pool = DBConnectionPool( dsn, pool_size = 1 )
+        conn = pool.get()
+        waiting = gevent.spawn( pool.get )
+        gevent.sleep( 0.1 )
+        waiting.kill()
+        pool.put( conn )
+        self.assertEqual( pool.qsize, 1 )
+        self.assertEqual( pool.in_use, 0 )
+        conn = pool.get( timeout = 0.5 )
+
+        timeout = gevent.Timeout( 0.1 )
+        with self.assertRaises( gevent.Timeout ) as raised:
+            with timeout:
+                pool.get( timeout = 1 )
+        self.assertIs( raised.exception, timeout )
+        self.assertEqual( len( pool.waiters ), 0 )
+        pool.put( conn )
+        pool.__del__()
+
+    def test_connection_budget( self ):
+        """Test that pools sharing a connection budget stay within its limit"""
+
+        path = "/tmp/gdbpool_test_budget_%i.sock" % ( os.getpid(), )
+        budget = ConnectionBudget( path, limit = 3 )
+        pool_1 = DBConnectionPool( dsn, pool_size = 5, min_size = 1, budget = budget, budget_timeout = 0.5 )
+        pool_2 = DBConnectionPool( dsn, pool_size = 5, min_size = 1, budget = budget, budget_timeout = 0.5 )
+        conns = [ pool_1.get(), pool_1.get() ]
+        self.assertEqual( budget.held, 3 )
+        conns.append( pool_2.get() )
+        waiting = gevent.spawn( pool_2.get, timeout = 2 )
+        gevent.sleep( 0.2 )
+        self.assertFalse( waiting.ready() )
+        # closing a connection of pool_1 lets pool_2 open one
+        pool_1.put( conns.pop( 0 ), force_recycle = True )
+        conns.append( waiting.get() )
+        self.assertEqual( budget.held, 3 )
+        with self.assertRaises( DBPoolBudgetException ):
+            budget.acquire( timeout = 0.1 )
+        pool_1.put( conns.pop( 0 ) )
+        pool_2.put( conns.pop( 0 ) )
+        pool_2.put( conns.pop( 0 ) )
+        pool_1.__del__()
+        pool_2.__del__()
+        self.assertEqual( budget.held, 0 )
+        budget.close()
+
+    def test_connection_budget_failover( self ):
+        """Test that the server taking over from one that died does not grant the units the clients still hold"""
+
+        path = "/tmp/gdbpool_test_budget_failover_%i.sock" % ( os.getpid(), )
+        host = ConnectionBudget( path, limit = 2 )
+        host.acquire( timeout = 1 )
+        client = ConnectionBudget( path, limit = 2, takeover_grace = 0.5 )
+        client.acquire( timeout = 1 )
+        # the host process goes away. the client takes over and reports its unit.
+        host.close()
+        gevent.sleep( 0.2 )
+        self.assertIsNotNone( client.server )
+        self.assertEqual( client.held, 1 )
+        other = ConnectionBudget( path, limit = 2 )
+        other.acquire( timeout = 2 )
+        with self.assertRaises( DBPoolBudgetException ):
+            other.acquire( timeout = 0.5 )
+        self.assertEqual( client.server.used, 2 )
+        client.release()
+        other.acquire( timeout = 1 )
+        other.close()
+        client.close()
+
+    def test_metrics( self ):
+        """Test the interaction and connection pool metrics"""
+
+        sql = """
+        SELECT val1, count(id) FROM test_values WHERE val2 = %s GROUP BY val1 order by val1;
+        """
+        for i in xrange( 5 ):
+            self.ipool.run( sql, [ i ] ).get()
+        snapshot = self.ipool.metrics_snapshot()
+        histograms = snapshot[ 'interactions' ][ 'histograms' ]
+        self.assertEqual( histograms[ self.ipool._query_metric( sql ) ][ 'count' ], 5 )
+        self.assertTrue( snapshot[ 'pools' ][ 'default' ][ 'histograms' ][ 'get_wait' ][ 'count' ] >= 5 )
+        self.assertTrue( snapshot[ 'pools' ][ 'default' ][ 'histograms' ][ 'checkout' ][ 'count' ] >= 5 )
+
+    def test_read_replicas( self ):
+        """Test balancing read interactions across read replica pools"""
+
+        for name in [ 'replica_1', 'replica_2' ]:
+            self.ipool.add_pool( dsn = dsn, pool_name = name, pool_size = 2, read_replica = True )
+        self.ipool.replica_balancer.set_strategy( 'round_robin' )
+        for i in xrange( 10 ):
+            self.ipool.run( "SELECT 1;", is_write = False ).get()
+        snapshot = self.ipool.metrics_snapshot()[ 'pools' ]
+        for name in [ 'replica_1', 'replica_2' ]:
+            self.assertEqual( snapshot[ name ][ 'histograms' ][ 'checkout' ][ 'count' ], 5 )
+
+        self.ipool.replica_balancer.report_failure( 'replica_1' )
+        self.assertEqual( self.ipool.replica_balancer.available(), [ 'replica_2' ] )
+
     def test_listen_on( self ):
         def run_insert( wait ):
             gevent.sleep( 0.1 )
@@ -216,6 +851,70 @@ class gDBPoolTests( unittest.TestCase ):
         gevent.sleep( 1 )
 
 
+    def test_listen_on_many_channels( self ):
+        """Test that all channels of a pool share one listener connection"""
+
+        idle = self.ipool.pool.qsize
+        stop_event = gevent.event.Event()
+        queues = [ Queue() for i in xrange( 10 ) ]
+        for i, rq in enumerate( queues ):
+            gevent.spawn( self.ipool.listen_on, result_queue = rq, channel_name = 'notify_test_%i' % ( i, ), cancel_event = stop_event )
+        gevent.sleep( 0.5 )
+        self.assertEqual( self.ipool.pool.qsize, idle - 1 )
+
+        self.ipool.run( "NOTIFY notify_test_3, 'k:v';" ).get()
+        self.assertEqual( queues[ 3 ].get( timeout = 1 ), { 'k': 'v' } )
+        self.assertEqual( sum( rq.qsize() for rq in queues ), 0 )
+
+        stop_event.set()
+        gevent.sleep( 0.5 )
+        self.assertEqual( self.ipool.pool.qsize, idle )
+
+    def test_listen_on_close( self ):
+        """Test that closing a subscription unsubscribes its queue right away"""
+
+        subscription = self.ipool.listen_on( channel_name = 'notify_test_close' )
+        self.ipool.run( "NOTIFY notify_test_close, 'k:1';" ).get()
+        self.assertEqual( subscription.queue.get( timeout = 1 ), { 'k': '1' } )
+        subscription.close()
+        self.ipool.run( "NOTIFY notify_test_close, 'k:2';" ).get()
+        gevent.sleep( 0.5 )
+        self.assertEqual( subscription.queue.qsize(), 0 )
+
+    def test_listen_on_batch_json( self ):
+        """Test batched delivery of JSON payloads in the order they were sent"""
+
+        subscription = self.ipool.listen_on( channel_name = 'notify_test_batch',
+                                             unmarshaller = 'json', batch = True )
+        self.ipool.run( "SELECT pg_notify( 'notify_test_batch', '{\"i\": ' || i || '}' ) FROM generate_series( 1, 5 ) AS i;" ).get()
+        batch = subscription.queue.get( timeout = 1 )
+        self.assertEqual( [ p[ 'i' ] for p in batch ], range( 1, 6 ) )
+        subscription.close()
+
+    def test_transaction( self ):
+        """Test that a transaction commits or rolls back on exit and returns its connection"""
+
+        pool = self.ipool.conn_pools[ 'default' ]
+        idle = pool.qsize
+        with self.ipool.transaction() as txn:
+            row = txn.run( "SELECT * FROM test_values WHERE id = %s FOR UPDATE;", [ 20000 ] )[ 0 ]
+            self.assertEqual( pool.qsize, idle - 1 )
+            txn.run( "UPDATE test_values SET val2 = %s WHERE id = %s;", [ row[ 'val2' ] + 1, 20000 ], get_result = False )
+        self.assertEqual( pool.qsize, idle )
+        self.assertEqual( self.ipool.run( "SELECT val2 FROM test_values WHERE id = %s;", [ 20000 ] ).get()[ 0 ][ 'val2' ], row[ 'val2' ] + 1 )
+        with self.assertRaises( ValueError ):
+            with self.ipool.transaction() as txn:
+                txn.run( "UPDATE test_values SET val2 = %s WHERE id = %s;", [ row[ 'val2' ], 20000 ], get_result = False )
+                raise ValueError( "roll back" )
+        self.assertEqual( pool.qsize, idle )
+        self.assertEqual( self.ipool.run( "SELECT val2 FROM test_values WHERE id = %s;", [ 20000 ] ).get()[ 0 ][ 'val2' ], row[ 'val2' ] + 1 )
+        with self.ipool.transaction() as txn:
+            with self.assertRaises( DBInteractionException ):
+                txn.run( "SELECT * FROM test_values_not_here;" )
+            with self.assertRaises( DBInteractionException ):
+                txn.run( "SELECT 1;" )
+        self.assertEqual( pool.qsize, idle )
+
     def test_partial_run( self ):
         def interaction_part1( conn, cursor ):
             # cursor = conn.cursor()